@@ -1,7 +1,7 @@
 import gradio as gr
 
 from scripts.config_utils import AppConfig, ProjectConfig, DevConfig
-from scripts.gradio_utils import batch_convert_all_score_gr, batch_convert_selected_score_gr, convert_to_midi_gr, convert_video_gr, create_preview_gr, download_and_convert_video_gr, download_video_gr, midi_to_dtx_and_output_image_gr, midi_to_dtx_gr, new_score_gr, reload_preview_gr, reload_video_gr, reload_workspace_gr, reset_dtx_wav_gr, reset_pitch_midi_gr, select_project_gr, select_workspace_gr, separate_music_gr, convert_test_to_midi_gr, dev_select_separate_audio_gr, dev_separate_audio_gr
+from scripts.gradio_utils import batch_convert_all_score_gr, batch_convert_selected_score_gr, convert_to_midi_gr, convert_video_gr, create_preview_gr, download_and_convert_video_gr, download_video_gr, midi_to_dtx_and_output_image_gr, midi_to_dtx_gr, new_score_gr, reload_preview_gr, reload_video_gr, reload_workspace_gr, reset_dtx_wav_gr, reset_pitch_midi_gr, select_project_gr, select_workspace_gr, separate_music_draft_gr, separate_music_progress_gr, convert_test_to_midi_gr, dev_select_separate_audio_gr, dev_separate_audio_gr
 
 demucs_models = ["htdemucs", "htdemucs_ft", "htdemucs_6s", "hdemucs_mmi", "mdx", "mdx_extra", "mdx_q", "mdx_extra_q", "SIG"]
 midi_models = ["original", "e-gmd", "mixed"]
@@ -165,7 +165,10 @@ with gr.Blocks(title="TubeDTX") as demo:
             with gr.Row():
                 with gr.Column():
                     add_space(1)
-                    separate_button = gr.Button("Separate", variant="primary")
+                    with gr.Row():
+                        separate_button = gr.Button("Separate", variant="primary")
+                    with gr.Row():
+                        separate_draft_button = gr.Button("Draft Separate")
                     separate_model_dropdown = gr.Dropdown(demucs_models, value=app_config.separate_model, label="Model (Global)")
                     separate_jobs_slider = gr.Slider(0, 32, value=app_config.separate_jobs, step=1, label="Number of Jobs (Global)")
                 with gr.Column():
@@ -176,7 +179,10 @@ with gr.Blocks(title="TubeDTX") as demo:
 
             text += "\"Separate\"ボタンを押すと、Demucsを使用して分離を実行します。\n"
             text += "各Modelの詳細は公式のREADMEを参照してください。\n"
-            text += "https://github.com/facebookresearch/demucs\n"
+            text += "https://github.com/facebookresearch/demucs\n\n"
+
+            text += "\"Draft Separate\"ボタンを押すと、Demucsを使わずにHPSSで打楽器成分を取り出して、数秒で仮分離します。\n"
+            text += "仮分離したプロジェクトは、バッチ処理の\"3. Separate Music\"でDemucsで分離し直して、MIDIと譜面も作り直します。\n"
 
             gr.TextArea(text, show_label=False)
         with gr.TabItem("4. Convert to MIDI"):
@@ -712,7 +718,19 @@ with gr.Blocks(title="TubeDTX") as demo:
                             preview_output_audio,
                       ])
 
-    separate_button.click(separate_music_gr,
+    separate_button.click(separate_music_progress_gr,
+                          inputs=[
+                              *app_config_inputs,
+                              *inputs,
+                          ],
+                          outputs=[
+                                base_output,
+                                separate_output,
+                                separate_output_audio,
+                                dtx_bpm_slider,
+                          ])
+
+    separate_draft_button.click(separate_music_draft_gr,
                           inputs=[
                               *app_config_inputs,
                               *inputs,
@@ -823,4 +841,6 @@ with gr.Blocks(title="TubeDTX") as demo:
                         ])
 
 if __name__ == "__main__":
+    # 分離などの進捗をジェネレータで表示するためにキューを使う
+    demo.queue(concurrency_count=4)
     demo.launch()
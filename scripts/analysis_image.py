@@ -0,0 +1,168 @@
+import librosa
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import PolyCollection
+from matplotlib.colors import to_rgba, to_rgba_array
+from matplotlib.figure import Figure
+from PIL import Image
+
+background_color = "black"
+foreground_color = "white"
+
+panel_dpi = 100
+# 全パネルのx軸を揃えるため、余白は固定
+panel_margins = dict(left=0.03, right=0.99, bottom=0.12, top=0.9)
+
+def _create_panel(image_width, panel_height, title):
+    # pyplotのグローバルな状態を使わずにFigureを作る
+    fig = Figure(figsize=(image_width / panel_dpi, panel_height / panel_dpi), dpi=panel_dpi, facecolor=background_color)
+    FigureCanvasAgg(fig)
+    fig.subplots_adjust(**panel_margins)
+    ax = fig.add_subplot(1, 1, 1, facecolor=background_color)
+    ax.set_title(title, color=foreground_color)
+    for spine in ax.spines.values():
+        spine.set_color(foreground_color)
+    ax.tick_params(colors=foreground_color)
+    return fig, ax
+
+def _get_plot_width(image_width):
+    return max(1, int(image_width * (panel_margins["right"] - panel_margins["left"])))
+
+def _render_panel(fig: Figure):
+    fig.canvas.draw()
+    return np.asarray(fig.canvas.buffer_rgba())[..., :3].copy()
+
+def _decimate_frames(X, max_columns):
+    # フレーム方向を最大値でまとめて、列数をmax_columns以下にする
+    X = np.asarray(X)
+    frame_count = X.shape[-1]
+    factor = max(1, -(-frame_count // max_columns))
+    if factor == 1:
+        return X, 1
+    return np.maximum.reduceat(X, np.arange(0, frame_count, factor), axis=-1), factor
+
+def _rasterize_notes(pitch, start, end, velocity, duration, columns):
+    # ノーツを(ピッチ, 時間)のRGBA画像にする。色は赤、透明度はvelocity
+    raster = np.zeros((128, columns, 4), dtype=np.float32)
+    raster[..., 0] = 1.0
+    if len(pitch) == 0 or duration <= 0:
+        return raster
+
+    scale = columns / duration
+    start_columns = np.clip((np.asarray(start) * scale).astype(np.int64), 0, columns - 1)
+    end_columns = np.clip(np.ceil(np.asarray(end) * scale).astype(np.int64), start_columns + 1, columns)
+    counts = end_columns - start_columns
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    rows = np.repeat(np.asarray(pitch, dtype=np.int64), counts)
+    cells = np.repeat(start_columns, counts) + offsets
+    alphas = np.repeat(np.clip(np.asarray(velocity, dtype=np.float32) / 127, 0, 1), counts)
+    np.maximum.at(raster[..., 3], (rows, cells), alphas)
+    return raster
+
+def _draw_note_panel(notes, title, duration, pitch_lines, min_pitch, max_pitch, image_width, panel_height):
+    fig, ax = _create_panel(image_width, panel_height, title)
+    raster = _rasterize_notes(notes.pitch, notes.start, notes.end, notes.velocity, duration, _get_plot_width(image_width))
+    ax.imshow(raster, origin="lower", aspect="auto", interpolation="nearest", extent=(0, duration, -0.5, 127.5))
+
+    for lines, color in pitch_lines:
+        ax.hlines(lines, 0, duration, color=color, alpha=0.9, linestyle="--")
+
+    ax.set_xlim(0, duration)
+    ax.set_ylim(min_pitch, max_pitch)
+    ax.set_ylabel("Pitch", color=foreground_color)
+    return _render_panel(fig)
+
+#@debug_args
+def analysis_to_image(
+        output_image_path,
+        duration,
+        S_dB,
+        onset_env,
+        onsets,
+        sr,
+        hop_length,
+        cqt_notes,
+        peak_notes,
+        drum_notes,
+        drum_lane_ids,
+        lane_colors,
+        pitch_lines,
+        min_pitch,
+        max_pitch,
+        image_width=6000,
+        panel_height=800):
+    """
+    テスト変換の解析結果(メルスペクトログラム, onset, CQT, CQTピーク, ドラムのノーツ)を縦に並べた画像を保存する
+    スペクトログラムとonset envelopeは出力画像の幅まで間引き、ノーツはラスター画像やコレクションでまとめて描画する
+    各パネルは別々のFigureとして描画し、最後に連結する
+    """
+
+    frame_time = librosa.frames_to_time(1, sr=sr, hop_length=hop_length)
+    plot_width = _get_plot_width(image_width)
+    onset_times = np.asarray(onsets) * frame_time
+    onset_max = float(np.max(onset_env)) if len(onset_env) > 0 else 1.0
+
+    def draw_spectrogram():
+        fig, ax = _create_panel(image_width, panel_height, "Mel spectrogram")
+        S, factor = _decimate_frames(S_dB, plot_width)
+        end_time = S.shape[1] * factor * frame_time
+        ax.imshow(S, origin="lower", aspect="auto", interpolation="nearest", cmap="magma", extent=(0, end_time, 0, len(S)))
+
+        # y軸はメル帯域の中心周波数
+        mel_frequencies = librosa.mel_frequencies(n_mels=len(S) + 2, fmax=sr / 2)[1:-1]
+        ticks = np.linspace(0, len(S) - 1, 6).astype(np.int64)
+        ax.set_yticks(ticks + 0.5)
+        ax.set_yticklabels([f"{int(mel_frequencies[i])}" for i in ticks])
+        ax.set_ylabel("Hz", color=foreground_color)
+        ax.set_xlim(0, duration)
+        return _render_panel(fig)
+
+    def draw_onsets():
+        fig, ax = _create_panel(image_width, panel_height, "Onset Envelope and Detected Onsets")
+        env, factor = _decimate_frames(onset_env, plot_width * 2)
+        ax.plot(np.arange(len(env)) * factor * frame_time, env, label="Onset envelope")
+        ax.vlines(onset_times, 0, onset_max, color="r", alpha=0.9, linestyle="--", label="Onsets")
+        ax.legend(facecolor=background_color, labelcolor=foreground_color)
+        ax.set_xlim(0, duration)
+        return _render_panel(fig)
+
+    def draw_drums():
+        fig, ax = _create_panel(image_width, panel_height, "Drum Notes")
+
+        # ノーツごとの矩形をまとめて1つのコレクションとして描画
+        lane_ids = np.asarray(drum_lane_ids, dtype=np.int64)
+        starts = np.asarray(drum_notes.start, dtype=np.float64)
+        ends = np.asarray(drum_notes.end, dtype=np.float64)
+        verts = np.empty((len(lane_ids), 4, 2), dtype=np.float64)
+        verts[:, [0, 3], 0] = starts[:, None]
+        verts[:, [1, 2], 0] = ends[:, None]
+        verts[:, [0, 1], 1] = lane_ids[:, None] - 0.5
+        verts[:, [2, 3], 1] = lane_ids[:, None] + 0.5
+
+        lane_rgba = to_rgba_array([lane_colors.get(lane_id, "C0") for lane_id in range(max(lane_colors.keys(), default=0) + 1)])
+        facecolors = np.zeros((len(lane_ids), 4), dtype=np.float64)
+        visible = (lane_ids >= 0) & (lane_ids < len(lane_rgba))
+        facecolors[visible] = lane_rgba[lane_ids[visible]]
+        facecolors[~visible] = to_rgba("C0")
+        facecolors[:, 3] = np.clip(np.asarray(drum_notes.velocity, dtype=np.float64) / 127, 0, 1)
+        ax.add_collection(PolyCollection(verts, facecolors=facecolors, edgecolors=foreground_color, linewidths=0.5))
+
+        ax.vlines(onset_times, 0, onset_max, color="r", alpha=0.9, linestyle="--", label="Onsets")
+        ax.set_xlim(0, duration)
+        ax.set_ylim(0, 11)
+        ax.set_xlabel("Time (seconds)", color=foreground_color)
+        ax.set_ylabel("Lane", color=foreground_color)
+        return _render_panel(fig)
+
+    # matplotlibはスレッドセーフではない(フォントキャッシュなどを共有する)ので、パネルは順番に描画する
+    panels = [
+        draw_spectrogram(),
+        draw_onsets(),
+        _draw_note_panel(cqt_notes, "CQT", duration, pitch_lines, min_pitch, max_pitch, image_width, panel_height),
+        _draw_note_panel(peak_notes, "CQT Peak", duration, pitch_lines, min_pitch, max_pitch, image_width, panel_height),
+        draw_drums(),
+    ]
+
+    Image.fromarray(np.concatenate(panels, axis=0)).save(output_image_path)
+
+    print(f"Generation of analysis image is complete. {output_image_path}")
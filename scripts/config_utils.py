@@ -112,10 +112,17 @@ class AppConfig(JsonConfig):
         if not os.path.isdir(self.workspace_path):
             return []
 
+        # "."で始まるディレクトリは分離キャッシュなどの作業用
         files = os.listdir(self.workspace_path)
-        project_paths = [os.path.join(self.workspace_path, f) for f in files if os.path.isdir(os.path.join(self.workspace_path, f))]
+        project_paths = [os.path.join(self.workspace_path, f) for f in files if os.path.isdir(os.path.join(self.workspace_path, f)) and not f.startswith(".")]
         return project_paths
 
+    def get_separation_cache_dir(self):
+        # 分離結果はWorkspace内のプロジェクトで共有する
+        if os.path.isdir(self.workspace_path):
+            return os.path.join(self.workspace_path, ".separation_cache")
+        return os.path.join(".", "cache", "separation")
+
     @classmethod
     def get_preimage(cls, project_path):
         preimage = os.path.join(project_path, "pre.jpg")
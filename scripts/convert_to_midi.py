@@ -1,11 +1,12 @@
-import librosa
-from matplotlib import pyplot as plt
-from matplotlib.patches import Rectangle
+from dataclasses import dataclass, fields
 import pretty_midi
 import numpy as np
 
+from scripts.analysis_image import analysis_to_image
 from scripts.config_utils import ProjectConfig
 from scripts.debug_utils import debug_args
+from scripts.feature_cache import FeatureCache
+from scripts.midi_utils import get_midi_tick_scales, load_midi_notes, time_to_midi_ticks, write_midi, write_midi_async
 
 # Define MIDI note numbers
 hh_note = 42
@@ -21,36 +22,141 @@ lc_note = 52
 lp_note = 44
 lbd_note = 35
 
-def _clamp(n, smallest, largest):
-    return sorted([smallest, n, largest])[1]
+# CQTの最低音 (C1)
+cqt_min_pitch = 24
 
-def get_peak_frame_data(frame_data, samples_num, frame_clip):
-    samples_indices = range(-(samples_num // 2), -(samples_num // 2) + samples_num)
+def _get_pitch_windows(X, samples_num):
+    # ピッチ方向にずらした行列のリスト。範囲外は0
+    start = -(samples_num // 2)
+    padded = np.pad(X, ((samples_num, samples_num), (0, 0)))
+    return [padded[samples_num + i:samples_num + i + len(X)] for i in range(start, start + samples_num)]
 
+def get_peak_matrix(C, samples_num, frame_clip):
     # 上下のピッチでならす
-    tmp_frame_data = {}
-    for pitch, power in frame_data.items():
-        frames = [frame_data[pitch + i] if pitch + i in frame_data else 0 for i in samples_indices]
-        tmp_frame_data[pitch] = _clamp(max(frames), 0, 1) if frame_clip else max(frames)
+    smoothed = np.max(_get_pitch_windows(C, samples_num), axis=0)
+    if frame_clip:
+        smoothed = np.clip(smoothed, 0, 1)
 
     # ピークのみ抽出
-    peak_frame_data = {}
-    for pitch, power in tmp_frame_data.items():
-        frames = [tmp_frame_data[pitch + i] if pitch + i in tmp_frame_data else 0 for i in samples_indices]
-        peak_frame_data[pitch] = tmp_frame_data[pitch] if frames.count(power) == len(frames) else 0
-
-    return peak_frame_data
-
-def percentile_average(data: list) -> float:
+    is_peak = np.all([window == smoothed for window in _get_pitch_windows(smoothed, samples_num)], axis=0)
+    return np.where(is_peak, smoothed, 0)
+
+def get_band_powers(C, peak_C, pitch_min, pitch_range, threshold):
+    # 音程範囲のピークの平均がthreshold未満のフレームは0、それ以外は音程範囲の平均パワー
+    frame_count = C.shape[1]
+    if pitch_range <= 0:
+        return np.zeros(frame_count, dtype=C.dtype)
+
+    rows = np.arange(pitch_min, pitch_min + pitch_range) - cqt_min_pitch
+    valid = (rows >= 0) & (rows < len(C))
+
+    # 範囲外のピッチは0として扱う
+    powers = np.zeros((frame_count, pitch_range), dtype=C.dtype if np.all(valid) else np.float64)
+    peak_powers = np.zeros((frame_count, pitch_range), dtype=np.float64)
+    powers[:, valid] = C[rows[valid]].T
+    peak_powers[:, valid] = peak_C[rows[valid]].T
+
+    return np.where(peak_powers.mean(axis=1) < threshold, 0, powers.mean(axis=1))
+
+def get_note_runs(mask, values, merge_runs=True):
+    """
+    maskがTrueのセル(音程, フレーム)からノーツを作る
+    merge_runsがTrueの場合は同じ音程で連続するフレームを1つのノーツにまとめ、値は区間内の最大値
+    戻り値は(音程のインデックス, 開始フレーム, フレーム数, 値)で、開始フレーム、音程の順に並ぶ
+    """
+    if not merge_runs:
+        start_frames, rows = np.nonzero(np.transpose(mask))
+        return rows, start_frames, np.ones(len(rows), dtype=np.int64), np.asarray(values)[rows, start_frames]
+
+    # 前後に空のフレームを追加して、区間の開始(0→1)と終了(1→0)を検出
+    frame_count = mask.shape[1]
+    padded = np.zeros((mask.shape[0], frame_count + 2), dtype=np.int8)
+    padded[:, 1:-1] = mask
+    diff = np.diff(padded, axis=1)
+    rows, start_frames = np.nonzero(diff == 1)
+    _, end_frames = np.nonzero(diff == -1)
+    if len(rows) == 0:
+        return rows, start_frames, end_frames - start_frames, np.zeros(0, dtype=values.dtype)
+
+    # 区間ごとの最大値 (区間は行をまたがないので、平坦化した配列でまとめて計算)
+    flat_values = np.concatenate([np.ravel(values), np.zeros(1, dtype=values.dtype)])
+    bounds = np.empty(len(rows) * 2, dtype=np.int64)
+    bounds[0::2] = rows * frame_count + start_frames
+    bounds[1::2] = rows * frame_count + end_frames
+    peaks = np.maximum.reduceat(flat_values, bounds)[0::2]
+
+    order = np.lexsort((rows, start_frames))
+    return rows[order], start_frames[order], (end_frames - start_frames)[order], peaks[order]
+
+def detect_drum_notes(powers, segmentation):
+    """
+    (ドラム数, フレーム数)のパワー行列から、ドラムごとに立ち上がり〜ピーク〜リリースを検出する
+    立ち上がり: 前フレームよりパワーが大きい、リリース: 前フレームのパワー * segmentation より小さい
+    戻り値は(ドラム番号, 開始フレーム, ピークフレーム, ベロシティ)の配列で、リリースフレーム順
+    """
+    powers = np.asarray(powers)
+    drum_count, frame_count = powers.shape
+    prev_powers = np.pad(powers, ((0, 0), (1, 0)))[:, :-1]
+    rising = powers > prev_powers
+    falling = powers.astype(np.float64) < prev_powers.astype(np.float64) * segmentation
+
+    # 立ち上がり(0)と立ち下がり(1)のイベントをドラム、フレーム、種類の順に並べる
+    rising_drums, rising_frames = np.nonzero(rising)
+    falling_drums, falling_frames = np.nonzero(falling)
+    event_drums = np.concatenate([rising_drums, falling_drums])
+    event_frames = np.concatenate([rising_frames, falling_frames])
+    event_types = np.concatenate([np.zeros(len(rising_drums), dtype=np.int64), np.ones(len(falling_drums), dtype=np.int64)])
+    order = np.lexsort((event_types, event_frames, event_drums))
+    event_drums, event_frames, event_types = event_drums[order], event_frames[order], event_types[order]
+
+    # 直前のイベントが立ち下がり(またはドラムの先頭)の立ち上がりで開始、直前のイベントが立ち上がりの立ち下がりでリリース
+    first_events = np.ones(len(event_types), dtype=bool)
+    first_events[1:] = event_drums[1:] != event_drums[:-1]
+    prev_types = np.roll(event_types, 1)
+    is_start = (event_types == 0) & (first_events | (prev_types == 1))
+    is_release = (event_types == 1) & ~first_events & (prev_types == 0)
+
+    # リリースごとに直前の開始イベントを対応付ける
+    start_events = np.maximum.accumulate(np.where(is_start, np.arange(len(event_types)), 0))
+    release_events = np.flatnonzero(is_release)
+    start_events = start_events[release_events]
+
+    drum_indices = event_drums[release_events]
+    start_frames = event_frames[start_events]
+    release_frames = event_frames[release_events]
+
+    # 開始〜リリースの立ち上がりフレームの最大パワーをベロシティとする
+    flat_powers = powers.reshape(-1)
+    flat_rising = rising.reshape(-1)
+    flat_starts = drum_indices * frame_count + start_frames
+    flat_releases = drum_indices * frame_count + release_frames
+    rising_powers = np.append(np.where(flat_rising, flat_powers, -np.inf), -np.inf)
+    boundaries = np.stack([flat_starts, flat_releases + 1], axis=1).reshape(-1)
+    velocities = np.maximum.reduceat(rising_powers, boundaries)[::2] if len(boundaries) > 0 else flat_powers[:0]
+
+    # ベロシティに最初に達した立ち上がりフレームをピークとする
+    rising_indices = np.flatnonzero(flat_rising)
+    note_indices = np.searchsorted(flat_starts, rising_indices, side='right') - 1
+    matched = note_indices >= 0
+    matched[matched] = rising_indices[matched] <= flat_releases[note_indices[matched]]
+    matched[matched] = flat_powers[rising_indices[matched]] == velocities[note_indices[matched]]
+    _, first_indices = np.unique(note_indices[matched], return_index=True)
+    peak_frames = rising_indices[matched][first_indices] - drum_indices * frame_count
+
+    # リリースフレーム順 (同フレームはドラム順)
+    order = np.lexsort((drum_indices, release_frames))
+    return drum_indices[order], start_frames[order], peak_frames[order], velocities[order]
+
+def percentile_average(data) -> float:
     if len(data) == 0:
         print("データがありません")
         return 0
 
-    data_sorted = sorted(data)
+    data_sorted = np.sort(np.asarray(data))
     lower_bound = np.percentile(data_sorted, 25)
     upper_bound = np.percentile(data_sorted, 75)
 
-    selected_data = [x for x in data_sorted if lower_bound <= x <= upper_bound]
+    selected_data = data_sorted[(lower_bound <= data_sorted) & (data_sorted <= upper_bound)]
 
     if len(selected_data) == 0:
         print("対象パーセンタイルにデータがありません")
@@ -58,91 +164,164 @@ def percentile_average(data: list) -> float:
 
     return np.mean(selected_data)
 
-def get_onset_nearest(onsets, t, range_min, range_max):
-    onset = None
-    for i in range(range_min, range_max):
-        if t + i in onsets:
-            if onset is None or abs(i) < abs(onset - t):
-                onset = t + i
-    return onset
-
-def get_offset_frame(onsets, t, range_min, range_max):
-    onset = get_onset_nearest(onsets, t, range_min, range_max)
-    if onset is not None:
-        return onset - t
-    return None
+@dataclass(repr=False)
+class DrumNotes:
+    """
+    ドラムのノーツを列ごとの配列で保持する。pretty_midiのNoteへの変換はMIDIファイルの書き込み時のみ行う
+    velocityはノーマライズまでは解析値(float)、ノーマライズ後は0-127の整数
+    """
+    pitch: np.ndarray
+    start_frame: np.ndarray
+    start: np.ndarray
+    end: np.ndarray
+    velocity: np.ndarray
+
+    def __len__(self):
+        return len(self.pitch)
+
+    def __repr__(self):
+        return f"DrumNotes({len(self)} notes)"
+
+    @classmethod
+    def from_frames(cls, pitch, start_frame, velocity, frame_time, frame_count=1):
+        start_frame = np.asarray(start_frame, dtype=np.int64)
+        start = start_frame * frame_time
+        end = start + frame_count * frame_time
+        pitch = np.broadcast_to(np.asarray(pitch, dtype=np.int64), start_frame.shape).copy()
+        return cls(pitch, start_frame, start, end, np.asarray(velocity))
+
+    @classmethod
+    def from_instrument(cls, instrument: pretty_midi.Instrument, frame_time):
+        notes = instrument.notes
+        start = np.array([note.start for note in notes], dtype=np.float64)
+        return cls(
+            pitch=np.array([note.pitch for note in notes], dtype=np.int64),
+            start_frame=(start / frame_time).astype(np.int64),
+            start=start,
+            end=np.array([note.end for note in notes], dtype=np.float64),
+            velocity=np.array([note.velocity for note in notes], dtype=np.int64))
+
+    def select(self, indices) -> "DrumNotes":
+        return DrumNotes(*[getattr(self, field.name)[indices] for field in fields(self)])
+
+    def concatenate(self, other: "DrumNotes") -> "DrumNotes":
+        return DrumNotes(*[np.concatenate([getattr(self, field.name), getattr(other, field.name)]) for field in fields(self)])
+
+    def round_trip_midi(self, midi_resolution, tempo) -> "DrumNotes":
+        """
+        pretty_midiで1トラックとしてMIDIファイルに書き込み、読み込んだ場合と同じノーツを返す
+        時刻はtick単位に丸められ、同じピッチの開いているノーツは次のノートオフ(音量0のノートオンを含む)でまとめて閉じる
+        並び順はノートオフのtick、ピッチ、ノートオンのtick、音量の順
+        """
+        write_tick_scale, read_tick_scale = get_midi_tick_scales(midi_resolution, tempo)
+        start_ticks = time_to_midi_ticks(self.start, write_tick_scale)
+        end_ticks = time_to_midi_ticks(self.end, write_tick_scale)
+
+        # (ピッチ, tick)の整数キーでノートオフを並べて、各ノートオン以降の最初のノートオフを探す
+        key_scale = int(max(start_ticks.max(initial=0), end_ticks.max(initial=0))) + 1
+        is_off_start = self.velocity <= 0
+        off_keys = np.sort(np.concatenate([
+            self.pitch * key_scale + end_ticks,
+            self.pitch[is_off_start] * key_scale + start_ticks[is_off_start]]))
+        off_indices = np.searchsorted(off_keys, self.pitch * key_scale + start_ticks, side='right')
+        off_keys = np.append(off_keys, -1) # 番兵
+        read_end_ticks = off_keys[off_indices] - self.pitch * key_scale
+        closed = ~is_off_start & (off_indices < len(off_keys) - 1) & (read_end_ticks < key_scale)
+
+        indices = np.flatnonzero(closed)
+        indices = indices[np.lexsort((indices, self.velocity[indices], start_ticks[indices], self.pitch[indices], read_end_ticks[indices]))]
+        notes = self.select(indices)
+        notes.start = start_ticks[indices] * read_tick_scale
+        notes.end = read_end_ticks[indices] * read_tick_scale
+        return notes
+
+    def to_instrument(self, program=0, is_drum=True):
+        track = pretty_midi.Instrument(program=program, is_drum=is_drum)
+        for pitch, start, end, velocity in zip(self.pitch.tolist(), self.start.tolist(), self.end.tolist(), self.velocity.tolist()):
+            track.notes.append(pretty_midi.Note(velocity=velocity, pitch=pitch, start=start, end=end))
+        return track
+
+class OnsetIndex:
+    """
+    onsetのフレーム番号をソート済みの配列で保持する
+    """
+
+    def __init__(self, onset_frames):
+        self.frames = np.unique(np.asarray(onset_frames, dtype=np.int64))
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __iter__(self):
+        return iter(self.frames.tolist())
+
+    def nearest(self, t, range_min, range_max):
+        """
+        各フレームtについて、t + [range_min, range_max)の範囲で最も近いonsetを検索する
+        同じ距離の場合は前のonsetを優先。戻り値は(onsetのフレーム番号, 見つかったかどうか)
+        """
+        t = np.asarray(t, dtype=np.int64)
+        low = t + range_min
+        high = t + range_max - 1
+        frames = np.append(self.frames, 0) # 範囲外のインデックス用の番兵
+
+        # t以前で最も後のonsetと、t以降で最も前のonset
+        before_indices = np.searchsorted(self.frames, np.minimum(t, high), side='right') - 1
+        after_indices = np.searchsorted(self.frames, np.maximum(t, low), side='left')
+        before = frames[before_indices]
+        after = frames[after_indices]
+        has_before = (before_indices >= 0) & (before >= low)
+        has_after = (after_indices < len(self.frames)) & (after <= high)
+
+        use_after = has_after & (~has_before | (after - t < t - before))
+        return np.where(use_after, after, before), has_before | has_after
 
 # offsetの調整
 @debug_args
-def adjust_offset(track, onsets, frame_time, adjust_offset_count, adjust_offset_min, adjust_offset_max):
+def adjust_offset(notes: DrumNotes, onset_index: OnsetIndex, frame_time, adjust_offset_count, adjust_offset_min, adjust_offset_max):
     for i in range(adjust_offset_count):
         # offset取得
-        offset_frames_map: dict[int, list[int]] = {}
-        for note in track.notes:
-            note: pretty_midi.Note
-            offset_frame = get_offset_frame(onsets, note.start_frame, adjust_offset_min, adjust_offset_max)
-            if offset_frame is not None:
-                if note.pitch not in offset_frames_map:
-                    offset_frames_map[note.pitch] = []
-                offset_frames_map[note.pitch].append(offset_frame)
+        nearest_onsets, found = onset_index.nearest(notes.start_frame, adjust_offset_min, adjust_offset_max)
+        offset_frames = nearest_onsets - notes.start_frame
 
         # offset計算
         offset_frame_map: dict[int, float] = {}
-        for pitch, offset_frames in offset_frames_map.items():
-            offset_frame = percentile_average(offset_frames)
+        for pitch in np.unique(notes.pitch[found]).tolist():
+            offset_frame = percentile_average(offset_frames[found & (notes.pitch == pitch)])
             if i < adjust_offset_count - 1: # 最後のループ以外は切り捨て
                 offset_frame = int(offset_frame)
             offset_frame_map[pitch] = offset_frame
             print(f"pitch:{pitch} offset_frame:{offset_frame}")
 
-        # offset適用
-        for note in track.notes:
-            note: pretty_midi.Note
-            if note.pitch in offset_frame_map:
-                offset_frame = offset_frame_map[note.pitch]
-                offset_time = offset_frame * frame_time
-                note.start_frame += offset_frame
-                note.start += offset_time
-                note.end += offset_time
+        # offset適用 (start_frameは整数部のみ)
+        for pitch, offset_frame in offset_frame_map.items():
+            indices = notes.pitch == pitch
+            offset_time = offset_frame * frame_time
+            notes.start_frame[indices] += int(offset_frame)
+            notes.start[indices] += offset_time
+            notes.end[indices] += offset_time
 
 @debug_args
 def get_onsets(input_path, offset, duration, hop_length, onset_delta):
-    # 音声ファイルの読み込みと解析
-    y, sr = librosa.load(input_path, offset=offset, duration=duration)
-    y_normalized = librosa.util.normalize(y)
-    C = np.abs(librosa.cqt(y_normalized, sr=sr, hop_length=hop_length))
-    frame_time = librosa.frames_to_time(1, sr=sr, hop_length=hop_length)
-
-    # メル周波数対数パワースペクトログラムの計算
-    S = librosa.feature.melspectrogram(y=y_normalized, sr=sr, n_mels=128, hop_length=hop_length)
-    S_dB = librosa.power_to_db(S, ref=np.max)
+    # 音声ファイルの解析 (プロジェクトの特徴量キャッシュから取得)
+    features = FeatureCache(input_path, offset, duration, hop_length)
+    C = features.get_cqt()
 
     # onsetを検出
-    onset_env = librosa.onset.onset_strength(S=S_dB, sr=sr)
-    onsets = set(librosa.onset.onset_detect(onset_envelope=onset_env, sr=sr, delta=onset_delta, hop_length=hop_length))
+    onset_env = features.get_onset_env()
+    onsets = OnsetIndex(features.get_onset_frames(onset_delta))
 
-    return onsets, onset_env, C, sr, frame_time
+    return onsets, onset_env, C, features.sr, features.frame_time
 
 @debug_args
-def normalize_notes(track, velocity_max_percentile):
-    velocities_map: dict[int, list[float]] = {}
-
-    for note in track.notes:
-        note: pretty_midi.Note = note
-        if note.pitch not in velocities_map:
-            velocities_map[note.pitch] = []
-        velocities_map[note.pitch].append(note.velocity)
-
-    # パーセンタイルで音量最大値を設定
-    max_velocities = {}
-    for pitch, velocities in velocities_map.items():
-        max_velocities[pitch] = np.percentile(velocities, velocity_max_percentile)
-
-    # チャンネルごとにノーマライズ
-    for note in track.notes:
-        note: pretty_midi.Note = note
-        max_velocity = max_velocities.get(note.pitch, 0)
-        note.velocity = _clamp(int(note.velocity / max_velocity * 127), 0, 127)
+def normalize_notes(notes: DrumNotes, velocity_max_percentile):
+    # ピッチごとにパーセンタイルで音量最大値を設定してノーマライズ
+    velocity = np.zeros(len(notes), dtype=np.int64)
+    for pitch in np.unique(notes.pitch).tolist():
+        indices = notes.pitch == pitch
+        max_velocity = np.percentile(notes.velocity[indices], velocity_max_percentile)
+        velocity[indices] = np.clip((notes.velocity[indices].astype(np.float64) / max_velocity * 127).astype(np.int64), 0, 127)
+    notes.velocity = velocity
 
 @debug_args
 def convert_to_midi_drums(
@@ -164,125 +343,82 @@ def convert_to_midi_drums(
         velocity_max_percentile,
         config: ProjectConfig):
 
-    # onsetsの取得
-    onsets, onset_env, C, sr, frame_time = get_onsets(input_path, offset, duration, hop_length, onset_delta)
+    # 音声ファイルの解析 (プロジェクトの特徴量キャッシュから取得)
+    features = FeatureCache(input_path, offset, duration, hop_length)
+    frame_time = features.frame_time
+
+    # バスドラ、フロアタム、ロータム、ハイタム、スネア推定
+    # ブロックごとにピークを抽出して音程範囲のパワーを計算 (長い音声でもCQT全体をメモリに載せない)
+    band_ranges = {
+        bd_note: (config.bd_min, config.bd_range),
+        ft_note: (config.ft_min, config.ft_range),
+        lt_note: (config.lt_min, config.lt_range),
+        ht_note: (config.ht_min, config.ht_range),
+        sn_note: (config.sn_min, config.sn_range),
+    }
+    band_powers_blocks = {pitch: [] for pitch in band_ranges}
+    for block in features.iter_blocks():
+        peak_C = get_peak_matrix(block.C, 3, True)
+        for pitch, (pitch_min, pitch_range) in band_ranges.items():
+            band_powers_blocks[pitch].append(get_band_powers(block.C, peak_C, pitch_min, pitch_range, threshold))
+    bd_powers, ft_powers, lt_powers, ht_powers, sn_powers = [np.concatenate(blocks) for blocks in band_powers_blocks.values()]
 
-    # MIDIファイルの作成
-    midi_data = pretty_midi.PrettyMIDI(resolution=bpm * resolution, initial_tempo=bpm)
+    # onsetを検出
+    onset_env = features.get_onset_env()
+    onsets = OnsetIndex(features.get_onset_frames(onset_delta))
+
+    # 低い音程のタイコが鳴っている場合は、高い音程のタムは無効
+    drums_powers = {
+        bd_note: bd_powers,
+        ft_note: np.where(bd_powers == 0, ft_powers, 0),
+        lt_note: np.where((bd_powers == 0) & (ft_powers == 0), lt_powers, 0),
+        ht_note: np.where((bd_powers == 0) & (ft_powers == 0) & (lt_powers == 0), ht_powers, 0),
+        sn_note: sn_powers,
+    }
 
-    # トラックを作成
-    track = pretty_midi.Instrument(program=0, is_drum=True)
-
-    # 曲の解析とノートイベントの追加
-    start_frames = {}
-    peak_frames = {}
-    peak_powers = {}
-    prev_drums_frame_data = {}
-
-    disable_hh_frames = set()
-
-    for t, frame in enumerate(C.T):
-        frame_data = {i + 24: power for i, power in enumerate(frame)}
-
-        # ピークのみ抽出
-        peak_frame_data = get_peak_frame_data(frame_data, 3, True)
-        drums_frame_data = {}
-
-        def get_peak_power(pitch_min, pitch_range):
-            if pitch_range <= 0:
-                return 0
-
-            powers = [peak_frame_data[i] if i in peak_frame_data else 0 for i in range(pitch_min, pitch_min + pitch_range)]
-            peak = np.mean(powers)
-            if peak < threshold:
-                return 0
-
-            powers = [frame_data[i] if i in frame_data else 0 for i in range(pitch_min, pitch_min + pitch_range)]
-            power = np.mean(powers)
-            return power
-
-        # バスドラ推定
-        bd_power = get_peak_power(config.bd_min, config.bd_range)
-        drums_frame_data[bd_note] = bd_power
-
-        # フロアタム推定
-        ft_power = get_peak_power(config.ft_min, config.ft_range)
-        drums_frame_data[ft_note] = ft_power if bd_power == 0 else 0
-
-        # ロータム推定
-        lt_power = get_peak_power(config.lt_min, config.lt_range)
-        drums_frame_data[lt_note] = lt_power if bd_power == 0 and ft_power == 0 else 0
-
-        # ハイタム推定
-        ht_power = get_peak_power(config.ht_min, config.ht_range)
-        drums_frame_data[ht_note] = ht_power if bd_power == 0 and ft_power == 0 and lt_power == 0 else 0
-
-        # スネア推定
-        sn_power = get_peak_power(config.sn_min, config.sn_range)
-        drums_frame_data[sn_note] = sn_power
-
-        # notesを生成
-        for pitch, power in drums_frame_data.items():
-            prev_power = prev_drums_frame_data[pitch] if pitch in prev_drums_frame_data else 0
-            peak_power = peak_powers[pitch] if pitch in peak_powers else 0
-
-            if power > prev_power:
-                if pitch not in start_frames:
-                    start_frames[pitch] = t
-                if power > peak_power:
-                    peak_frames[pitch] = t
-                    peak_powers[pitch] = power
-            if power < prev_power * segmentation and pitch in peak_frames:
-                start_frame = start_frames.pop(pitch)
-                peak_frame = peak_frames.pop(pitch)
-                velocity = peak_powers.pop(pitch)
-
-                start = start_frame * frame_time
-                end = start + frame_time
-                note = pretty_midi.Note(velocity=velocity, pitch=pitch, start=start, end=end)
-                note.start_frame = start_frame
-                track.notes.append(note)
-
-        prev_drums_frame_data = drums_frame_data
+    # notesを生成
+    drum_pitches = np.array(list(drums_powers.keys()))
+    drum_indices, start_frames, _, velocities = detect_drum_notes(list(drums_powers.values()), segmentation)
+    notes = DrumNotes.from_frames(drum_pitches[drum_indices], start_frames, velocities, frame_time)
 
     # ハイハット無効フレームの取得
-    for note in track.notes:
-        note: pretty_midi.Note = note
-        onset = get_onset_nearest(onsets, note.start_frame, -disable_hh_frame, disable_hh_frame)
-        if onset is not None:
-            disable_hh_frames.add(onset)
+    nearest_onsets, found = onsets.nearest(notes.start_frame, -disable_hh_frame, disable_hh_frame)
+    disable_hh_frames = nearest_onsets[found]
 
     # offsetの調整
-    adjust_offset(track, onsets, frame_time, adjust_offset_count, adjust_offset_min, adjust_offset_max)
+    adjust_offset(notes, onsets, frame_time, adjust_offset_count, adjust_offset_min, adjust_offset_max)
 
     # ハイハット推定
     # onsetがあってノーツがない場合はハイハット扱い
-    for onset in onsets:
-        if onset not in disable_hh_frames:
-            pitch = hh_note
-            start = onset * frame_time
-            end = start + frame_time
-            power = onset_env[onset]
-            velocity = power
-            note = pretty_midi.Note(velocity=velocity, pitch=pitch, start=start, end=end)
-            track.notes.append(note)
-
-    # 音量ノーマライズ
-    normalize_notes(track, velocity_max_percentile)
+    hh_onsets = onsets.frames[~np.isin(onsets.frames, disable_hh_frames)]
+    hh_notes = DrumNotes.from_frames(hh_note, hh_onsets, onset_env[hh_onsets], frame_time)
+
+    # 音量ノーマライズ (ピッチごとなので、解析値の型が異なるハイハットは別にノーマライズする)
+    normalize_notes(notes, velocity_max_percentile)
+    normalize_notes(hh_notes, velocity_max_percentile)
+    notes = notes.concatenate(hh_notes)
+
+    # MIDIファイルの作成
+    midi_data = pretty_midi.PrettyMIDI(resolution=bpm * resolution, initial_tempo=bpm)
 
     # トラックをMIDIデータに追加
-    midi_data.instruments.append(track)
+    midi_data.instruments.append(notes.to_instrument())
+
+    # MIDIファイルから読み込んだ場合と同じノーツ
+    midi_notes = notes.round_trip_midi(bpm * resolution, bpm)
 
     # ベースMIDIファイルのtrackを追加
     if base_midi_path is not None:
         base_midi = pretty_midi.PrettyMIDI(base_midi_path)
         if len(base_midi.instruments) > 0:
             midi_data.instruments.append(base_midi.instruments[0])
+            base_notes = DrumNotes.from_instrument(base_midi.instruments[0], frame_time)
+            midi_notes = midi_notes.concatenate(base_notes.round_trip_midi(bpm * resolution, bpm))
 
-    # MIDIファイルの保存
-    midi_data.write(output_path)
+    # MIDIファイルとノーツの保存 (DTXへの変換にはノーツを直接渡せるので、書き込みは待たない)
+    write_midi_async(midi_data, output_path, midi_notes)
 
-    print(f"MIDI convert is complete. {output_path}")
+    return midi_notes
 
 @debug_args
 def convert_to_midi_peak(
@@ -293,43 +429,35 @@ def convert_to_midi_peak(
         threshold,
         hop_length,
         test_offset,
-        test_duration):
-    # 音声ファイルの読み込みと解析
-    y, sr = librosa.load(input_path, offset=test_offset, duration=test_duration)
-    y_normalized = librosa.util.normalize(y)
-    C = np.abs(librosa.cqt(y_normalized, sr=sr, hop_length=hop_length))
-    frame_time = librosa.frames_to_time(1, sr=sr, hop_length=hop_length)
+        test_duration,
+        merge_runs=True):
+    # 音声ファイルの解析 (プロジェクトの特徴量キャッシュから取得)
+    features = FeatureCache(input_path, test_offset, test_duration, hop_length)
+    C = features.get_cqt()
+    frame_time = features.frame_time
 
     # MIDIファイルの作成
     midi_data = pretty_midi.PrettyMIDI(resolution=bpm * resolution, initial_tempo=bpm)
 
-    # トラックを作成
-    track = pretty_midi.Instrument(program=0, is_drum=False)
-
-    # 曲の解析とノートイベントの追加
-    for t, frame in enumerate(C.T):
-        frame_data = {i + 24: power for i, power in enumerate(frame)}
-
-        # ピークのみ抽出
-        peak_frame_data = get_peak_frame_data(frame_data, 3, True)
+    # ピークのみ抽出
+    peak_C = get_peak_matrix(C, 3, True)
 
-        # notesを生成
-        for pitch, power in peak_frame_data.items():
-            if power > threshold:
-                start = t * frame_time
-                end = start + frame_time
-                velocity = min(int(power * 127), 127)
-                note = pretty_midi.Note(velocity=velocity, pitch=pitch, start=start, end=end)
-                track.notes.append(note)
+    # 閾値を超えたピークからノーツを生成 (連続するフレームは1つのノーツにまとめる)
+    rows, start_frames, frame_counts, peaks = get_note_runs(peak_C.astype(np.float64) > threshold, peak_C, merge_runs)
+    velocities = np.minimum((peaks * 127).astype(np.int64), 127)
+    notes = DrumNotes.from_frames(rows + cqt_min_pitch, start_frames, velocities, frame_time, frame_counts)
 
     # トラックをMIDIデータに追加
-    midi_data.instruments.append(track)
+    midi_data.instruments.append(notes.to_instrument(program=0, is_drum=False))
 
-    # MIDIファイルの保存
-    midi_data.write(output_path)
+    # MIDIファイルとノーツの保存
+    midi_notes = notes.round_trip_midi(bpm * resolution, bpm)
+    write_midi(midi_data, output_path, midi_notes)
 
     print(f"MIDI convert is complete. {output_path}")
 
+    return midi_notes
+
 @debug_args
 def convert_to_midi_cqt(
         output_path,
@@ -339,51 +467,39 @@ def convert_to_midi_cqt(
         threshold,
         hop_length,
         test_offset,
-        test_duration):
-    # 音声ファイルの読み込みと解析
-    y, sr = librosa.load(input_path, offset=test_offset, duration=test_duration)
-    y_normalized = librosa.util.normalize(y)
-    C = np.abs(librosa.cqt(y_normalized, sr=sr, hop_length=hop_length))
-    frame_time = librosa.frames_to_time(1, sr=sr, hop_length=hop_length)
+        test_duration,
+        merge_runs=True):
+    # 音声ファイルの解析 (プロジェクトの特徴量キャッシュから取得)
+    features = FeatureCache(input_path, test_offset, test_duration, hop_length)
+    C = features.get_cqt()
+    frame_time = features.frame_time
 
     # MIDIファイルの作成
     midi_data = pretty_midi.PrettyMIDI(resolution=bpm * resolution, initial_tempo=bpm)
 
-    # トラックを作成
-    track = pretty_midi.Instrument(program=0, is_drum=False)
-
-    # 曲の解析とノートイベントの追加
-    velocities = []
-    for t, frame in enumerate(C.T):
-        frame_data = {i + 24: power for i, power in enumerate(frame)}
-
-        # notesを生成
-        for pitch, power in frame_data.items():
-            if power > threshold:
-                start = t * frame_time
-                end = start + frame_time
-                velocity = power
-                note = pretty_midi.Note(velocity=velocity, pitch=pitch, start=start, end=end)
-                track.notes.append(note)
-                velocities.append(velocity)
-
-    max_velocity = np.percentile(velocities, 90)
-
-    # velocityを最大値に合わせて補正
-    def fix_velocity(note: pretty_midi.Note):
-        note.velocity = _clamp(int(note.velocity / max_velocity * 127), 0, 127)
-        return note
+    # 閾値を超えたセルからノーツを生成 (連続するフレームは1つのノーツにまとめ、velocityは区間の最大値)
+    mask = C.astype(np.float64) > threshold
+    rows, start_frames, frame_counts, powers = get_note_runs(mask, C, merge_runs)
 
-    track.notes = [fix_velocity(note) for note in track.notes]
+    # velocityを最大値に合わせて補正 (最大値はまとめる前の全フレームのパワーのパーセンタイル)
+    velocities = np.zeros(len(powers), dtype=np.int64)
+    if len(powers) > 0:
+        max_velocity = np.percentile(C[mask], 90)
+        powers = powers.astype(np.promote_types(powers.dtype, np.asarray(max_velocity).dtype))
+        velocities = np.clip((powers / max_velocity * 127).astype(np.int64), 0, 127)
+    notes = DrumNotes.from_frames(rows + cqt_min_pitch, start_frames, velocities, frame_time, frame_counts)
 
     # トラックをMIDIデータに追加
-    midi_data.instruments.append(track)
+    midi_data.instruments.append(notes.to_instrument(program=0, is_drum=False))
 
-    # MIDIファイルの保存
-    midi_data.write(output_path)
+    # MIDIファイルとノーツの保存
+    midi_notes = notes.round_trip_midi(bpm * resolution, bpm)
+    write_midi(midi_data, output_path, midi_notes)
 
     print(f"MIDI convert is complete. {output_path}")
 
+    return midi_notes
+
 from scripts.midi_to_dtx import channel_to_lane_id, pitch_to_channel, note_color_map
 
 @debug_args
@@ -397,22 +513,25 @@ def output_test_image(
         onset_delta,
         offset,
         duration,
-        config: ProjectConfig):
-    # 音声ファイルの読み込み
-    y, sr = librosa.load(audio_file, offset=offset, duration=duration)
-    y_normalized = librosa.util.normalize(y)
-
-    # メル周波数対数パワースペクトログラムの計算
-    S = librosa.feature.melspectrogram(y=y_normalized, sr=sr, n_mels=128, hop_length=hop_length)
-    S_dB = librosa.power_to_db(S, ref=np.max)
-
-    # onsetを検出
-    onset_env = librosa.onset.onset_strength(S=S_dB, sr=sr)
-    onsets = librosa.onset.onset_detect(onset_envelope=onset_env, sr=sr, delta=onset_delta, hop_length=hop_length)
-
-    # 時間軸を作成
-    spectrogram_times = np.linspace(0, len(y_normalized) / sr, num=S_dB.shape[1])
-    onset_env_times = np.linspace(0, len(y_normalized) / sr, num=len(onset_env))
+        config: ProjectConfig,
+        drum_notes=None,
+        peak_notes=None,
+        cqt_notes=None):
+    # 音声ファイルの解析 (変換時に計算した特徴量を再利用)
+    features = FeatureCache(audio_file, offset, duration, hop_length)
+    S_dB = features.get_mel_db()
+    onset_env = features.get_onset_env()
+    onsets = features.get_onset_frames(onset_delta)
+    audio_duration = features.get_audio_duration()
+
+    # ノーツ (変換結果が渡されていない場合はMIDIファイルから読み込む)
+    drum_notes = drum_notes if drum_notes is not None else load_midi_notes(drum_midi_file)
+    peak_notes = peak_notes if peak_notes is not None else load_midi_notes(peak_midi_file)
+    cqt_notes = cqt_notes if cqt_notes is not None else load_midi_notes(cqt_midi_file)
+
+    def get_lane_id(pitch):
+        channel = pitch_to_channel.get(pitch, 0)
+        return channel_to_lane_id.get(channel, 0)
 
     # 音程ライン作成
     pitch_lines_map = {
@@ -422,103 +541,24 @@ def output_test_image(
         lt_note: [config.lt_min - 0.5, config.lt_min + config.lt_range - 0.5],
         ft_note: [config.ft_min - 0.5, config.ft_min + config.ft_range - 0.5],
     }
-
-    def draw_pitch_lines():
-        for pitch, lines in pitch_lines_map.items():
-            channel = pitch_to_channel.get(pitch, 0)
-            lane_id = channel_to_lane_id.get(channel, 0)
-            color = note_color_map.get(lane_id, None)
-            plt.hlines(lines, 0, duration, color=color, alpha=0.9, linestyle='--')
+    pitch_lines = [(lines, note_color_map.get(get_lane_id(pitch), None)) for pitch, lines in pitch_lines_map.items()]
 
     min_pitch = min([lines[0] - 2 for lines in pitch_lines_map.values() if lines[0] > 0 and lines[1] > 0])
     max_pitch = max([lines[1] + 2 for lines in pitch_lines_map.values() if lines[0] > 0 and lines[1] > 0])
 
-    # Set style color
-    plt.style.use({
-        'axes.facecolor': 'black',
-        'axes.edgecolor': 'white',
-        'axes.labelcolor': 'white',
-        'xtick.color': 'white',
-        'ytick.color': 'white',
-        'axes.titlecolor': 'white',
-        'figure.facecolor': 'black',
-    })
-
-    # onset envelopeとonsetを表示
-    plt.figure(figsize=(60, 40))
-
-    ax1 = plt.subplot(5, 1, 1)
-    librosa.display.specshow(S_dB, x_coords=spectrogram_times, y_axis='mel', sr=sr, fmax=8000)
-    plt.title('Mel spectrogram')
-
-    ax2 = plt.subplot(5, 1, 2, sharex=ax1)
-    plt.plot(onset_env_times, onset_env, label='Onset envelope')
-    plt.vlines(onset_env_times[onsets], 0, onset_env.max(), color='r', alpha=0.9, linestyle='--', label='Onsets')
-    plt.title('Onset Envelope and Detected Onsets')
-    plt.legend()
-
-    ax3 = plt.subplot(5, 1, 3, sharex=ax1)
-
-    pm = pretty_midi.PrettyMIDI(cqt_midi_file)
-    notes = []
-    for instrument in pm.instruments:
-        for note in instrument.notes:
-            note: pretty_midi.Note = note
-            color = (1, 0, 0, note.velocity / 127)
-            notes.append((note.start, note.pitch, color))
-
-    times, pitches, colors = zip(*notes)
-    plt.scatter(times, pitches, c=colors, marker='s')
-
-    draw_pitch_lines()
-
-    ax3.set_ylim(min_pitch, max_pitch)
-    plt.ylabel('Pitch')
-    plt.title('CQT')
-
-    ax4 = plt.subplot(5, 1, 4, sharex=ax1)
-
-    pm = pretty_midi.PrettyMIDI(peak_midi_file)
-    pitches = []
-    for instrument in pm.instruments:
-        for note in instrument.notes:
-            note: pretty_midi.Note = note
-            color = (1, 0, 0, note.velocity / 127)
-            notes.append((note.start, note.pitch, color))
-
-    times, pitches, colors = zip(*notes)
-    plt.scatter(times, pitches, c=colors, marker='s')
-
-    draw_pitch_lines()
-
-    ax4.set_ylim(min_pitch, max_pitch)
-    plt.ylabel('Pitch')
-    plt.title('CQT Peak')
-
-    ax5 = plt.subplot(5, 1, 5, sharex=ax1)
-
-    pm = pretty_midi.PrettyMIDI(drum_midi_file)
-    for instrument in pm.instruments:
-        for note in instrument.notes:
-            note: pretty_midi.Note = note
-            channel = pitch_to_channel.get(note.pitch, 0)
-            lane_id = channel_to_lane_id.get(channel, 0)
-            color = note_color_map.get(lane_id, None)
-            alpha = note.velocity / 127
-            rect = Rectangle((note.start, lane_id - 0.5), note.end - note.start, 1, facecolor=color, alpha=alpha, edgecolor='white', linewidth=0.5)
-            ax5.add_patch(rect)
-
-    plt.vlines(onset_env_times[onsets], 0, onset_env.max(), color='r', alpha=0.9, linestyle='--', label='Onsets')
-
-    ax5.set_ylim(0, 11)
-    plt.xlabel('Time (seconds)')
-    plt.ylabel('Lane')
-    plt.title('Drum Notes')
-
-    plt.tight_layout()
-
-    # 画像として保存
-    plt.savefig(output_image, dpi=100, bbox_inches='tight')
-
-    # 画像を閉じる
-    plt.close()
+    analysis_to_image(
+        output_image_path=output_image,
+        duration=audio_duration,
+        S_dB=S_dB,
+        onset_env=onset_env,
+        onsets=onsets,
+        sr=features.sr,
+        hop_length=features.hop_length,
+        cqt_notes=cqt_notes,
+        peak_notes=peak_notes,
+        drum_notes=drum_notes,
+        drum_lane_ids=[get_lane_id(pitch) for pitch in np.asarray(drum_notes.pitch).tolist()],
+        lane_colors=note_color_map,
+        pitch_lines=pitch_lines,
+        min_pitch=min_pitch,
+        max_pitch=max_pitch)
@@ -3,7 +3,8 @@ import numpy as np
 from scripts.config_utils import ProjectConfig
 from scripts.debug_utils import debug_args
 from scripts.media_utils import convert_audio, download_and_extract, get_tmp_dir
-from scripts.convert_to_midi import adjust_offset, get_onsets, hh_note, normalize_notes, sn_note, bd_note, ht_note, lt_note, ft_note, cy_note, hho_note, ride_note, lc_note, lp_note, lbd_note
+from scripts.midi_utils import write_midi
+from scripts.convert_to_midi import DrumNotes, adjust_offset, get_onsets, hh_note, normalize_notes, sn_note, bd_note, ht_note, lt_note, ft_note, cy_note, hho_note, ride_note, lc_note, lp_note, lbd_note
 import os
 
 import tensorflow._api.v2.compat.v1 as tf
@@ -138,11 +139,11 @@ def convert_to_midi_with_onsets_frames(
     # ドラムトラックの読み込み
     track_input = pretty_midi.Instrument(program=0, is_drum=True)
     for instrument in midi_input.instruments:
-        for note in instrument.notes:
-            track_input.notes.append(note)
+        track_input.notes.extend(instrument.notes)
+    notes = DrumNotes.from_instrument(track_input, frame_time)
 
     # 音量ノーマライズ
-    normalize_notes(track_input, velocity_max_percentile)
+    normalize_notes(notes, velocity_max_percentile)
 
     note_volumes = {
         sn_note: config.e_gmd_sn_volume,
@@ -153,21 +154,22 @@ def convert_to_midi_with_onsets_frames(
     }
 
     # 音量補正
-    track_output = pretty_midi.Instrument(program=0, is_drum=True)
-    for note in track_input.notes:
-        note: pretty_midi.Note = note
-        volume = note_volumes.get(note.pitch, 0)
-        note.velocity = int(note.velocity * volume / 100)
-
-        if note.velocity > 0:
-            note.start_frame = int(note.start / frame_time)
-            track_output.notes.append(note)
+    volume_table = np.zeros(128, dtype=np.int64)
+    for pitch, volume in note_volumes.items():
+        volume_table[pitch] = volume
+    notes.velocity = (notes.velocity * volume_table[notes.pitch] / 100).astype(np.int64)
+    notes = notes.select(notes.velocity > 0)
 
     # offsetの調整
-    #adjust_offset(track_output, onsets, frame_time, adjust_offset_count, adjust_offset_min, adjust_offset_max)
+    #adjust_offset(notes, onsets, frame_time, adjust_offset_count, adjust_offset_min, adjust_offset_max)
+
+    # MIDIファイルから読み込んだ場合と同じノーツ
+    midi_notes = notes.round_trip_midi(bpm * resolution, bpm)
 
-    # MIDIファイルの書き込み
-    midi_output.instruments.append(track_output)
-    midi_output.write(output_path)
+    # MIDIファイルとノーツの書き込み
+    midi_output.instruments.append(notes.to_instrument())
+    write_midi(midi_output, output_path, midi_notes)
 
     print(f"MIDI convert is complete. {output_path}")
+
+    return midi_notes
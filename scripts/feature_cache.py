@@ -0,0 +1,411 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+from dataclasses import dataclass
+import librosa
+import numpy as np
+import soundfile as sf
+
+from scripts.debug_utils import debug_args
+from scripts.hash_utils import get_cached_file_hash
+
+feature_cache_dir_name = os.path.join("cache", "features")
+analysis_cache_dir_name = os.path.join("cache", "analysis")
+feature_cache_max_bytes = 2 * 1024 * 1024 * 1024 # プロジェクトごとのキャッシュ上限
+incomplete_cache_max_age = 24 * 60 * 60 # meta.jsonがない(作成中または中断した)エントリを残す時間 (秒)
+decode_block_frames = 1024 * 1024 # デコード時に一度に読み込むフレーム数
+
+stream_min_duration = 600.0 # これより長い音声はブロックごとに解析する
+stream_block_duration = 30.0 # 1ブロックの長さ
+stream_margin_duration = 2.0 # ブロック前後の余白 (CQTの最低音のフィルタ長より長くする)
+
+def get_dir_size(dir_path):
+    size = 0
+    for root, _, files in os.walk(dir_path):
+        for file in files:
+            size += os.path.getsize(os.path.join(root, file))
+    return size
+
+def get_dir_mtime(dir_path):
+    # ディレクトリと中のファイルの最終更新時刻
+    mtime = os.path.getmtime(dir_path)
+    for root, _, files in os.walk(dir_path):
+        for file in files:
+            mtime = max(mtime, os.path.getmtime(os.path.join(root, file)))
+    return mtime
+
+@debug_args
+def evict_feature_cache(cache_dir, max_bytes, keep_dir=None):
+    # 最後にアクセスされた時刻が古いものから削除する
+    # meta.jsonがないエントリ(中断した分離の区間など)は、しばらく更新されていなければ削除する
+    if not os.path.isdir(cache_dir):
+        return
+
+    entries = []
+    incomplete_size = 0
+    for name in os.listdir(cache_dir):
+        entry_dir = os.path.join(cache_dir, name)
+        if not os.path.isdir(entry_dir):
+            continue
+        meta_path = os.path.join(entry_dir, "meta.json")
+        if os.path.exists(meta_path):
+            entries.append((os.path.getmtime(meta_path), get_dir_size(entry_dir), entry_dir))
+        elif entry_dir != keep_dir and time.time() - get_dir_mtime(entry_dir) > incomplete_cache_max_age:
+            print(f"Evict incomplete feature cache. {entry_dir}")
+            shutil.rmtree(entry_dir, ignore_errors=True)
+        else:
+            incomplete_size += get_dir_size(entry_dir)
+
+    total_size = sum(size for _, size, _ in entries) + incomplete_size
+    for _, size, entry_dir in sorted(entries):
+        if total_size <= max_bytes:
+            break
+        if entry_dir == keep_dir:
+            continue
+        print(f"Evict feature cache. {entry_dir}")
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        total_size -= size
+
+@dataclass
+class FeatureBlock:
+    frame_start: int # ブロック先頭のフレーム番号
+    C: np.ndarray
+    mel_db: np.ndarray
+    onset_env: np.ndarray
+
+class CacheEntry:
+    """
+    キーごとのディレクトリに解析結果を.npyで保存するキャッシュ
+    """
+
+    max_bytes = feature_cache_max_bytes # キャッシュディレクトリ全体の上限
+
+    def __init__(self, cache_dir, key, meta):
+        self.cache_dir = cache_dir
+        self.key = key
+        self.meta = meta
+        key_hash = hashlib.sha1(json.dumps(self.key, sort_keys=True).encode()).hexdigest()
+        self.entry_dir = os.path.join(self.cache_dir, key_hash)
+
+    def _get_path(self, name):
+        return os.path.join(self.entry_dir, f"{name}.npy")
+
+    def _touch(self):
+        meta_path = os.path.join(self.entry_dir, "meta.json")
+        if os.path.exists(meta_path):
+            os.utime(meta_path)
+        else:
+            os.makedirs(self.entry_dir, exist_ok=True)
+            with open(meta_path, "w") as f:
+                json.dump({**self.meta, **self.key}, f, indent=2)
+
+    def _evict(self):
+        evict_feature_cache(self.cache_dir, self.max_bytes, keep_dir=self.entry_dir)
+
+    def _load_or_compute(self, name, compute):
+        path = self._get_path(name)
+        if os.path.exists(path):
+            self._touch()
+            return np.load(path, mmap_mode="r")
+
+        value = compute()
+
+        self._touch()
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, value)
+        os.replace(tmp_path, path)
+        self._evict()
+
+        return value
+
+    def _has(self, name):
+        return os.path.exists(self._get_path(name))
+
+class AudioAnalysis(CacheEntry):
+    """
+    音声ファイルを1回だけデコードして、元のサンプリングレートのモノラルPCMをプロジェクトごとにキャッシュする
+    各解析(BPM, サビ, onset)で必要なサンプリングレートの信号はこのPCMから作るので、同じファイルを何度もデコードしない
+    get_yはlibrosa.load(path, sr=sr, offset=offset, duration=duration, mono=True)と同じ信号を返す
+    """
+
+    def __init__(self, input_path, cache_dir=None):
+        self.input_path = input_path
+        self.file_hash = get_cached_file_hash(input_path)
+        cache_dir = cache_dir or os.path.join(os.path.dirname(input_path), analysis_cache_dir_name)
+        super().__init__(cache_dir, {"hash": self.file_hash}, {"input_path": input_path})
+
+    def _decode(self, source_path=None):
+        # ブロックごとにデコードしてモノラルにし、メモリマップに書き込む
+        # source_pathを指定した場合は、同じ音声のエンコード前のファイルからデコードする
+        source_path = source_path or self.input_path
+        path = self._get_path("y_native")
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        os.makedirs(self.entry_dir, exist_ok=True)
+        try:
+            with sf.SoundFile(source_path) as f:
+                sr_native = f.samplerate
+                output = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float32, shape=(f.frames,))
+                frame_count = 0
+                for block in f.blocks(blocksize=decode_block_frames, dtype="float32", always_2d=True):
+                    y = librosa.to_mono(block.T)
+                    output[frame_count:frame_count + len(y)] = y
+                    frame_count += len(y)
+                output.flush()
+                # ヘッダーのフレーム数と実際に読めたフレーム数が違う場合は切り詰める
+                y = np.array(output[:frame_count]) if frame_count != len(output) else None
+                del output
+                if y is not None:
+                    with open(tmp_path, "wb") as output_file:
+                        np.save(output_file, y)
+        except sf.SoundFileRuntimeError:
+            # soundfileで読めない形式はlibrosaでまとめてデコード
+            y, sr_native = librosa.load(source_path, sr=None, mono=True)
+            with open(tmp_path, "wb") as f:
+                np.save(f, y)
+
+        os.replace(tmp_path, path)
+        np.save(self._get_path("sr_native"), np.array(sr_native))
+        self._touch()
+        self._evict()
+
+    def set_native_source(self, source_path):
+        """
+        エンコード前の同じ音声(分離したステムのWAVなど)から解析用のPCMを作る
+        """
+        self._decode(source_path)
+
+    def set_native_pcm(self, pcm, sr, gain=1.0):
+        """
+        メモリ上のPCM(channels, samples)を解析用のPCMとして保存する。エンコードしたファイルをデコードし直さない
+        """
+        pcm = np.atleast_2d(pcm)
+        path = self._get_path("y_native")
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        os.makedirs(self.entry_dir, exist_ok=True)
+        output = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float32, shape=(pcm.shape[1],))
+        for start in range(0, pcm.shape[1], decode_block_frames):
+            output[start:start + decode_block_frames] = librosa.to_mono(np.asarray(pcm[:, start:start + decode_block_frames], dtype=np.float32)) * gain
+        output.flush()
+        del output
+
+        os.replace(tmp_path, path)
+        np.save(self._get_path("sr_native"), np.array(sr))
+        self._touch()
+        self._evict()
+
+    def get_native_y(self):
+        if not (self._has("y_native") and self._has("sr_native")):
+            print(f"Decode audio. {self.input_path}")
+            self._decode()
+        self._touch()
+        return np.load(self._get_path("y_native"), mmap_mode="r"), int(np.load(self._get_path("sr_native")))
+
+    def get_duration(self):
+        y_native, sr_native = self.get_native_y()
+        return len(y_native) / sr_native
+
+    def get_y(self, sr=22050, offset=0.0, duration=None):
+        y_native, sr_native = self.get_native_y()
+        start = int(offset * sr_native) if offset else 0
+        if duration is not None:
+            y = y_native[start:start + int(duration * sr_native)]
+        else:
+            y = y_native[start:]
+        y = np.array(y)
+        if sr is not None:
+            y = librosa.resample(y, orig_sr=sr_native, target_sr=sr)
+        return y
+
+    def load_or_compute(self, name, compute):
+        """
+        このファイルの解析結果をキャッシュから読み込む。ない場合はcomputeで計算して保存する
+        """
+        return self._load_or_compute(name, compute)
+
+class FeatureCache(CacheEntry):
+    """
+    音声ファイルの解析結果(PCM, CQT, メルスペクトログラム, onset)をプロジェクトごとにキャッシュする
+    キーは音声ファイルの内容のハッシュ, sr, hop_length, offset, duration。onsetはさらにonset_deltaごと
+    各特徴量は必要になった時に計算して.npyで保存し、次回からはメモリマップで読み込む
+    PCMはAudioAnalysisのデコード結果から作る
+    stream_min_duration より長い音声は、余白付きのブロックごとに解析を行い、メモリ使用量を一定に保つ
+    """
+
+    def __init__(self, input_path, offset=0.0, duration=None, hop_length=512, sr=22050, cache_dir=None):
+        self.input_path = input_path
+        self.offset = float(offset or 0.0)
+        self.duration = float(duration) if duration is not None else None
+        self.hop_length = int(hop_length)
+        self.sr = sr
+        self.frame_time = librosa.frames_to_time(1, sr=sr, hop_length=self.hop_length)
+        self.analysis = AudioAnalysis(input_path)
+
+        key = {
+            "hash": self.analysis.file_hash,
+            "sr": self.sr,
+            "hop_length": self.hop_length,
+            "offset": self.offset,
+            "duration": self.duration,
+        }
+        cache_dir = cache_dir or os.path.join(os.path.dirname(input_path), feature_cache_dir_name)
+        super().__init__(cache_dir, key, {"input_path": input_path})
+
+    def get_source_duration(self):
+        duration = max(self.analysis.get_duration() - self.offset, 0.0)
+        if self.duration is not None:
+            duration = min(duration, self.duration)
+        return duration
+
+    def is_streaming(self):
+        return self.get_source_duration() > stream_min_duration
+
+    def _ensure_streamed(self, name):
+        # 長い音声はブロック解析でまとめてキャッシュを作成する
+        if not self._has(name) and self.is_streaming():
+            for _ in self._stream_blocks(self._get_block_frames(stream_block_duration)):
+                pass
+
+    def get_y(self):
+        # ノーマライズ済みのPCM
+        def compute():
+            y = self.analysis.get_y(sr=self.sr, offset=self.offset, duration=self.duration)
+            return librosa.util.normalize(y)
+        return self._load_or_compute("y", compute)
+
+    def get_cqt(self):
+        self._ensure_streamed("cqt")
+        return self._load_or_compute("cqt", lambda: np.abs(librosa.cqt(np.asarray(self.get_y()), sr=self.sr, hop_length=self.hop_length)))
+
+    def get_mel_db(self):
+        # メル周波数対数パワースペクトログラム
+        def compute():
+            S = librosa.feature.melspectrogram(y=np.asarray(self.get_y()), sr=self.sr, n_mels=128, hop_length=self.hop_length)
+            return librosa.power_to_db(S, ref=np.max)
+        self._ensure_streamed("mel_db")
+        return self._load_or_compute("mel_db", compute)
+
+    def get_onset_env(self):
+        self._ensure_streamed("onset_env")
+        return self._load_or_compute("onset_env", lambda: librosa.onset.onset_strength(S=np.asarray(self.get_mel_db()), sr=self.sr))
+
+    def get_onset_frames(self, onset_delta):
+        def compute():
+            onset_env = np.asarray(self.get_onset_env())
+            return librosa.onset.onset_detect(onset_envelope=onset_env, sr=self.sr, delta=onset_delta, hop_length=self.hop_length)
+        return self._load_or_compute(f"onset_frames_{float(onset_delta)}", compute)
+
+    def precompute(self):
+        # MIDI変換で使う特徴量(CQT, メルスペクトログラム, onset envelope)をまとめて計算しておく
+        for _ in self.iter_blocks():
+            pass
+
+    def get_audio_duration(self):
+        self._ensure_streamed("samples")
+        return int(self._load_or_compute("samples", lambda: np.array(len(self.get_y())))) / self.sr
+
+    def _get_block_frames(self, block_duration):
+        return max(1, int(block_duration * self.sr / self.hop_length))
+
+    def iter_blocks(self, block_duration=stream_block_duration):
+        """
+        CQT, メルスペクトログラム, onset envelopeをフレーム方向のブロックごとに返すジェネレータ
+        """
+        block_frames = self._get_block_frames(block_duration)
+        if not all(self._has(name) for name in ("cqt", "mel_db", "onset_env")) and self.is_streaming():
+            yield from self._stream_blocks(block_frames)
+            return
+
+        C = self.get_cqt()
+        mel_db = self.get_mel_db()
+        onset_env = self.get_onset_env()
+        for frame_start in range(0, C.shape[1], block_frames):
+            frame_end = frame_start + block_frames
+            yield FeatureBlock(frame_start, C[:, frame_start:frame_end], mel_db[:, frame_start:frame_end], onset_env[frame_start:frame_end])
+
+    def _load_segment(self, start, end):
+        # 解析範囲の先頭からのサンプル位置[start, end)をデコード
+        duration = (end - start) / self.sr
+        if self.duration is not None:
+            duration = min(duration, self.duration - start / self.sr)
+        if duration <= 0:
+            return np.zeros(0, dtype=np.float32)
+        return self.analysis.get_y(sr=self.sr, offset=self.offset + start / self.sr, duration=duration)
+
+    def _stream_blocks(self, block_frames):
+        hop_length = self.hop_length
+        block_samples = block_frames * hop_length
+        margin_samples = int(np.ceil(stream_margin_duration * self.sr / hop_length)) * hop_length
+
+        def iter_segments():
+            # 余白付きのブロックと、その中のブロック先頭位置
+            start = 0
+            while True:
+                segment_start = max(start - margin_samples, 0)
+                y = self._load_segment(segment_start, start + block_samples + margin_samples)
+                yield start, segment_start, y
+                if len(y) < start + block_samples - segment_start:
+                    break
+                start += block_samples
+
+        def get_mel(y):
+            return librosa.feature.melspectrogram(y=y, sr=self.sr, n_mels=128, hop_length=hop_length)
+
+        # 1パス目: ノーマライズ用のピークとdB変換用のメルパワーの最大値、全体の長さを取得
+        peak = 0.0
+        mel_max = 0.0
+        total_samples = 0
+        for start, segment_start, y in iter_segments():
+            block = y[start - segment_start:start - segment_start + block_samples]
+            if len(block) > 0:
+                peak = max(peak, float(np.max(np.abs(block))))
+                frame_offset = (start - segment_start) // hop_length
+                mel_max = max(mel_max, float(np.max(get_mel(y)[:, frame_offset:frame_offset + block_frames])))
+            total_samples = start + len(block)
+        scale = 1.0 / peak if peak > 0 else 1.0
+        mel_ref = mel_max * scale ** 2 if mel_max > 0 else 1.0
+        frame_count = 1 + total_samples // hop_length
+
+        # 2パス目: ブロックごとに解析して余白を除き、キャッシュに書き込みながら返す
+        os.makedirs(self.entry_dir, exist_ok=True)
+        outputs = {}
+        try:
+            for start, segment_start, y in iter_segments():
+                frame_start = start // hop_length
+                if frame_start >= frame_count:
+                    break
+                y = y * scale
+                frame_offset = (start - segment_start) // hop_length
+                block_slice = slice(frame_offset, frame_offset + min(block_frames, frame_count - frame_start))
+
+                C = np.abs(librosa.cqt(y, sr=self.sr, hop_length=hop_length))
+                mel_db = np.maximum(librosa.power_to_db(get_mel(y), ref=mel_ref, top_db=None), -80.0).astype(np.float32)
+                onset_env = librosa.onset.onset_strength(S=mel_db, sr=self.sr)
+                block = FeatureBlock(frame_start, C[:, block_slice], mel_db[:, block_slice], onset_env[block_slice])
+
+                for name, value in (("cqt", block.C), ("mel_db", block.mel_db), ("onset_env", block.onset_env)):
+                    if name not in outputs:
+                        shape = (*value.shape[:-1], frame_count)
+                        outputs[name] = np.lib.format.open_memmap(f"{self._get_path(name)}.{os.getpid()}.tmp", mode="w+", dtype=value.dtype, shape=shape)
+                    outputs[name][..., frame_start:frame_start + value.shape[-1]] = value
+
+                yield block
+
+            # メモリマップを閉じてから置き換える
+            names = list(outputs.keys())
+            for output in outputs.values():
+                output.flush()
+            outputs = {}
+            for name in names:
+                os.replace(f"{self._get_path(name)}.{os.getpid()}.tmp", self._get_path(name))
+            np.save(self._get_path("samples"), np.array(total_samples))
+            self._touch()
+            self._evict()
+        finally:
+            # 途中で中断された場合は書きかけのファイルを削除
+            for name in outputs:
+                tmp_path = f"{self._get_path(name)}.{os.getpid()}.tmp"
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
@@ -1,8 +1,10 @@
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import nullcontext
 from dataclasses import asdict
 import datetime
 import multiprocessing as mp
 import os
+import queue
 import shutil
 import traceback
 import gradio as gr
@@ -11,12 +13,14 @@ import requests
 from scripts.config_utils import AppConfig, ProjectConfig, DevConfig
 from scripts.convert_to_midi_with_onsets_frames import convert_to_midi_with_onsets_frames
 from scripts.debug_utils import debug_args
-from scripts.media_utils import convert_audio, create_preview_audio, download_video, extract_audio, get_tmp_dir, get_tmp_file_path, get_video_info, resize_image, trim_and_crop_video
-from scripts.music_utils import compute_bpm, compute_chorus_time
+from scripts.feature_cache import FeatureCache
+from scripts.media_utils import create_preview_audio, download_video, extract_audio, get_tmp_dir, get_tmp_file_path, get_video_info, resize_image, trim_and_crop_video
+from scripts.music_utils import detect_chorus_candidates, estimate_tempo
 from scripts.convert_to_midi import convert_to_midi_cqt, convert_to_midi_drums, convert_to_midi_peak, output_test_image
 from scripts.midi_to_dtx import midi_to_dtx
-from scripts.platform_utils import force_copy_file, get_audio_path, get_folder_path, safe_remove_file
-from scripts.separate_music import separate_music
+from scripts.midi_utils import wait_all_midi_writes
+from scripts.platform_utils import force_copy_file, get_audio_path, get_folder_path
+from scripts.separate_music import is_draft_separation, mark_draft_separation, separate_drums_draft, separate_music, separation_stems
 
 app_config = AppConfig.instance()
 dev_config = DevConfig.instance()
@@ -137,11 +141,17 @@ def _batch_convert_gr(lock: mp.Lock, project_path):
 
     base_output_log = ""
     output_log = ""
+    converted_notes = {}
 
     def check_converted(file_name):
         output_path = os.path.join(project_path, file_name)
         return app_config.batch_skip_converted and os.path.exists(output_path)
 
+    # 仮分離したプロジェクトはDemucsで分離し直して、MIDIと譜面も作り直す
+    upgrade_draft = app_config.batch_separate_music and is_draft_separation(project_path)
+    # 仮分離の印は、MIDIと譜面まで作り直せる場合だけ消す (分離だけ行った場合は次のバッチで作り直す)
+    clear_draft = upgrade_draft and app_config.batch_convert_to_midi and app_config.batch_convert_to_dtx
+
     try:
         if app_config.batch_download_movie:
             if not check_converted(config.get_fixed_download_file_name()):
@@ -165,30 +175,42 @@ def _batch_convert_gr(lock: mp.Lock, project_path):
                 output_log += outputs[1]
 
         if app_config.batch_separate_music:
-            if not check_converted("drums.wav"):
-                outputs = separate_music_gr(*app_config.to_dict().values(), *config.to_dict().values(), project_path=project_path, lock=lock)
+            if upgrade_draft or not check_converted(config.midi_input_name2):
+                outputs = separate_music_gr(*app_config.to_dict().values(), *config.to_dict().values(), project_path=project_path, lock=lock, clear_draft=False)
                 config = ProjectConfig.load(project_path)
                 base_output_log = outputs[0]
                 output_log += outputs[1]
 
         if app_config.batch_convert_to_midi:
-            if not check_converted("drums.mid"):
-                outputs = convert_to_midi_gr(*app_config.to_dict().values(), *config.to_dict().values(), project_path=project_path)
+            if upgrade_draft or not check_converted("drums.mid"):
+                outputs, converted_notes = convert_to_midi_gr(*app_config.to_dict().values(), *config.to_dict().values(), project_path=project_path, return_notes=True)
                 config = ProjectConfig.load(project_path)
                 base_output_log = outputs[0]
                 output_log += outputs[1]
 
         if app_config.batch_convert_to_dtx:
-            if not check_converted(config.dtx_output_name):
-                outputs = midi_to_dtx_gr(*config.to_dict().values(), project_path=project_path)
+            if upgrade_draft or not check_converted(config.dtx_output_name):
+                outputs = midi_to_dtx_gr(*config.to_dict().values(), project_path=project_path, output_text=False, converted_notes=converted_notes)
                 config = ProjectConfig.load(project_path)
                 base_output_log = outputs[0]
                 output_log += outputs[1]
+
+        # バックグラウンドのMIDI書き込みを待つ (プロセスの終了で書き込みが失われないように)
+        wait_all_midi_writes()
+
+        if clear_draft:
+            mark_draft_separation(project_path, False)
     except Exception as e:
         print(e)
         print(traceback.format_exc())
         output_log = f"[失敗] {config.dtx_title}\n\n"
         output_log += f"{str(e)}\n{traceback.format_exc()}\n\n"
+
+        # 途中で失敗した場合も書き込み中のMIDIファイルは書き終える
+        try:
+            wait_all_midi_writes()
+        except Exception as e:
+            print(e)
     else:
         if output_log != "":
             output_log = f"[成功] {config.dtx_title}\n\n"
@@ -218,9 +240,12 @@ def batch_convert_all_score_gr(*args):
     base_output_log = ""
     output_log = ""
 
-    pool = mp.Pool(app_config.batch_jobs)
+    # Demucsの分離でCUDAを初期化したプロセスはforkできないので、ワーカーはspawnで起動する
     lock = mp.Manager().Lock()
-    result = pool.starmap(_batch_convert_gr, [(lock, p) for p in project_paths])
+    with mp.get_context("spawn").Pool(app_config.batch_jobs) as pool:
+        result = pool.starmap(_batch_convert_gr, [(lock, p) for p in project_paths])
+        pool.close()
+        pool.join()
 
     index = project_paths.index(app_config.project_path)
     base_output_log = result[index][0]
@@ -386,9 +411,11 @@ def create_preview_gr(*args, project_path=None):
     output_log += '"3. Separate Music"タブに進んでください。\n\n'
 
     if start_time == 0.0:
-        start_time = compute_chorus_time(input_path)
+        candidates = detect_chorus_candidates(input_path)
+        start_time = candidates[0].time if len(candidates) > 0 else 0.0
         config.preview_start_time = start_time
-        output_log += f"start time: {start_time}\n\n"
+        output_log += f"start time: {start_time}\n"
+        output_log += "candidates: " + ", ".join([f"{candidate.time} ({candidate.score:.2f})" for candidate in candidates]) + "\n\n"
 
     create_preview_audio(
         input_path,
@@ -422,8 +449,35 @@ def reload_preview_gr(*args, project_path=None):
 
     return [base_output_log, output_log, input_path, output_path]
 
+def _yield_progress_gr(func, output_count, log_index, *args, **kwargs):
+    """
+    funcを別スレッドで実行し、progress(割合, メッセージ)の内容をログに表示し続けるジェネレータ
+    最後にfuncの戻り値を返す
+    """
+    progress_queue = queue.Queue()
+    def progress(fraction, message):
+        progress_queue.put(f"{message} ({fraction * 100:.0f}%)")
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(func, *args, progress=progress, **kwargs)
+        progress_log = ""
+        while not future.done() or not progress_queue.empty():
+            try:
+                progress_log += progress_queue.get(timeout=0.5) + "\n"
+            except queue.Empty:
+                continue
+            outputs = [gr.update() for _ in range(output_count)]
+            outputs[log_index] = progress_log
+            yield outputs
+
+        yield future.result()
+
+def separate_music_progress_gr(*args):
+    # 分離の進捗を表示しながら実行する (ジェネレータなのでdebug_argsは付けない)
+    yield from _yield_progress_gr(separate_music_gr, 4, 1, *args)
+
 @debug_args
-def separate_music_gr(*args, project_path=None, lock: mp.Lock=None):
+def separate_music_gr(*args, project_path=None, lock: mp.Lock=None, progress=None, clear_draft=True):
     config, project_path = parse_args(*args, project_path=project_path)
 
     model = app_config.separate_model
@@ -438,26 +492,69 @@ def separate_music_gr(*args, project_path=None, lock: mp.Lock=None):
     if not os.path.exists(input_path):
         raise Exception(f"BGMが見つかりません。 {input_path}")
 
+    progress_log = []
+    def report_progress(fraction, message):
+        progress_log.append(f"{message} ({fraction * 100:.0f}%)")
+        if progress is not None:
+            progress(fraction, message)
+
     with lock if lock is not None else nullcontext():
-        output_files = separate_music(model, input_path, project_path, jobs, drums_only=True)
+        separate_music(model, input_path, {"drums": output_path}, jobs, progress=report_progress, cache_dir=app_config.get_separation_cache_dir(), bitrate=bitrate, analyze=True)
+    if clear_draft:
+        mark_draft_separation(project_path, False)
 
-    # 音声の変換
-    convert_audio(output_files[0], output_path, bitrate)
-    safe_remove_file(output_files[0])
+    # MIDI変換で使う特徴量を、エンコード前のステムから計算しておく
+    FeatureCache(output_path, 0, None, config.midi_hop_length).precompute()
 
-    bpm = compute_bpm(output_path)
+    tempo = estimate_tempo(output_path)
+    bpm = tempo.integer_bpm
     config.dtx_bpm = bpm
 
     output_log = "ドラム音の分離に成功しました。\n"
     output_log += '"4. Convert to MIDI"タブに進んでください。\n\n'
-    output_log += f"bpm: {bpm}\n\n"
+    output_log += f"bpm: {bpm} (estimated: {tempo.bpm:.2f}, confidence: {tempo.confidence:.2f})\n\n"
+    if len(progress_log) > 0:
+        output_log += "\n".join(progress_log) + "\n\n"
+
+    base_output_log = auto_save(config, project_path)
+
+    return [base_output_log, output_log, output_path, bpm]
+
+@debug_args
+def separate_music_draft_gr(*args, project_path=None):
+    config, project_path = parse_args(*args, project_path=project_path)
+
+    input_file = config.bgm_name
+    output_file = config.midi_input_name2
+    bitrate = app_config.bgm_bitrate
+
+    input_path = os.path.join(project_path, input_file)
+    output_path = os.path.join(project_path, output_file)
+
+    if not os.path.exists(input_path):
+        raise Exception(f"BGMが見つかりません。 {input_path}")
+
+    separate_drums_draft(input_path, output_path, bitrate)
+    mark_draft_separation(project_path, True)
+
+    # MIDI変換で使う特徴量を、エンコード前の信号から計算しておく
+    FeatureCache(output_path, 0, None, config.midi_hop_length).precompute()
+
+    tempo = estimate_tempo(output_path)
+    bpm = tempo.integer_bpm
+    config.dtx_bpm = bpm
+
+    output_log = "ドラム音の仮分離に成功しました。\n"
+    output_log += "バッチ処理の\"3. Separate Music\"でDemucsによる分離に置き換えられます。\n"
+    output_log += '"4. Convert to MIDI"タブに進んでください。\n\n'
+    output_log += f"bpm: {bpm} (estimated: {tempo.bpm:.2f}, confidence: {tempo.confidence:.2f})\n\n"
 
     base_output_log = auto_save(config, project_path)
 
     return [base_output_log, output_log, output_path, bpm]
 
 @debug_args
-def _convert_to_midi_gr(*args, project_path=None, is_test=False):
+def _convert_to_midi_gr(*args, project_path=None, is_test=False, return_notes=False):
     config, project_path = parse_args(*args, project_path=project_path)
 
     input_file_name = config.midi_input_name2
@@ -476,13 +573,14 @@ def _convert_to_midi_gr(*args, project_path=None, is_test=False):
 
     input_path = os.path.join(project_path, input_file_name)
     test_image_path = None
+    converted_notes = {} # MIDIファイルのパス -> ノーツ (DTXへの変換に直接渡す)
 
     if convert_model == "e-gmd" and not is_test:
         output_path = os.path.splitext(input_path)[0] + ".mid"
         offset = 0
         duration = None
 
-        convert_to_midi_with_onsets_frames(
+        converted_notes[output_path] = convert_to_midi_with_onsets_frames(
             output_path,
             input_path,
             offset,
@@ -508,7 +606,7 @@ def _convert_to_midi_gr(*args, project_path=None, is_test=False):
         offset = 0
         duration = None
 
-        convert_to_midi_drums(
+        converted_notes[output_path] = convert_to_midi_drums(
             output_path,
             input_path,
             None,
@@ -555,7 +653,7 @@ def _convert_to_midi_gr(*args, project_path=None, is_test=False):
             config
         )
 
-        convert_to_midi_drums(
+        converted_notes[output_path] = convert_to_midi_drums(
             output_path,
             input_path,
             e_gmd_output_path,
@@ -585,7 +683,7 @@ def _convert_to_midi_gr(*args, project_path=None, is_test=False):
         offset = config.midi_test_offset
         duration = config.midi_test_duration
 
-        convert_to_midi_drums(
+        drum_notes = convert_to_midi_drums(
             test_midi_path,
             input_path,
             None,
@@ -604,7 +702,7 @@ def _convert_to_midi_gr(*args, project_path=None, is_test=False):
             velocity_max_percentile,
             config)
 
-        convert_to_midi_peak(
+        peak_notes = convert_to_midi_peak(
             peak_midi_path,
             input_path,
             bpm,
@@ -614,7 +712,7 @@ def _convert_to_midi_gr(*args, project_path=None, is_test=False):
             offset,
             duration)
 
-        convert_to_midi_cqt(
+        cqt_notes = convert_to_midi_cqt(
             cqt_midi_path,
             input_path,
             bpm,
@@ -634,18 +732,24 @@ def _convert_to_midi_gr(*args, project_path=None, is_test=False):
             onset_delta,
             offset,
             duration,
-            config)
+            config,
+            drum_notes=drum_notes,
+            peak_notes=peak_notes,
+            cqt_notes=cqt_notes)
 
         output_log = "テスト用画像の作成に成功しました。\n\n"
 
     base_output_log = auto_save(config, project_path)
 
-    return [base_output_log, output_log, test_image_path]
+    outputs = [base_output_log, output_log, test_image_path]
+    if return_notes:
+        return outputs, converted_notes
+    return outputs
 
 @debug_args
-def convert_to_midi_gr(*args, project_path=None):
+def convert_to_midi_gr(*args, project_path=None, return_notes=False):
     project_path = project_path or app_config.project_path
-    return _convert_to_midi_gr(*args, project_path=project_path, is_test=False)
+    return _convert_to_midi_gr(*args, project_path=project_path, is_test=False, return_notes=return_notes)
 
 @debug_args
 def convert_test_to_midi_gr(*args, project_path=None):
@@ -708,7 +812,7 @@ def copy_resources(config: ProjectConfig, project_path):
     print(f"Resource copying is complete.")
 
 @debug_args
-def _midi_to_dtx_gr(config: ProjectConfig, project_path: str, output_image: bool):
+def _midi_to_dtx_gr(config: ProjectConfig, project_path: str, output_image: bool, output_text: bool, converted_notes: dict = None):
     input_file_name = config.dtx_input_name
     output_file_name = config.dtx_output_name
     output_image_name = config.dtx_output_image_name
@@ -721,7 +825,10 @@ def _midi_to_dtx_gr(config: ProjectConfig, project_path: str, output_image: bool
     if not os.path.exists(os.path.join(project_path, dtx_info.VIDEO)):
         dtx_info.VIDEO = config.get_fixed_download_file_name()
 
-    dtx_text = midi_to_dtx(input_path, output_path, output_image_path, dtx_info)
+    # 直前にMIDIへ変換したノーツがあれば、MIDIファイルを読み込まずに使う
+    notes = (converted_notes or {}).get(input_path)
+
+    dtx_text = midi_to_dtx(input_path, output_path, output_image_path, dtx_info, output_text=output_text, notes=notes)
 
     config.dtx_shift_time = dtx_info.SHIFT_TIME
     config.dtx_align_nth_bd = dtx_info.ALIGN_NTH_BD
@@ -736,11 +843,11 @@ def _midi_to_dtx_gr(config: ProjectConfig, project_path: str, output_image: bool
     return [base_output_log, output_log, dtx_info.SHIFT_TIME, dtx_info.ALIGN_NTH_BD, dtx_text, output_image_path]
 
 @debug_args
-def midi_to_dtx_gr(*args, project_path=None):
+def midi_to_dtx_gr(*args, project_path=None, output_text=True, converted_notes=None):
     project_path = project_path or app_config.project_path
     config = ProjectConfig(*args)
 
-    outputs = _midi_to_dtx_gr(config, project_path, output_image=False)
+    outputs = _midi_to_dtx_gr(config, project_path, output_image=False, output_text=output_text, converted_notes=converted_notes)
     return outputs
 
 @debug_args
@@ -748,7 +855,7 @@ def midi_to_dtx_and_output_image_gr(*args, project_path=None):
     project_path = project_path or app_config.project_path
     config = ProjectConfig(*args)
 
-    outputs = _midi_to_dtx_gr(config, project_path, output_image=True)
+    outputs = _midi_to_dtx_gr(config, project_path, output_image=True, output_text=True)
     return outputs
 
 @debug_args
@@ -862,8 +969,12 @@ def dev_select_separate_audio_gr(*args):
 
     return [output_log, audio_file]
 
-@debug_args
 def dev_separate_audio_gr(*args):
+    # 分離の進捗を表示しながら実行する (ジェネレータなのでdebug_argsは付けない)
+    yield from _yield_progress_gr(_dev_separate_audio_gr, 5, 0, *args)
+
+@debug_args
+def _dev_separate_audio_gr(*args, progress=None):
     dev_config.update(*args)
     dev_config.save(".")
 
@@ -876,16 +987,17 @@ def dev_separate_audio_gr(*args):
     if not os.path.exists(input_path):
         raise Exception(f"BGMが見つかりません。 {input_path}")
 
-    output_files = separate_music(model, input_path, output_dir, jobs, drums_only=False)
+    progress_log = []
+    def report_progress(fraction, message):
+        progress_log.append(f"{message} ({fraction * 100:.0f}%)")
+        if progress is not None:
+            progress(fraction, message)
 
-    # 音声の変換
-    converted_files = []
-    for output_file in output_files:
-        converted_path = output_file.replace(".wav", ".ogg")
-        convert_audio(output_file, converted_path, bitrate)
-        safe_remove_file(output_file)
-        converted_files.append(converted_path)
+    output_paths = {stem: os.path.join(output_dir, f"{stem}.ogg") for stem in separation_stems}
+    converted_files = separate_music(model, input_path, output_paths, jobs, progress=report_progress, cache_dir=app_config.get_separation_cache_dir(), bitrate=bitrate)
 
     output_log = "音声の分離に成功しました。\n\n"
+    if len(progress_log) > 0:
+        output_log += "\n".join(progress_log) + "\n\n"
 
     return [output_log, *converted_files]
@@ -0,0 +1,30 @@
+import hashlib
+import os
+import threading
+
+_file_hashes: dict[str, tuple] = {} # 絶対パス -> ((更新日時, サイズ), ハッシュ)
+_file_hashes_lock = threading.Lock()
+
+def get_file_hash(file_path):
+    file_hash = hashlib.sha1()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+def get_cached_file_hash(file_path):
+    """
+    更新日時とサイズが前回と同じ場合は、ファイルを読み直さずに前回のハッシュを返す
+    """
+    path = os.path.abspath(file_path)
+    stat = os.stat(path)
+    key = (stat.st_mtime_ns, stat.st_size)
+    with _file_hashes_lock:
+        cached = _file_hashes.get(path)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+
+    file_hash = get_file_hash(path)
+    with _file_hashes_lock:
+        _file_hashes[path] = (key, file_hash)
+    return file_hash
@@ -17,6 +17,7 @@ from pytube.cipher import get_throttling_function_code
 import requests
 from bs4 import BeautifulSoup
 from scripts.debug_utils import debug_args
+from scripts.platform_utils import force_link_file
 from PIL import Image
 from yt_dlp import YoutubeDL
 
@@ -335,6 +336,74 @@ def convert_audio(input_file, output_file, bitrate=None, remove_original=True):
         os.remove(output_file)
     os.rename(tmp_output_file, output_file)
 
+def _move_encoded_file(tmp_output_file, output_file):
+    # tmpから出力先に移動する (同じドライブならリネームのみ)
+    if os.path.exists(output_file):
+        os.remove(output_file)
+    shutil.move(tmp_output_file, output_file)
+
+@debug_args
+def encode_audio(input_file, output_file, bitrate=None):
+    """
+    入力ファイルをコピーせずにエンコードする
+    ffmpegには全角文字を含まないtmpのパスを渡す。入力はハードリンク、出力はエンコード後に移動する
+    """
+    tmp_input_file = get_tmp_file_path(os.path.splitext(input_file)[1])
+    tmp_output_file = get_tmp_file_path(os.path.splitext(output_file)[1])
+
+    force_link_file(input_file, tmp_input_file)
+
+    ffmpeg = get_setting("FFMPEG_BINARY")
+    cmd = [ffmpeg, '-y', '-i', tmp_input_file]
+
+    if bitrate is not None:
+        cmd.append('-ab')
+        cmd.append(bitrate)
+
+    cmd.append(tmp_output_file)
+
+    print(" ".join(cmd))
+
+    try:
+        subprocess.run(cmd, check=True)
+    finally:
+        os.remove(tmp_input_file)
+
+    _move_encoded_file(tmp_output_file, output_file)
+
+#@debug_args
+def encode_pcm(pcm, samplerate, output_file, bitrate=None, gain=1.0, block_frames=1024 * 1024):
+    """
+    メモリ上のPCM(channels, samples)をffmpegの標準入力に渡してエンコードする。中間ファイルは作らない
+    ffmpegにはtmpのパスに出力させて、エンコード後に出力先に移動する
+    """
+    tmp_output_file = get_tmp_file_path(os.path.splitext(output_file)[1])
+    channels, frames = pcm.shape
+
+    ffmpeg = get_setting("FFMPEG_BINARY")
+    cmd = [ffmpeg, '-y', '-f', 'f32le', '-ar', str(samplerate), '-ac', str(channels), '-i', 'pipe:0']
+
+    if bitrate is not None:
+        cmd.append('-ab')
+        cmd.append(bitrate)
+
+    cmd.append(tmp_output_file)
+
+    print(" ".join(cmd))
+
+    process = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+    try:
+        for start in range(0, frames, block_frames):
+            block = pcm[:, start:start + block_frames] * gain
+            process.stdin.write(block.T.astype("<f4").tobytes())
+    finally:
+        process.stdin.close()
+        returncode = process.wait()
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd)
+
+    _move_encoded_file(tmp_output_file, output_file)
+
 @debug_args
 def merge_video_and_audio(input_video_file, input_audio_file, output_file, remove_original=True):
     tmp_input_video_file = get_tmp_file_path(os.path.splitext(input_video_file)[1])
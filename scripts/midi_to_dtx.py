@@ -1,14 +1,10 @@
 from dataclasses import dataclass
+import io
 import numpy as np
-import pretty_midi
-from collections import defaultdict
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-from matplotlib.patches import Rectangle
-import japanize_matplotlib
 
 from scripts.debug_utils import debug_args
+from scripts.midi_utils import load_midi_notes
+from scripts.score_image import drum_notes_to_image
 
 # Define MIDI note numbers
 hh_note = 42
@@ -159,142 +155,247 @@ class DtxInfo:
     WAV_SPLITS: int = 4
     WAV_VOLUME: int = 80
 
-@dataclass
-class DtxChip:
-    channel: str = ""
-    time: float = 0.0
-    measure_pos: int = 0
-    beat_pos: int = 0
-    resolution: int = 0
-    velocity: int = 0
-    wav_number: int = 0
-
-    @staticmethod
-    def create_pos_key(channel, measure_pos, beat_pos):
-        return f"{channel}_{measure_pos}_{beat_pos}"
-
-    def pos_key(self):
-        return DtxChip.create_pos_key(self.channel, self.measure_pos, self.beat_pos)
-
-def _clamp(n, smallest, largest):
-    return sorted([smallest, n, largest])[1]
-
-def auto_shift_time(bd_notes, chip_timings_list, dtx_info: DtxInfo, measure_time):
-    beat_pos_zero_count_list = []
-    nth_bd_start = bd_notes[dtx_info.ALIGN_NTH_BD - 1].start if dtx_info.ALIGN_NTH_BD > 0 else 0
-    for i in range(0, 20):
-        auto_shift_time = (i - 10) * 0.01 + measure_time * (nth_bd_start // measure_time + 1) - nth_bd_start
-        beat_pos_zero_count = 0
-
-        for current_time, next_time, current_measure, beat_pos in chip_timings_list:
-            if beat_pos != 0:
-                continue
-
-            for note in bd_notes:
-                if note.start + auto_shift_time >= current_time and note.start + auto_shift_time < next_time:
-                    beat_pos_zero_count += 1
-
-        beat_pos_zero_count_list.append(beat_pos_zero_count)
-
-    index = int(np.argmax(beat_pos_zero_count_list))
-    best_shift_time = (index - 10) * 0.01
-    best_zero_count = beat_pos_zero_count_list[index]
-
-    print(f"beat_pos_zero_count_list: {beat_pos_zero_count_list}")
-    print(f"best shift_time: {best_shift_time}")
-
-    return best_shift_time, best_zero_count
-
-#@debug_args
-def drum_notes_to_image(
-        notes,
-        output_image_path,
-        total_duration,
-        bpm,
-        measure_y_count,
-        chip_resolution,
-        image_width,
-        image_height,
-        title):
-
-    measure_time = 60 * 4 / float(bpm) # 1小節の時間
-    time_interval = measure_time * measure_y_count
-    grid_interval = measure_time
-
-    # Calculate the number of subplots needed
-    num_subplots = int(total_duration / time_interval) + 1
-    
-    # Calculate dpi for custom image size
-    dpi = 100
-    width = image_width / dpi
-    height = image_height / dpi
-
-    # Set style color
-    plt.style.use({
-        'axes.facecolor': 'black',
-        'axes.edgecolor': 'white',
-        'axes.labelcolor': 'white',
-        'xtick.color': 'white',
-        'ytick.color': 'white',
-        'axes.titlecolor': 'white',
-        'figure.facecolor': 'black',
-    })
-
-    # Create subplots with custom width and height
-    fig, axes = plt.subplots(1, num_subplots, sharey=True, figsize=(width * num_subplots, height), dpi=dpi)
-
-    fig.suptitle(f"{title} / BPM {bpm}", color="white")
-
-    for i, ax in enumerate(axes):
-        # Set the range of the x-axis (pitch) and y-axis (time)
-        ax.set_xlim(0, 11)
-        ax.set_ylim(0, time_interval)
-
-    # Plot notes with specified colors and transparency based on velocity in each subplot
-    for time, channel, velocity in notes:
-        start_time = time
-        end_time = time + grid_interval / chip_resolution
-        lane_id = channel_to_lane_id.get(channel, 0)
-        subplot_idx = int(start_time // time_interval)
-        relative_start_time = start_time % time_interval
-        relative_end_time = end_time % time_interval
-        color = note_color_map.get(lane_id, None)
-        alpha = velocity / 127
-
-        if color is not None:
-            rect_duration = relative_end_time - relative_start_time
-            if rect_duration < 0:
-                rect_duration = time_interval - relative_start_time
-            rect = Rectangle((lane_id - 0.5, relative_start_time), 1, rect_duration, edgecolor='white', facecolor=color, alpha=alpha, linewidth=0.5)
-            axes[subplot_idx].add_patch(rect)
-
-    for i, ax in enumerate(axes):
-        ax.set_title(f"{i * measure_y_count + 1} - {(i + 1) * measure_y_count}")
-
-        # Draw grid lines
-        for t in np.arange(0, time_interval + grid_interval, grid_interval):
-            ax.axhline(t, color='gray', linestyle='--', linewidth=0.5)
-
-        ax.set_yticklabels([])
-        ax.set_xticks([])
-
-    # Save plot as an image
-    plt.tight_layout()
-    plt.savefig(output_image_path, dpi=dpi)
-
-    print(f"Generation of Notes image is complete. {output_image_path}")
+# DTXチップの配列の型
+dtx_chip_dtype = np.dtype([
+    ("channel_id", np.int16),
+    ("measure_pos", np.int32),
+    ("beat_pos", np.int32),
+    ("resolution", np.int32),
+    ("velocity", np.int16),
+    ("wav_number", np.int32),
+])
+
+# channel_id -> DTX channel
+channel_list = [bgm_channel, video_channel, *pitch_to_channel.values()]
+
+def create_dtx_chips(channel_ids, slots, resolution, velocities, wav_numbers):
+    dtx_chips = np.zeros(len(slots), dtype=dtx_chip_dtype)
+    dtx_chips["channel_id"] = channel_ids
+    dtx_chips["measure_pos"] = np.asarray(slots) // resolution + 1
+    dtx_chips["beat_pos"] = np.asarray(slots) % resolution
+    dtx_chips["resolution"] = resolution
+    dtx_chips["velocity"] = velocities
+    dtx_chips["wav_number"] = wav_numbers
+    return dtx_chips
+
+def get_dtx_chip_pos_keys(dtx_chips, max_resolution):
+    # (小節, 拍)の整数キー
+    return dtx_chips["measure_pos"].astype(np.int64) * max_resolution + dtx_chips["beat_pos"]
+
+def get_dtx_chip_keys(dtx_chips, max_measure, max_resolution):
+    # (チャンネル, 小節, 拍)の整数キー
+    pos_keys = get_dtx_chip_pos_keys(dtx_chips, max_resolution)
+    return dtx_chips["channel_id"].astype(np.int64) * (max_measure + 1) * max_resolution + pos_keys
+
+def unique_dtx_chips(dtx_chips, max_measure, max_resolution):
+    # 同じ位置のチップは後のものを優先する
+    keys = get_dtx_chip_keys(dtx_chips, max_measure, max_resolution)
+    _, reversed_indices = np.unique(keys[::-1], return_index=True)
+    indices = np.sort(len(keys) - 1 - reversed_indices)
+    return dtx_chips[indices]
+
+def remove_hidden_hh_chips(dtx_chips, max_measure, max_resolution):
+    # HHO/RIDEのチップがある場合、HHのチップは削除する
+    pos_keys = get_dtx_chip_pos_keys(dtx_chips, max_resolution)
+    hh_indices = dtx_chips["channel_id"] == channel_list.index(hh_channel)
+    hide_hh_indices = np.isin(dtx_chips["channel_id"], [channel_list.index(hho_channel), channel_list.index(ride_channel)])
+    hidden = hh_indices & np.isin(pos_keys, pos_keys[hide_hh_indices])
+    return dtx_chips[~hidden]
+
+# WAV番号 -> 2桁の36進数文字列
+base36_pairs = np.array([np.base_repr(i, 36).rjust(2, "0") for i in range(36 * 36)])
+
+def to_base36_pairs(wav_numbers):
+    # 表の範囲外(36 * 36以上)のWAV番号はnp.base_reprで変換する
+    wav_numbers = np.asarray(wav_numbers)
+    if wav_numbers.size == 0 or wav_numbers.max() < len(base36_pairs):
+        return base36_pairs[wav_numbers]
+    return np.array([np.base_repr(n, 36).rjust(2, "0") for n in wav_numbers.ravel().tolist()]).reshape(wav_numbers.shape)
+
+class DtxWriter:
+    """
+    (小節, チャンネル)ごとのWAV番号を整数配列で保持して、DTXを書き出す
+    チャンネルごとの解像度は固定
+    """
+
+    def __init__(self, dtx_info: DtxInfo, max_measure):
+        self.dtx_info = dtx_info
+        self.max_measure = max_measure
+        self.wav_numbers: dict[str, np.ndarray] = {}
+        self.used_measures: dict[str, np.ndarray] = {}
+
+    def set_chips(self, channel, resolution, measure_positions, beat_positions, wav_numbers):
+        wav_numbers_buffer = self.wav_numbers.get(channel)
+        if wav_numbers_buffer is None or wav_numbers_buffer.shape[1] != resolution:
+            wav_numbers_buffer = np.zeros((self.max_measure + 1, resolution), dtype=np.int64)
+            self.wav_numbers[channel] = wav_numbers_buffer
+            self.used_measures[channel] = np.zeros(self.max_measure + 1, dtype=bool)
+
+        wav_numbers_buffer[measure_positions, beat_positions] = wav_numbers
+        self.used_measures[channel][measure_positions] = True
+
+    def write(self, f):
+        self.write_header(f)
+        self.write_wavs(f)
+        self.write_measures(f)
+
+    def write_header(self, f):
+        dtx_info = self.dtx_info
+        f.write(f"""; Created by TubeDTX
 
-@debug_args
-def midi_to_dtx(midi_file, output_path, output_image_path, dtx_info: DtxInfo):
-    pm = pretty_midi.PrettyMIDI(midi_file)
+#TITLE: {dtx_info.TITLE}
+#ARTIST: {dtx_info.ARTIST}
+#COMMENT: {dtx_info.COMMENT}
+#PREVIEW: {dtx_info.PREVIEW}
+#PREIMAGE: {dtx_info.PREIMAGE}
+#BPM: {dtx_info.BPM}
+#DLEVEL: {dtx_info.DLEVEL}
 
-    # Initialize defaultdict
-    dtx_data = defaultdict(lambda: '00' * dtx_info.CHIP_RESOLUTION)
+""")
 
-    pitch_list = list(pitch_to_channel.keys())
+    def write_wavs(self, f):
+        dtx_info = self.dtx_info
+
+        # Add WAV and VOLUME commands
+        f.write(f"""
+#WAV01: {dtx_info.BGM}
+#VOLUME01: {dtx_info.BGM_VOLUME}
+#BGMWAV: 01
+""")
+
+        wav_splits = dtx_info.WAV_SPLITS
+        wav_names = [
+            dtx_info.HHC_WAV,
+            dtx_info.SNARE_WAV,
+            dtx_info.BD_WAV,
+            dtx_info.HT_WAV,
+            dtx_info.LT_WAV,
+            dtx_info.FT_WAV,
+            dtx_info.CYMBAL_WAV,
+            dtx_info.HHO_WAV,
+            dtx_info.RIDE_WAV,
+            dtx_info.LC_WAV,
+            dtx_info.LP_WAV,
+            dtx_info.LBD_WAV,
+        ]
+        wav_volumes = [
+            dtx_info.HHC_VOLUME,
+            dtx_info.SNARE_VOLUME,
+            dtx_info.BD_VOLUME,
+            dtx_info.HT_VOLUME,
+            dtx_info.LT_VOLUME,
+            dtx_info.FT_VOLUME,
+            dtx_info.CYMBAL_VOLUME,
+            dtx_info.HHO_VOLUME,
+            dtx_info.RIDE_VOLUME,
+            dtx_info.LC_VOLUME,
+            dtx_info.LP_VOLUME,
+            dtx_info.LBD_VOLUME,
+        ]
+        wav_pans = [
+            dtx_info.HHC_PAN,
+            dtx_info.SNARE_PAN,
+            dtx_info.BD_PAN,
+            dtx_info.HT_PAN,
+            dtx_info.LT_PAN,
+            dtx_info.FT_PAN,
+            dtx_info.CYMBAL_PAN,
+            dtx_info.HHO_PAN,
+            dtx_info.RIDE_PAN,
+            dtx_info.LC_PAN,
+            dtx_info.LP_PAN,
+            dtx_info.LBD_PAN,
+        ]
+        wav_volumes = [v * dtx_info.WAV_VOLUME / 100 for v in wav_volumes]
+        for i in range(0, wav_splits * len(wav_names)):
+            group_index = i // wav_splits
+            wav_name = wav_names[group_index]
+            wav_volume = wav_volumes[group_index]
+            wav_pan = wav_pans[group_index]
+            wav_number_str = to_base36_pairs([i + 2])[0]
+            f.write(f"#WAV{wav_number_str}: {wav_name}\n")
+            f.write(f"#VOLUME{wav_number_str}: {int((wav_volume / wav_splits) * (i % wav_splits + 1))}\n")
+            if wav_pan != 0:
+                f.write(f"#PAN{wav_number_str}: {wav_pan}\n")
+
+        f.write(f"""
+#AVI01: {dtx_info.VIDEO}
+
+""")
+
+    def write_measures(self, f):
+        keys = []
+        for channel, used_measures in self.used_measures.items():
+            for measure_pos in np.flatnonzero(used_measures):
+                keys.append((str(measure_pos).zfill(3) + channel, channel, measure_pos))
+
+        for key, channel, measure_pos in sorted(keys):
+            f.write(f"#{key}: {''.join(to_base36_pairs(self.wav_numbers[channel][measure_pos]))}\n")
+
+def calculate_timings(max_measure, measure_time, resolution):
+    # 各グリッドの開始時間 (末尾は最終グリッドの終了時間)
+    return measure_time / resolution * np.arange(max_measure * resolution + 1)
+
+def quantize_times(times, timings):
+    # timings[i] <= time < timings[i + 1] となるグリッド番号を取得。範囲外は-1
+    slots = np.searchsorted(timings, times, side='right') - 1
+    slots[(slots < 0) | (slots >= len(timings) - 1)] = -1
+    return slots
+
+def compute_beat_pos_zero_counts(bd_starts, chip_timings, chip_resolution, measure_time, align_nth_bds):
+    # align_nth_bd x shift_time候補ごとに、小節頭のグリッドに乗るBDの数を数える
+    # 候補数を超えるalign_nth_bdは選ばれないように-1とする
+    align_nth_bds = np.asarray(align_nth_bds)
+    valid = align_nth_bds <= len(bd_starts)
+    nth_bd_starts = np.zeros(len(align_nth_bds), dtype=np.float64)
+    indices = (align_nth_bds > 0) & valid
+    nth_bd_starts[indices] = bd_starts[align_nth_bds[indices] - 1]
+
+    shift_offsets = (np.arange(20) - 10) * 0.01
+    shift_times = shift_offsets[None, :] + (measure_time * (nth_bd_starts // measure_time + 1))[:, None] - nth_bd_starts[:, None]
+
+    slots = quantize_times(bd_starts[None, :] + shift_times.reshape(-1, 1), chip_timings)
+    counts = ((slots >= 0) & (slots % chip_resolution == 0)).sum(axis=1).reshape(shift_times.shape)
+    counts[~valid] = -1
+
+    return counts
+
+def create_channel_id_table():
+    # pitch -> channel_idのテーブル。対応するchannelがない場合は-1
+    table = np.full(128, -1, dtype=np.int16)
+    for pitch, channel in pitch_to_channel.items():
+        table[pitch] = channel_list.index(channel)
+    return table
+
+def create_wav_number_table(wav_splits):
+    # (pitch, velocity) -> WAV番号のテーブル。対応するWAVがない場合は0
+    table = np.zeros((128, 128), dtype=np.int64)
+    split_velocity = 128 // wav_splits
+    wav_nums = np.clip((np.arange(128) - 1) // split_velocity + 1, 0, wav_splits - 1)
+    for index, pitch in enumerate(pitch_to_channel.keys()):
+        table[pitch] = index * wav_splits + 2 + wav_nums
+    return table
+
+@debug_args
+def midi_to_dtx(midi_file, output_path, output_image_path, dtx_info: DtxInfo, output_text=False, notes=None):
+    # notesが指定された場合はMIDIファイルを読み込まずに、そのノーツ(pitch, start, end, velocityの配列)を使う
+    if notes is None:
+        # .notes.npzが有効ならMIDIファイルを解析せずに読み込む
+        midi_notes = load_midi_notes(midi_file)
+        pitches = midi_notes.pitch
+        starts = midi_notes.start
+        ends = midi_notes.end
+        velocities = midi_notes.velocity
+        end_time = midi_notes.end_time
+    else:
+        pitches = np.array(notes.pitch, dtype=np.int64)
+        starts = np.array(notes.start, dtype=np.float64)
+        ends = np.array(notes.end, dtype=np.float64)
+        velocities = np.array(notes.velocity, dtype=np.int64)
+        end_time = max(float(ends.max()), 0.0) if len(ends) > 0 else 0.0
 
     measure_time = 60 * 4 / float(dtx_info.BPM) # 1小節の時間
-    max_measure = int(pm.get_end_time() / measure_time) + 1 # 最大小節数
+    max_measure = int(end_time / measure_time) + 1 # 最大小節数
     shift_time = dtx_info.SHIFT_TIME
 
     note_offsets = {
@@ -312,230 +413,111 @@ def midi_to_dtx(midi_file, output_path, output_image_path, dtx_info: DtxInfo):
         lbd_note: dtx_info.LBD_OFFSET,
     }
 
-    # Collect notes and adjust offset
-    notes: list[pretty_midi.Note] = []
-    for instrument in pm.instruments:
-        for note in instrument.notes:
-            note: pretty_midi.Note = note
-            offset = note_offsets.get(note.pitch, 0)
-            if offset != 0:
-                note.start += offset
-                note.end += offset
-            notes.append(note)
+    # Adjust offset
+    offset_table = np.zeros(128, dtype=np.float64)
+    for pitch, offset in note_offsets.items():
+        offset_table[pitch] = offset
+    starts += offset_table[pitches]
+    ends += offset_table[pitches]
+    total_duration = max(end_time, ends.max()) if len(ends) > 0 else end_time
 
     # Collect bd_notes
-    bd_notes = [note for note in notes if note.pitch == bd_note]
-    bd_notes.sort(key=lambda note: note.start)
-
-    def calculate_timings_list(max_measure, measure_time, resolution):
-        timings_list = []
+    bd_starts = np.sort(starts[pitches == bd_note])
 
-        for i in range(max_measure * resolution):
-            current_time = measure_time / resolution * i
-            next_time = measure_time / resolution * (i + 1)
-            current_measure = int(i / resolution) + 1
-            beat_pos = int(i % resolution)
+    chip_timings = calculate_timings(max_measure, measure_time, dtx_info.CHIP_RESOLUTION)
 
-            timings_list.append((current_time, next_time, current_measure, beat_pos))
+    if dtx_info.AUTO_ALIGN_NTH_BD or dtx_info.AUTO_SHIFT_TIME:
+        align_nth_bds = [1, 2, 3, 4, 5] if dtx_info.AUTO_ALIGN_NTH_BD else [dtx_info.ALIGN_NTH_BD]
+        beat_pos_zero_counts = compute_beat_pos_zero_counts(
+            bd_starts, chip_timings, dtx_info.CHIP_RESOLUTION, measure_time, align_nth_bds)
 
-        return timings_list
+        print(f"beat_pos_zero_counts: {beat_pos_zero_counts.tolist()}")
 
-    chip_timings_list = calculate_timings_list(max_measure, measure_time, dtx_info.CHIP_RESOLUTION)
-    bgm_timings_list = calculate_timings_list(max_measure, measure_time, dtx_info.BGM_RESOLUTION)
+        if dtx_info.AUTO_ALIGN_NTH_BD:
+            beat_pos_zero_count_list = beat_pos_zero_counts.max(axis=1)
+            dtx_info.ALIGN_NTH_BD = align_nth_bds[int(np.argmax(beat_pos_zero_count_list))]
 
-    if dtx_info.AUTO_ALIGN_NTH_BD:
-        beat_pos_zero_count_list = []
-        for i in range(0, 5):
-            dtx_info.ALIGN_NTH_BD = i + 1
-            _, zero_count = auto_shift_time(bd_notes, chip_timings_list, dtx_info, measure_time)
-            beat_pos_zero_count_list.append(zero_count)
+            print(f"beat_pos_zero_count_list: {beat_pos_zero_count_list.tolist()}")
+            print(f"best align_nth_bd: {dtx_info.ALIGN_NTH_BD}")
 
-        dtx_info.ALIGN_NTH_BD = int(np.argmax(beat_pos_zero_count_list)) + 1
+        if dtx_info.AUTO_SHIFT_TIME:
+            beat_pos_zero_count_list = beat_pos_zero_counts[align_nth_bds.index(dtx_info.ALIGN_NTH_BD)]
+            dtx_info.SHIFT_TIME = (int(np.argmax(beat_pos_zero_count_list)) - 10) * 0.01
+            shift_time = dtx_info.SHIFT_TIME
 
-        print(f"beat_pos_zero_count_list: {beat_pos_zero_count_list}")
-        print(f"best align_nth_bd: {dtx_info.ALIGN_NTH_BD}")
-
-    if dtx_info.AUTO_SHIFT_TIME:
-        dtx_info.SHIFT_TIME, zero_count = auto_shift_time(bd_notes, chip_timings_list, dtx_info, measure_time)
-        shift_time = dtx_info.SHIFT_TIME
+            print(f"beat_pos_zero_count_list: {beat_pos_zero_count_list.tolist()}")
+            print(f"best shift_time: {dtx_info.SHIFT_TIME}")
 
     if dtx_info.ALIGN_NTH_BD > 0:
-        if len(bd_notes) >= dtx_info.ALIGN_NTH_BD:
-            nth_bd_start = bd_notes[dtx_info.ALIGN_NTH_BD - 1].start
+        if len(bd_starts) >= dtx_info.ALIGN_NTH_BD:
+            nth_bd_start = bd_starts[dtx_info.ALIGN_NTH_BD - 1]
             shift_time += measure_time * (nth_bd_start // measure_time + 1) - nth_bd_start
 
-    def get_wav_number(pitch, velocity):
-        try:
-            index = pitch_list.index(pitch)
-        except ValueError:
-            return 0
-
-        offset = index * dtx_info.WAV_SPLITS + 2
-        split_velocity = 128 // dtx_info.WAV_SPLITS
-        wav_num = _clamp((velocity - 1) // split_velocity + 1, 0, dtx_info.WAV_SPLITS - 1)
-
-        return offset + wav_num
-
-    dtx_chip_map: dict[str, DtxChip] = {}
-
     # Convert bgm, video to dtx_chips
-    for current_time, next_time, current_measure, beat_pos in bgm_timings_list:
-        if current_time >= shift_time + dtx_info.BGM_OFFSET_TIME:
-            dtx_chip_bgm = DtxChip(
-                channel=bgm_channel,
-                time=current_time,
-                measure_pos=current_measure,
-                beat_pos=beat_pos,
-                resolution=dtx_info.BGM_RESOLUTION,
-                wav_number=1
-            )
-            dtx_chip_map[dtx_chip_bgm.pos_key()] = dtx_chip_bgm
-
-            dtx_chip_video = DtxChip(
-                channel=video_channel,
-                time=current_time,
-                measure_pos=current_measure,
-                beat_pos=beat_pos,
-                resolution=dtx_info.BGM_RESOLUTION,
-                wav_number=1
-            )
-            dtx_chip_map[dtx_chip_video.pos_key()] = dtx_chip_video
-            break
+    bgm_timings = calculate_timings(max_measure, measure_time, dtx_info.BGM_RESOLUTION)
+    bgm_slot = int(np.searchsorted(bgm_timings[:-1], shift_time + dtx_info.BGM_OFFSET_TIME, side='left'))
+    bgm_chips = np.zeros(0, dtype=dtx_chip_dtype)
+    if bgm_slot < len(bgm_timings) - 1:
+        bgm_chips = create_dtx_chips(
+            [channel_list.index(bgm_channel), channel_list.index(video_channel)],
+            [bgm_slot, bgm_slot],
+            dtx_info.BGM_RESOLUTION,
+            0,
+            1)
 
     # Convert notes to dtx_chips
-    for current_time, next_time, current_measure, beat_pos in chip_timings_list:
-        for note in notes:
-            if note.start + shift_time >= current_time and note.start + shift_time < next_time:
-                channel = pitch_to_channel.get(note.pitch)
-                if channel:
-                    wav_number = get_wav_number(note.pitch, note.velocity)
-                    dtx_chip = DtxChip(
-                        channel=channel,
-                        time=current_time,
-                        measure_pos=current_measure,
-                        beat_pos=beat_pos,
-                        resolution=dtx_info.CHIP_RESOLUTION,
-                        velocity=note.velocity,
-                        wav_number=wav_number
-                    )
-                    dtx_chip_map[dtx_chip.pos_key()] = dtx_chip
-
-    # HHO/RIDEのチップがある場合、HHのチップは削除する
-    dtx_chips = list(dtx_chip_map.values())
-    for dtx_chip in dtx_chips:
-        if dtx_chip.channel == hho_channel or dtx_chip.channel == ride_channel:
-            pos_key = DtxChip.create_pos_key(hh_channel, dtx_chip.measure_pos, dtx_chip.beat_pos)
-            if pos_key in dtx_chip_map:
-                del dtx_chip_map[pos_key]
-
-    # Convert dtx_chips to dtx_data
-    dtx_chips = list(dtx_chip_map.values())
-    for dtx_chip in dtx_chips:
-        measure_pos_str = str(dtx_chip.measure_pos).zfill(3)
-        channel_key = measure_pos_str + dtx_chip.channel
-
-        # Ensure the length of the dtx_data string is correct for the resolution
-        if len(dtx_data[channel_key]) != dtx_chip.resolution * 2:
-            dtx_data[channel_key] = '00' * dtx_chip.resolution
-
-        # Convert the WAV number to hexadecimal
-        wav_number_str = np.base_repr(dtx_chip.wav_number, 36).rjust(2, "0")
-        dtx_data[channel_key] = dtx_data[channel_key][:dtx_chip.beat_pos * 2] + wav_number_str + dtx_data[channel_key][(dtx_chip.beat_pos + 1) * 2:]
-
-    # Generate DTX format text
-    dtx_text = f"""; Created by TubeDTX
-
-#TITLE: {dtx_info.TITLE}
-#ARTIST: {dtx_info.ARTIST}
-#COMMENT: {dtx_info.COMMENT}
-#PREVIEW: {dtx_info.PREVIEW}
-#PREIMAGE: {dtx_info.PREIMAGE}
-#BPM: {dtx_info.BPM}
-#DLEVEL: {dtx_info.DLEVEL}
-
-"""
-
-    # Add WAV and VOLUME commands
-    dtx_text += f"""
-#WAV01: {dtx_info.BGM}
-#VOLUME01: {dtx_info.BGM_VOLUME}
-#BGMWAV: 01
-"""
-
-    wav_splits = dtx_info.WAV_SPLITS
-    wav_names = [
-        dtx_info.HHC_WAV,
-        dtx_info.SNARE_WAV,
-        dtx_info.BD_WAV,
-        dtx_info.HT_WAV,
-        dtx_info.LT_WAV,
-        dtx_info.FT_WAV,
-        dtx_info.CYMBAL_WAV,
-        dtx_info.HHO_WAV,
-        dtx_info.RIDE_WAV,
-        dtx_info.LC_WAV,
-        dtx_info.LP_WAV,
-        dtx_info.LBD_WAV,
-    ]
-    wav_volumes = [
-        dtx_info.HHC_VOLUME,
-        dtx_info.SNARE_VOLUME,
-        dtx_info.BD_VOLUME,
-        dtx_info.HT_VOLUME,
-        dtx_info.LT_VOLUME,
-        dtx_info.FT_VOLUME,
-        dtx_info.CYMBAL_VOLUME,
-        dtx_info.HHO_VOLUME,
-        dtx_info.RIDE_VOLUME,
-        dtx_info.LC_VOLUME,
-        dtx_info.LP_VOLUME,
-        dtx_info.LBD_VOLUME,
-    ]
-    wav_pans = [
-        dtx_info.HHC_PAN,
-        dtx_info.SNARE_PAN,
-        dtx_info.BD_PAN,
-        dtx_info.HT_PAN,
-        dtx_info.LT_PAN,
-        dtx_info.FT_PAN,
-        dtx_info.CYMBAL_PAN,
-        dtx_info.HHO_PAN,
-        dtx_info.RIDE_PAN,
-        dtx_info.LC_PAN,
-        dtx_info.LP_PAN,
-        dtx_info.LBD_PAN,
-    ]
-    wav_volumes = [v * dtx_info.WAV_VOLUME / 100 for v in wav_volumes]
-    for i in range(0, wav_splits * len(wav_names)):
-        group_index = i // wav_splits
-        wav_name = wav_names[group_index]
-        wav_volume = wav_volumes[group_index]
-        wav_pan = wav_pans[group_index]
-        wav_number_str = np.base_repr(i + 2, 36).rjust(2, "0")
-        dtx_text += f"#WAV{wav_number_str}: {wav_name}\n"
-        dtx_text += f"#VOLUME{wav_number_str}: {int((wav_volume / wav_splits) * (i % wav_splits + 1))}\n"
-        if wav_pan != 0:
-            dtx_text += f"#PAN{wav_number_str}: {wav_pan}\n"
-
-    dtx_text += f"""
-#AVI01: {dtx_info.VIDEO}
-
-"""
-
-    for key in sorted(dtx_data.keys()):
-        dtx_text += f"#{key}: {dtx_data[key]}\n"
+    chip_slots = quantize_times(starts + shift_time, chip_timings)
+    channel_ids = create_channel_id_table()[pitches]
+    wav_numbers = create_wav_number_table(dtx_info.WAV_SPLITS)[pitches, velocities]
+
+    # 同じ位置のチップは後のものが優先されるので、グリッド順に安定ソートする
+    indices = np.argsort(chip_slots, kind='stable')
+    indices = indices[(chip_slots[indices] >= 0) & (channel_ids[indices] >= 0)]
+    note_chips = create_dtx_chips(
+        channel_ids[indices],
+        chip_slots[indices],
+        dtx_info.CHIP_RESOLUTION,
+        velocities[indices],
+        wav_numbers[indices])
+
+    max_resolution = max(dtx_info.BGM_RESOLUTION, dtx_info.CHIP_RESOLUTION)
+    dtx_chips = np.concatenate([bgm_chips, note_chips])
+    dtx_chips = unique_dtx_chips(dtx_chips, max_measure, max_resolution)
+    dtx_chips = remove_hidden_hh_chips(dtx_chips, max_measure, max_resolution)
+
+    # Convert dtx_chips to channel buffers
+    dtx_writer = DtxWriter(dtx_info, max_measure)
+    for channel_id in np.unique(dtx_chips["channel_id"]):
+        channel_chips = dtx_chips[dtx_chips["channel_id"] == channel_id]
+        dtx_writer.set_chips(
+            channel_list[channel_id],
+            channel_chips["resolution"][0],
+            channel_chips["measure_pos"],
+            channel_chips["beat_pos"],
+            channel_chips["wav_number"])
 
     # Save dtx text
+    dtx_text = None
     with open(output_path, 'w', encoding='shift_jis', errors='ignore') as f:
-        f.write(dtx_text)
+        if output_text:
+            text_io = io.StringIO()
+            dtx_writer.write(text_io)
+            dtx_text = text_io.getvalue()
+            f.write(dtx_text)
+        else:
+            dtx_writer.write(f)
 
     # Generate image
     if output_image_path is not None:
-        notes = [(chip.time, chip.channel, chip.velocity) for chip in dtx_chips]
+        image_chips = dtx_chips[dtx_chips["resolution"] == dtx_info.CHIP_RESOLUTION]
+        lane_id_table = np.array([channel_to_lane_id.get(channel, 0) for channel in channel_list])
         drum_notes_to_image(
-            notes=notes,
+            slots=(image_chips["measure_pos"] - 1) * dtx_info.CHIP_RESOLUTION + image_chips["beat_pos"],
+            lane_ids=lane_id_table[image_chips["channel_id"]],
+            velocities=image_chips["velocity"],
+            lane_colors=note_color_map,
             output_image_path=output_image_path,
-            total_duration=pm.get_end_time(),
+            total_duration=total_duration,
             bpm=dtx_info.BPM,
             measure_y_count=10,
             chip_resolution=dtx_info.CHIP_RESOLUTION,
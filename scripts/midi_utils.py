@@ -0,0 +1,157 @@
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+import numpy as np
+import pretty_midi
+
+from scripts.hash_utils import get_file_hash
+
+_midi_write_executor = ThreadPoolExecutor(max_workers=1)
+_midi_write_futures: dict[str, Future] = {}
+_midi_write_lock = threading.Lock()
+
+def _reset_midi_write_executor():
+    # fork先には書き込みスレッドが引き継がれないので作り直す (バッチ処理のプロセスプール)
+    global _midi_write_executor, _midi_write_futures, _midi_write_lock
+    _midi_write_executor = ThreadPoolExecutor(max_workers=1)
+    _midi_write_futures = {}
+    _midi_write_lock = threading.Lock()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_midi_write_executor)
+
+def get_midi_tick_scales(midi_resolution, tempo):
+    # pretty_midiで書き込んだ時と、そのファイルを読み込んだ時の1tickの時間
+    write_tick_scale = 60.0 / (tempo * midi_resolution)
+    file_tempo = int(6e7 / (60. / (write_tick_scale * midi_resolution)))
+    read_tick_scale = 60.0 / ((6e7 / file_tempo) * midi_resolution)
+    return write_tick_scale, read_tick_scale
+
+def time_to_midi_ticks(times, write_tick_scale):
+    # pretty_midi.PrettyMIDI.time_to_tick と同じ丸め (0以下は0)
+    times = np.asarray(times, dtype=np.float64)
+    return np.where(times > 0, np.round(times / write_tick_scale), 0).astype(np.int64)
+
+@dataclass
+class MidiNotes:
+    """
+    MIDIファイルの全トラックのノーツ
+    """
+    pitch: np.ndarray
+    start: np.ndarray
+    end: np.ndarray
+    velocity: np.ndarray
+    end_time: float # pretty_midi.PrettyMIDI.get_end_time()
+
+    @classmethod
+    def from_pretty_midi(cls, pm: pretty_midi.PrettyMIDI):
+        notes = [note for instrument in pm.instruments for note in instrument.notes]
+        return cls(
+            pitch=np.array([note.pitch for note in notes], dtype=np.int64),
+            start=np.array([note.start for note in notes], dtype=np.float64),
+            end=np.array([note.end for note in notes], dtype=np.float64),
+            velocity=np.array([note.velocity for note in notes], dtype=np.int64),
+            end_time=pm.get_end_time())
+
+def get_notes_sidecar_path(midi_path):
+    return os.path.splitext(midi_path)[0] + ".notes.npz"
+
+def save_notes_sidecar(midi_path, notes, end_time=None):
+    """
+    MIDIファイルのノーツを列ごとの配列で.notes.npzに保存する
+    notesはMIDIファイルから読み込んだ場合と同じノーツ。MIDIファイルの更新日時とハッシュも保存して、読み込み時に検証する
+    """
+    if end_time is None:
+        end_time = max(float(np.max(notes.end)), 0.0) if len(notes.end) > 0 else 0.0
+
+    stat = os.stat(midi_path)
+    sidecar_path = get_notes_sidecar_path(midi_path)
+    tmp_path = f"{sidecar_path}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(
+            f,
+            pitch=np.asarray(notes.pitch, dtype=np.int64),
+            start=np.asarray(notes.start, dtype=np.float64),
+            end=np.asarray(notes.end, dtype=np.float64),
+            velocity=np.asarray(notes.velocity, dtype=np.int64),
+            end_time=end_time,
+            midi_mtime_ns=stat.st_mtime_ns,
+            midi_size=stat.st_size,
+            midi_hash=get_file_hash(midi_path))
+    os.replace(tmp_path, sidecar_path)
+
+def _load_notes_sidecar(midi_path):
+    sidecar_path = get_notes_sidecar_path(midi_path)
+    if not os.path.exists(sidecar_path):
+        return None
+
+    try:
+        with np.load(sidecar_path) as data:
+            # 更新日時とサイズが同じ、またはハッシュが同じ場合のみ有効
+            stat = os.stat(midi_path)
+            is_valid = int(data["midi_mtime_ns"]) == stat.st_mtime_ns and int(data["midi_size"]) == stat.st_size
+            if not is_valid:
+                is_valid = str(data["midi_hash"]) == get_file_hash(midi_path)
+            if not is_valid:
+                return None
+
+            return MidiNotes(data["pitch"], data["start"], data["end"], data["velocity"], float(data["end_time"]))
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Failed to load notes sidecar. {sidecar_path} {e}")
+        return None
+
+def load_midi_notes(midi_path) -> MidiNotes:
+    """
+    MIDIファイルのノーツを読み込む
+    .notes.npzが有効な場合はそれを使い、無効な場合はMIDIファイルを読み込んで.notes.npzを作り直す
+    """
+    wait_midi_write(midi_path)
+
+    notes = _load_notes_sidecar(midi_path)
+    if notes is not None:
+        return notes
+
+    notes = MidiNotes.from_pretty_midi(pretty_midi.PrettyMIDI(midi_path))
+    save_notes_sidecar(midi_path, notes, notes.end_time)
+    return notes
+
+def write_midi(midi_data: pretty_midi.PrettyMIDI, output_path, notes=None):
+    """
+    MIDIファイルを書き込む。notesを指定した場合は.notes.npzも保存する
+    """
+    tmp_path = f"{output_path}.tmp"
+    midi_data.write(tmp_path)
+    os.replace(tmp_path, output_path)
+
+    if notes is not None:
+        save_notes_sidecar(output_path, notes)
+
+def write_midi_async(midi_data: pretty_midi.PrettyMIDI, output_path, notes=None):
+    """
+    MIDIファイルをバックグラウンドで書き込む
+    書き込み中のファイルを読み込む場合は、先にwait_midi_writeを呼ぶ
+    """
+
+    def write():
+        write_midi(midi_data, output_path, notes)
+        print(f"MIDI convert is complete. {output_path}")
+
+    with _midi_write_lock:
+        future = _midi_write_executor.submit(write)
+        _midi_write_futures[os.path.abspath(output_path)] = future
+    return future
+
+def wait_midi_write(path):
+    with _midi_write_lock:
+        future = _midi_write_futures.pop(os.path.abspath(path), None)
+    if future is not None:
+        future.result()
+
+def wait_all_midi_writes():
+    # 書き込み中の全てのMIDIファイルを待つ
+    with _midi_write_lock:
+        futures = list(_midi_write_futures.values())
+        _midi_write_futures.clear()
+    for future in futures:
+        future.result()
@@ -1,82 +1,168 @@
+from dataclasses import dataclass
 import librosa
 import numpy as np
 
 from scripts.debug_utils import debug_args
+from scripts.feature_cache import AudioAnalysis
+
+tempo_chunk_length = 4096 # BPMのマッチング度合いを一度に計算するサンプル数
+
+@dataclass
+class TempoEstimate:
+    bpm: float # 小数点以下まで絞り込んだBPM
+    integer_bpm: int # 整数BPM (整数のみで探索した場合の値)
+    confidence: float # 0-1。他のBPM候補に比べて突出しているほど大きい
+
+def get_tempo_scores(x, x_sr, bpms, chunk_length=tempo_chunk_length):
+    """
+    各BPMに対応する複素正弦波とビート検出用信号との内積の絶対値
+    信号をチャンクに分けて計算するので、メモリ使用量はlen(bpms) * chunk_lengthで抑えられる
+    """
+    bpms = np.asarray(bpms, dtype=np.float64)
+    x_bpm = np.zeros(len(bpms), dtype=np.complex128)
+    for start in range(0, len(x), chunk_length):
+        n = np.arange(start, min(start + chunk_length, len(x)))
+        thete = 2 * np.pi * (bpms[:, None] / 60) * (n[None, :] / x_sr)
+        x_bpm += np.dot(np.exp(-1j * thete), x[start:start + len(n)])
+    return np.abs(x_bpm)
+
+def _estimate_tempo(x, x_sr, bpm_min, bpm_max, resolution):
+    # 整数BPMで探索 (全て0の場合は0)
+    bpms = np.arange(bpm_min, bpm_max)
+    x_bpm = get_tempo_scores(x, x_sr, bpms)
+    if len(x_bpm) == 0 or x_bpm.max() <= 0:
+        return np.array([0.0, 0.0, 0.0])
+    integer_bpm = int(bpms[np.argmax(x_bpm)])
+
+    # 前後の範囲を1/10刻みで探索して、resolutionまで絞り込む
+    bpm = float(integer_bpm)
+    step = 1.0
+    while step > resolution:
+        step /= 10
+        candidates = bpm + np.arange(-10, 11) * step
+        bpm = float(candidates[np.argmax(get_tempo_scores(x, x_sr, candidates))])
+
+    # 信頼度: 最大値の近傍(±2BPM)以外で最も大きい候補との差
+    others = x_bpm[np.abs(bpms - integer_bpm) > 2]
+    confidence = 1.0 - float(others.max()) / float(x_bpm.max()) if len(others) > 0 else 1.0
+
+    return np.array([round(bpm, 6), integer_bpm, confidence])
 
 # https://www.wizard-notes.com/entry/music-analysis/compute-bpm
 @debug_args
-def compute_bpm(input_path):
-    outputs = ""
-    offset = 0.0
-    duration = None
-    x_sr = 200
-    bpm_min, bpm_max = 60, 240
+def estimate_tempo(input_path, bpm_min=60, bpm_max=240, resolution=0.01, x_sr=200):
+    analysis = AudioAnalysis(input_path)
 
-    # 楽曲の信号を読み込む
-    y, sr = librosa.load(input_path, offset=offset, duration=duration, mono=True)
+    def compute():
+        # 楽曲の信号を取得 (デコード済みのPCMから22050Hzに変換)
+        y = analysis.get_y(sr=22050)
 
-    # ビート検出用信号の生成
-    # リサンプリング & パワー信号の抽出
-    x = np.abs(librosa.resample(y=y, orig_sr=sr, target_sr=x_sr)) ** 2
-    x_len = len(x)
+        # ビート検出用信号の生成
+        # リサンプリング & パワー信号の抽出
+        x = np.abs(librosa.resample(y=y, orig_sr=22050, target_sr=x_sr)) ** 2
+        del y
 
-    # 各BPMに対応する複素正弦波行列を生成
-    M = np.zeros((bpm_max, x_len), dtype=np.complex128)
-    for bpm in range(bpm_min, bpm_max): 
-        thete = 2 * np.pi * (bpm/60) * (np.arange(0, x_len) / x_sr)
-        M[bpm] = np.exp(-1j * thete)
+        return _estimate_tempo(x, x_sr, bpm_min, bpm_max, resolution)
 
-    # 各BPMとのマッチング度合い計算
-    #（複素正弦波行列とビート検出用信号との内積）
-    x_bpm = np.abs(np.dot(M, x))
+    bpm, integer_bpm, confidence = analysis.load_or_compute(f"tempo_{bpm_min}_{bpm_max}_{resolution}_{x_sr}", compute).tolist()
 
-    # BPM　を算出
-    bpm = np.argmax(x_bpm)
+    print(f"BPM estimation is complete. {bpm:.2f} (confidence {confidence:.2f})")
 
-    print(f"BPM estimation is complete. {bpm}")
+    return TempoEstimate(bpm=bpm, integer_bpm=int(integer_bpm), confidence=confidence)
 
-    return int(bpm)
+@debug_args
+def compute_bpm(input_path):
+    return estimate_tempo(input_path).integer_bpm
+
+chorus_sr = 22050 # サビ検出用の信号のサンプリングレート
+chorus_n_fft = 2048
+chorus_hop_length = 1024
+chorus_block_frames = 2048 # 一度にFFTするフレーム数
+chorus_hop_duration = 16384 / 44100 # サビらしさを評価する間隔 (秒)
+chorus_window_durations = (65536 / 44100, 3.0, 6.0) # 特徴量を平均する窓の長さ (秒)。長さごとのサビらしさを平均する
+chorus_ignore_duration = 10 * chorus_hop_duration # 先頭と末尾の無視する長さ (秒)
+chorus_min_distance = 15.0 # 候補同士の最小間隔 (秒)
+
+@dataclass
+class ChorusCandidate:
+    time: float # 推定サビ時刻 (秒)
+    score: float # サビらしさ (RMS + スペクトル重心、各々[0.0, 1.0]に正規化)
+
+def get_chorus_frame_features(y, sr, n_fft=chorus_n_fft, hop_length=chorus_hop_length, block_frames=chorus_block_frames):
+    """
+    短いフレームごとの平均パワー、振幅スペクトルの合計、周波数で重み付けした振幅スペクトルの合計
+    フレームをブロックに分けてFFTするので、メモリ使用量は曲の長さによらない
+    """
+    y = np.pad(y, n_fft // 2)
+    frame_count = 1 + max(len(y) - n_fft, 0) // hop_length
+    window = librosa.filters.get_window("hann", n_fft, fftbins=True).astype(np.float32)
+    freqs = librosa.fft_frequencies(sr=sr, n_fft=n_fft)
+
+    features = np.zeros((3, frame_count), dtype=np.float64)
+    for start in range(0, frame_count, block_frames):
+        end = min(start + block_frames, frame_count)
+        frames = librosa.util.frame(y[start * hop_length:(end - 1) * hop_length + n_fft], frame_length=n_fft, hop_length=hop_length, axis=0)
+        S = np.abs(np.fft.rfft(frames * window, axis=1))
+        features[0, start:end] = np.mean(frames[:, n_fft // 2 - hop_length // 2:n_fft // 2 + hop_length // 2] ** 2, axis=1)
+        features[1, start:end] = S.sum(axis=1)
+        features[2, start:end] = S @ freqs
+    return features
+
+def _rolling_sum(x, window, indices):
+    # indicesを中心とするwindow個の合計 (範囲外は0)
+    cumsum = np.concatenate([[0.0], np.cumsum(x)])
+    starts = np.clip(indices - window // 2, 0, len(x))
+    ends = np.clip(starts + window, 0, len(x))
+    return cumsum[ends] - cumsum[starts]
 
 # https://www.wizard-notes.com/entry/music-analysis/highlight-detection-by-rms
 @debug_args
-def compute_chorus_time(
-        input_path,
-    ):
-
-    sr = 44100
-
-    # オーディオファイルを信号データとして読み込み
+def detect_chorus_candidates(input_path, top_n=5):
+    """
+    曲全体からサビらしい時刻の候補を、サビらしさの高い順に返す
+    短いフレームの特徴量から、長さの異なる窓(特徴量ピラミッド)でRMSとスペクトル重心を求めて平均する
+    """
+    analysis = AudioAnalysis(input_path)
+
+    # 短いフレームごとの特徴量 (デコード済みのPCMから作り、キャッシュする)
     # 今回はモノラル信号（中央定位成分）を利用
-    y, sr = librosa.load(input_path, sr=sr, mono=True, duration=120)
-
-    # 特徴量算出用のパラメタ
-    frame_length = 65536 # 特徴量を１つ算出するのに使うサンプル数
-    hop_length   = 16384 # 何サンプルずらして特徴量を算出するかを決める変数
-
-    # RMS：短時間ごとのエネルギーの大きさを算出
-    rms   = librosa.feature.rms(y=y, frame_length=frame_length, hop_length=hop_length)[0]
-    rms   /= np.max(rms) # [0.0. 1.0]に正規化
+    features = analysis.load_or_compute(
+        f"chorus_frames_{chorus_sr}_{chorus_n_fft}_{chorus_hop_length}",
+        lambda: get_chorus_frame_features(analysis.get_y(sr=chorus_sr), chorus_sr))
+    power, magnitude, weighted_magnitude = np.asarray(features)
+
+    # サビらしさを評価するフレーム
+    frame_time = chorus_hop_length / chorus_sr
+    times = np.arange(0, len(power) * frame_time, chorus_hop_duration)
+    indices = np.minimum(np.round(times / frame_time).astype(np.int64), len(power) - 1)
+
+    # 窓の長さごとにRMSとスペクトル重心を求め、[0.0, 1.0]に正規化して足す
+    scores = np.zeros(len(times), dtype=np.float64)
+    for window_duration in chorus_window_durations:
+        window = max(1, int(round(window_duration / frame_time)))
+        rms = np.sqrt(_rolling_sum(power, window, indices) / window)
+        sc = _rolling_sum(weighted_magnitude, window, indices) / np.maximum(_rolling_sum(magnitude, window, indices), 1e-10)
+        scores += rms / max(np.max(rms, initial=0), 1e-10) + sc / max(np.max(sc, initial=0), 1e-10)
+    scores /= len(chorus_window_durations)
+
+    # 先頭と末尾を除き、サビらしさの高い順に、近すぎる候補を除いて選ぶ
+    valid = (times >= chorus_ignore_duration) & (times <= times[-1] - chorus_ignore_duration)
+    if not np.any(valid):
+        valid = np.ones(len(times), dtype=bool)
+
+    candidates = []
+    for i in np.argsort(-scores[valid], kind="stable"):
+        time = float(np.floor(times[valid][i]))
+        if all(abs(time - candidate.time) >= chorus_min_distance for candidate in candidates):
+            candidates.append(ChorusCandidate(time=time, score=float(scores[valid][i])))
+        if len(candidates) >= top_n:
+            break
+
+    print(f"Chorus time estimation is complete. {[(candidate.time, round(candidate.score, 3)) for candidate in candidates]}")
+
+    return candidates
 
-    # スペクトル重心：短時間ごとの音色の煌びやかさを算出
-    sc    = librosa.feature.spectral_centroid(y=y, n_fft=frame_length, hop_length=hop_length)[0]
-    sc    /= np.max(sc) # [0.0. 1.0]に正規化
-
-    # 最大値探索で無視する,先頭と末尾のデータ数を指定
-    n_ignore = 10 
-
-    # サビらしさ特徴量時系列データ sc+rms より、
-    # 最もサビらしいインデックスを最大値探索で算出
-    # 念のため、2, 3番目に大きい値をとるインデックスも算出する
-    indices = np.argsort((sc+rms)[n_ignore:-n_ignore])[::-1] + n_ignore
-    # 最大値のみであれば、np.max((sc+rms)[n_ignore:-n_ignore]) でよい
-
-    # 特徴量時系列データのインデックスと時間（秒）の対応関係
-    # 今回は、rmsとscはhop_lengthが同じなので以下でよい
-    times = np.floor(librosa.times_like(sc, hop_length=hop_length, sr=sr))
-
-    # 推定サビ時刻（秒）を算出
-    chorus_estimated_time = times[indices[0]]
-
-    print(f"Chorus time estimation is complete. {chorus_estimated_time}")
-
-    return chorus_estimated_time
+@debug_args
+def compute_chorus_time(input_path):
+    candidates = detect_chorus_candidates(input_path, top_n=1)
+    return candidates[0].time if len(candidates) > 0 else 0.0
@@ -14,6 +14,14 @@ def force_copy_file(input_path, output_path):
     safe_remove_file(output_path)
     shutil.copyfile(input_path, output_path)
 
+def force_link_file(input_path, output_path):
+    # ハードリンクを作成する。できない場合(別ドライブなど)はコピー
+    safe_remove_file(output_path)
+    try:
+        os.link(input_path, output_path)
+    except OSError:
+        shutil.copyfile(input_path, output_path)
+
 # Keep a reference to the ctypes function pointer to avoid deallocation
 run_askdirectory_ctypes = None
 result_askdirectory_queue = queue.Queue()
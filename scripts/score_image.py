@@ -0,0 +1,189 @@
+import os
+import numpy as np
+from PIL import Image, ImageColor, ImageDraw, ImageFont
+
+lane_count = 11 # x軸のレーン数 (0, 11は空き)
+
+background_color = (0, 0, 0)
+frame_color = (255, 255, 255)
+grid_color = (128, 128, 128)
+text_color = (255, 255, 255)
+
+header_height = 60
+footer_height = 12
+margin_left = 12
+margin_right = 8
+
+def _load_font(size):
+    # 日本語タイトル用にjapanize_matplotlibのフォントを使う
+    try:
+        import japanize_matplotlib
+        font_path = os.path.join(os.path.dirname(japanize_matplotlib.__file__), "fonts", "ipaexg.ttf")
+        return ImageFont.truetype(font_path, size)
+    except (ImportError, OSError):
+        return ImageFont.load_default()
+
+def _draw_centered_text(draw: ImageDraw.ImageDraw, center_x, y, text, font):
+    left, _, right, _ = draw.textbbox((0, 0), text, font=font)
+    draw.text((center_x - (right - left) / 2, y), text, fill=text_color, font=font)
+
+def _get_cell_indices(pixel_count, cell_count, reverse=False):
+    # 各ピクセルが属するセル番号と、セルの境界ピクセルかどうかを取得
+    fractions = (np.arange(pixel_count) + 0.5) / pixel_count
+    if reverse:
+        fractions = 1 - fractions
+    indices = np.clip(np.floor(fractions * cell_count).astype(np.int64), 0, cell_count - 1)
+    edges = np.ones(pixel_count, dtype=bool)
+    edges[1:] = indices[1:] != indices[:-1]
+    return indices, edges
+
+def _render_tile(
+        slots,
+        lane_ids,
+        alphas,
+        lane_rgb,
+        column_start,
+        column_count,
+        rows_per_column,
+        measure_y_count,
+        image_width,
+        image_height):
+    plot_width = image_width - margin_left - margin_right
+    plot_height = image_height - header_height - footer_height
+
+    # セル(列, 行, レーン)ごとの色(アルファ乗算済み)と透明度を作成
+    cell_shape = (column_count, rows_per_column, lane_count)
+    cell_rgb = np.zeros((np.prod(cell_shape), 3), dtype=np.float32)
+    cell_alpha = np.zeros(np.prod(cell_shape), dtype=np.float32)
+
+    columns = slots // rows_per_column - column_start
+    indices = (columns >= 0) & (columns < column_count)
+    lanes = lane_ids[indices]
+    chip_alphas = alphas[indices]
+    cells = np.ravel_multi_index((columns[indices], slots[indices] % rows_per_column, lanes), cell_shape)
+
+    # 同じセルのチップ(HH/HHO, LP/LBDなど)は、描画順に重ねてアルファブレンドする
+    order = np.argsort(cells, kind="stable")
+    sorted_cells = cells[order]
+    group_starts = np.flatnonzero(np.r_[True, sorted_cells[1:] != sorted_cells[:-1]]) if len(cells) > 0 else np.zeros(0, dtype=np.int64)
+    layers = np.empty(len(cells), dtype=np.int64)
+    layers[order] = np.arange(len(cells)) - np.repeat(group_starts, np.diff(np.r_[group_starts, len(cells)]))
+    for layer in range(int(layers.max(initial=-1)) + 1):
+        chips = layers == layer
+        layer_cells, layer_alphas = cells[chips], chip_alphas[chips]
+        cell_rgb[layer_cells] = cell_rgb[layer_cells] * (1 - layer_alphas[:, None]) + lane_rgb[lanes[chips]] * layer_alphas[:, None]
+        cell_alpha[layer_cells] = cell_alpha[layer_cells] * (1 - layer_alphas) + layer_alphas
+    cell_rgb = cell_rgb.reshape(*cell_shape, 3)
+    cell_alpha = cell_alpha.reshape(cell_shape)
+
+    # ピクセルとセルの対応を作成 (時間は下から上)
+    row_of_y, edge_y = _get_cell_indices(plot_height, rows_per_column, reverse=True)
+    lane_of_x, edge_x = _get_cell_indices(plot_width, lane_count * 2)
+    lane_of_x = (lane_of_x + 1) // 2 # レーンは[lane_id - 0.5, lane_id + 0.5]の範囲
+    edge_x &= lane_of_x != np.roll(lane_of_x, 1)
+    lane_of_x = np.clip(lane_of_x, 0, lane_count - 1)
+
+    # セルをピクセルに展開して、背景(黒)にアルファブレンド。境界は白と混ぜた枠線
+    rgb = cell_rgb[:, row_of_y][:, :, lane_of_x]
+    alpha = cell_alpha[:, row_of_y][:, :, lane_of_x]
+    edges = edge_y[:, None] | edge_x[None, :]
+    rgb[:, edges] = (rgb[:, edges] + alpha[:, edges][..., None]) / 2
+    plot = (np.clip(rgb, 0, 1) * 255).astype(np.uint8)
+
+    canvas = np.zeros((image_height, column_count, image_width, 3), dtype=np.uint8)
+    canvas[:] = background_color
+    canvas[header_height:header_height + plot_height, :, margin_left:margin_left + plot_width] = plot.transpose(1, 0, 2, 3)
+
+    # 小節ごとのグリッド線(破線)
+    dashes = (np.arange(plot_width) // 3) % 2 == 0
+    grid_ys = header_height + np.round((1 - np.arange(measure_y_count + 1) / measure_y_count) * (plot_height - 1)).astype(np.int64)
+    canvas[grid_ys[:, None], :, margin_left + np.flatnonzero(dashes)[None, :]] = grid_color
+
+    # 枠線
+    canvas[header_height, :, margin_left:margin_left + plot_width] = frame_color
+    canvas[header_height + plot_height - 1, :, margin_left:margin_left + plot_width] = frame_color
+    canvas[header_height:header_height + plot_height, :, margin_left] = frame_color
+    canvas[header_height:header_height + plot_height, :, margin_left + plot_width - 1] = frame_color
+
+    return canvas.reshape(image_height, column_count * image_width, 3)
+
+#@debug_args
+def drum_notes_to_image(
+        slots,
+        lane_ids,
+        velocities,
+        lane_colors,
+        output_image_path,
+        total_duration,
+        bpm,
+        measure_y_count,
+        chip_resolution,
+        image_width,
+        image_height,
+        title,
+        max_columns=40):
+    """
+    ノーツをNumPyのバッファに直接描画して画像を保存する
+    slotsはchip_resolution単位のグリッド番号、列数がmax_columnsを超える場合は折り返して複数段で描画する
+    """
+
+    measure_time = 60 * 4 / float(bpm) # 1小節の時間
+    time_interval = measure_time * measure_y_count
+    rows_per_column = measure_y_count * chip_resolution
+
+    slots = np.asarray(slots, dtype=np.int64)
+    lane_ids = np.asarray(lane_ids, dtype=np.int64)
+    alphas = np.clip(np.asarray(velocities, dtype=np.float32) / 127, 0, 1)
+
+    # 色が設定されているレーンのみ描画
+    lane_rgb = np.zeros((lane_count, 3), dtype=np.float32)
+    lane_visible = np.zeros(lane_count, dtype=bool)
+    for lane_id, color in lane_colors.items():
+        if 0 <= lane_id < lane_count:
+            lane_rgb[lane_id] = np.array(ImageColor.getrgb(color)[:3]) / 255
+            lane_visible[lane_id] = True
+    indices = (lane_ids >= 0) & (lane_ids < lane_count) & (slots >= 0)
+    indices[indices] = lane_visible[lane_ids[indices]]
+    slots, lane_ids, alphas = slots[indices], lane_ids[indices], alphas[indices]
+
+    # Calculate the number of columns needed
+    num_columns = int(total_duration / time_interval) + 1
+    if len(slots) > 0:
+        num_columns = max(num_columns, int(slots.max()) // rows_per_column + 1)
+    tile_columns = min(num_columns, max_columns)
+    tile_count = (num_columns + tile_columns - 1) // tile_columns
+
+    image = Image.new("RGB", (tile_columns * image_width, tile_count * image_height), background_color)
+    draw = ImageDraw.Draw(image)
+    title_font = _load_font(14)
+    label_font = _load_font(12)
+
+    for tile_index in range(tile_count):
+        column_start = tile_index * tile_columns
+        column_count = min(tile_columns, num_columns - column_start)
+        tile = _render_tile(
+            slots,
+            lane_ids,
+            alphas,
+            lane_rgb,
+            column_start,
+            column_count,
+            rows_per_column,
+            measure_y_count,
+            image_width,
+            image_height)
+        tile_y = tile_index * image_height
+        image.paste(Image.fromarray(tile), (0, tile_y))
+
+        for i in range(column_count):
+            column_index = column_start + i
+            label = f"{column_index * measure_y_count + 1} - {(column_index + 1) * measure_y_count}"
+            center_x = i * image_width + margin_left + (image_width - margin_left - margin_right) / 2
+            _draw_centered_text(draw, center_x, tile_y + 36, label, label_font)
+
+    _draw_centered_text(draw, image.width / 2, 10, f"{title} / BPM {bpm}", title_font)
+
+    # Save plot as an image
+    image.save(output_image_path)
+
+    print(f"Generation of Notes image is complete. {output_image_path}")
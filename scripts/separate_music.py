@@ -1,54 +1,505 @@
-
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+import hashlib
 import os
-import platform
+import queue
 import shutil
-import subprocess as sp
+import threading
+import time
+import librosa
+import numpy as np
+import soundfile as sf
 
 from scripts.debug_utils import debug_args
-from scripts.platform_utils import force_copy_file
-from scripts.media_utils import get_tmp_dir, get_tmp_file_path
+from scripts.feature_cache import AudioAnalysis, CacheEntry, decode_block_frames
+from scripts.media_utils import encode_audio, encode_pcm
+from scripts.platform_utils import force_link_file, safe_remove_file
 
-@debug_args
-def separate_music(model, input_path, output_dir, jobs, drums_only):
-    # 全角文字が入ってるとコンバートに失敗するので作業ディレクトリに移動する
-    tmp_dir = get_tmp_dir()
-    tmp_input_path = get_tmp_file_path(os.path.splitext(input_path)[1])
-    force_copy_file(input_path, tmp_input_path)
-
-    if platform.system() == "Windows":
-        cmd = ["venv\Scripts\python", "-m", "demucs.separate", "-o", tmp_dir, "-n", model, "-j", str(jobs)]
+separation_stems = ["drums", "bass", "other", "vocals"]
+separation_params = {"shifts": 1, "split": True, "overlap": 0.25} # demucs.separateの既定値
+separation_cache_max_bytes = 20 * 1024 * 1024 * 1024 # 分離キャッシュ全体の上限
+separation_segment_duration = 60.0 # 区間ごとに分離する長さ (秒)
+separation_segment_overlap = 2.0 # 隣の区間とクロスフェードする長さ (秒)
+quantized_model_suffix = "_int8" # モデル名にこれを付けるとCPUでint8の動的量子化をしたモデルを使う
+
+draft_marker_name = ".separation_draft" # 仮分離したプロジェクトの目印
+draft_n_fft = 2048
+draft_hop_length = 512
+draft_mask_pool = 2 # マスクは周波数と時間をこの数ずつまとめたスペクトログラムで計算する
+draft_hpss_kernel_size = 15 # まとめたスペクトログラム上のメディアンフィルタの長さ (元の約30ビン, 30フレーム)
+draft_hpss_margin = 1.0 # librosa.decompose.hpssの既定値
+
+@dataclass
+class SeparationJob:
+    source: object # 音声ファイルのパス、または(PCM(channels, samples), sr)
+    stems: list # 返すステム名
+    progress: object = None # progress(割合, メッセージ)
+    work_dir: str = None # 区間ごとの分離結果の保存先。Noneの場合は全体を一度に分離する
+    future: Future = field(default_factory=Future)
+
+@dataclass
+class SeparationResult:
+    sources: dict # ステム名 -> PCM(channels, samples)
+    samplerate: int
+    real_time_factor: float = None # 分離にかかった時間 / 音声の長さ
+
+def parse_separation_model(model):
+    # (Demucsのモデル名, 量子化するか)
+    if model.endswith(quantized_model_suffix):
+        return model[:-len(quantized_model_suffix)], True
+    return model, False
+
+class SeparationSource:
+    """
+    分離する音声を区間ごとに読み込む。ファイルの場合は全体をメモリに読み込まない
+    """
+
+    def __init__(self, source):
+        self.file = None
+        self.y = None
+        if isinstance(source, (str, os.PathLike)):
+            try:
+                self.file = sf.SoundFile(source)
+                self.sr = self.file.samplerate
+                self.frames = self.file.frames
+                return
+            except sf.SoundFileRuntimeError:
+                y, sr = librosa.load(source, sr=None, mono=False)
+        else:
+            y, sr = source
+        self.y = np.atleast_2d(np.asarray(y, dtype=np.float32))
+        self.sr = sr
+        self.frames = self.y.shape[1]
+
+    def read(self, start, length):
+        # (channels, samples)
+        if self.file is None:
+            return self.y[:, start:start + length]
+        self.file.seek(start)
+        return self.file.read(length, dtype="float32", always_2d=True).T
+
+    def get_mono_stats(self, convert=None):
+        # demucs.separateの正規化に使うモノラル信号の平均と標準偏差
+        # convert(y, sr)を指定した場合は、モデルのサンプリングレートとチャンネル数に変換した信号で計算する
+        total = 0.0
+        total_sq = 0.0
+        frame_count = 0
+        for start in range(0, self.frames, decode_block_frames):
+            y = self.read(start, decode_block_frames)
+            if convert is not None:
+                y = np.asarray(convert(y, self.sr))
+            y = y.mean(axis=0, dtype=np.float64)
+            total += y.sum()
+            total_sq += np.dot(y, y)
+            frame_count += len(y)
+        mean = total / max(frame_count, 1)
+        std = np.sqrt(max(total_sq - total * mean, 0.0) / max(frame_count - 1, 1))
+        return mean, std
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+class SeparationService:
+    """
+    Demucsのモデルを1回だけ読み込んで、キューで受け取った音声を順番に分離する常駐ワーカー
+    Gradioのクリックやバッチ処理の曲ごとにPythonの起動、torchのインポート、モデルの読み込みをしない
+    """
+
+    _instance = None # Singleton instance
+    _instance_lock = threading.Lock()
+
+    @classmethod
+    def instance(cls, model, jobs):
+        # モデルかジョブ数が変わった場合は作り直す
+        with cls._instance_lock:
+            if cls._instance is not None and cls._instance.pid != os.getpid():
+                # fork先ではワーカースレッドが動いていないので使わない
+                cls._instance = None
+            if cls._instance is not None and (cls._instance.model_name, cls._instance.jobs) != (model, jobs):
+                cls._instance.close()
+                cls._instance = None
+            if cls._instance is None:
+                cls._instance = cls(model, jobs)
+            return cls._instance
+
+    def __init__(self, model, jobs, device=None):
+        self.pid = os.getpid()
+        self.model_name = model
+        self.demucs_model_name, self.quantized = parse_separation_model(model)
+        self.jobs = jobs
+        self.device = device
+        self.model = None
+        self.saved_num_threads = None # 量子化したモデルで変更する前のtorchのスレッド数
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name=f"separation-{model}", daemon=True)
+        self.thread.start()
+
+    def submit(self, source, stems=None, progress=None, work_dir=None) -> Future:
+        job = SeparationJob(source=source, stems=list(stems or separation_stems), progress=progress, work_dir=work_dir)
+        self.queue.put(job)
+        return job.future
+
+    def separate(self, source, stems=None, progress=None, work_dir=None) -> SeparationResult:
+        return self.submit(source, stems, progress, work_dir).result()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+        # torchのスレッド数はプロセス全体の設定なので、他のモデルや解析のために元に戻す
+        if self.saved_num_threads is not None:
+            import torch
+            torch.set_num_threads(self.saved_num_threads)
+            self.saved_num_threads = None
+
+    @classmethod
+    def _reset_after_fork(cls):
+        # fork時に親のロックが取得中だった場合に備えて、ロックも作り直す
+        cls._instance = None
+        cls._instance_lock = threading.Lock()
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            if not job.future.set_running_or_notify_cancel():
+                continue
+            try:
+                job.future.set_result(self._separate(job))
+            except BaseException as e:
+                job.future.set_exception(e)
+            job = None # 結果(メモリマップ)への参照を残さない
+
+    def _report(self, job: SeparationJob, fraction, message):
+        print(f"{message} ({fraction * 100:.0f}%)")
+        if job.progress is not None:
+            job.progress(fraction, message)
+
+    def _load_model(self):
+        import torch
+        from demucs.pretrained import get_model
+
+        model = get_model(self.demucs_model_name)
+        model.cpu()
+        model.eval()
+
+        if self.quantized:
+            # LinearとLSTMの重みをint8にする。量子化したモデルはCPUでのみ動き、jobsはスレッド数に使う
+            self.device = "cpu"
+            if self.jobs > 0:
+                self.saved_num_threads = torch.get_num_threads()
+                torch.set_num_threads(self.jobs)
+            model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear, torch.nn.LSTM}, dtype=torch.qint8)
+
+        if self.device is None:
+            self.device = "cuda" if torch.cuda.is_available() else "cpu"
+
+        return model
+
+    def _convert_audio(self, y, sr):
+        import torch
+        from demucs.audio import convert_audio
+
+        return convert_audio(torch.from_numpy(np.ascontiguousarray(y)), sr, self.model.samplerate, self.model.audio_channels)
+
+    def _apply_model(self, wav, ref_mean, ref_std):
+        import torch
+        from demucs.apply import apply_model
+
+        # demucs.separateと同じ正規化
+        wav = (wav - ref_mean) / ref_std
+        with torch.no_grad():
+            num_workers = 0 if self.quantized else self.jobs
+            sources = apply_model(self.model, wav[None], device=self.device, progress=False, num_workers=num_workers, **separation_params)[0]
+        return (sources * ref_std + ref_mean).cpu().numpy()
+
+    def _separate(self, job: SeparationJob):
+        if self.model is None:
+            self._report(job, 0.0, f"Load separation model. {self.model_name}")
+            self.model = self._load_model()
+
+        unknown_stems = [stem for stem in job.stems if stem not in self.model.sources]
+        if len(unknown_stems) > 0:
+            raise Exception(f"モデルにないステムです。 {unknown_stems} {self.model.sources}")
+
+        source = SeparationSource(job.source)
+        start_time = time.perf_counter()
+        try:
+            if job.work_dir is None:
+                result = self._separate_whole(job, source)
+            else:
+                result = self._separate_segments(job, source)
+        finally:
+            source.close()
+
+        # 実時間比 (1未満なら音声の長さより速く分離できている)
+        elapsed_time = time.perf_counter() - start_time
+        duration = source.frames / source.sr
+        result.real_time_factor = elapsed_time / duration if duration > 0 else 0.0
+        self._report(job, 1.0, f"Music separation is complete. {self.model_name} RTF: {result.real_time_factor:.3f} ({elapsed_time:.1f}s / {duration:.1f}s)")
+        return result
+
+    def _separate_whole(self, job: SeparationJob, source: SeparationSource):
+        self._report(job, 0.1, "Load audio.")
+        wav = self._convert_audio(source.read(0, source.frames), source.sr)
+
+        self._report(job, 0.2, f"Separate music. {self.model_name}")
+        ref = wav.mean(0)
+        sources = self._apply_model(wav, ref.mean(), ref.std())
+        return SeparationResult(
+            sources={stem: sources[self.model.sources.index(stem)] for stem in job.stems},
+            samplerate=self.model.samplerate)
+
+    def _separate_segments(self, job: SeparationJob, source: SeparationSource):
+        """
+        重なりのある固定長の区間ごとに分離して、重なった部分をクロスフェードで繋げる
+        分離した区間はwork_dirに保存するので、中断しても次回は続きの区間から分離する
+        ステムはwork_dirのメモリマップに書き込むので、長い音声でもメモリ使用量は区間の長さで決まる
+        """
+        os.makedirs(job.work_dir, exist_ok=True)
+        samplerate = self.model.samplerate
+        segment_length = int(separation_segment_duration * source.sr)
+        overlap_length = int(separation_segment_overlap * source.sr)
+        hop_length = segment_length - overlap_length
+        segment_count = max(1, -(-max(source.frames - overlap_length, 1) // hop_length))
+        output_frames = source.frames * samplerate // source.sr
+
+        self._report(job, 0.1, "Load audio.")
+        ref_mean, ref_std = source.get_mono_stats(self._convert_audio)
+
+        outputs = {}
+        for stem in job.stems:
+            outputs[stem] = np.lib.format.open_memmap(
+                os.path.join(job.work_dir, f"{stem}.npy"), mode="w+", dtype=np.float32, shape=(self.model.audio_channels, output_frames))
+
+        for i in range(segment_count):
+            start = i * hop_length
+            segment_path = os.path.join(job.work_dir, f"segment_{i:05d}.npy")
+            if os.path.exists(segment_path):
+                sources = np.load(segment_path)
+                message = f"Load separated segment. {i + 1}/{segment_count}"
+            else:
+                wav = self._convert_audio(source.read(start, segment_length), source.sr)
+                sources = self._apply_model(wav, ref_mean, ref_std).astype(np.float32)
+                tmp_path = f"{segment_path}.{os.getpid()}.tmp"
+                with open(tmp_path, "wb") as f:
+                    np.save(f, sources)
+                os.replace(tmp_path, segment_path)
+                message = f"Separate segment. {i + 1}/{segment_count}"
+
+            # 前の区間と重なった部分はクロスフェード、それ以外はそのまま書き込む
+            output_start = start * samplerate // source.sr
+            output_end = min(output_start + sources.shape[-1], output_frames)
+            fade_length = min(overlap_length * samplerate // source.sr, output_end - output_start) if i > 0 else 0
+            fade_in = (np.arange(fade_length, dtype=np.float32) + 0.5) / max(fade_length, 1)
+            for stem, output in outputs.items():
+                segment = sources[self.model.sources.index(stem), :, :output_end - output_start]
+                fade_end = output_start + fade_length
+                output[:, output_start:fade_end] = output[:, output_start:fade_end] * (1 - fade_in) + segment[:, :fade_length] * fade_in
+                output[:, fade_end:output_end] = segment[:, fade_length:]
+
+            self._report(job, 0.1 + 0.9 * (i + 1) / segment_count, message)
+
+        for output in outputs.values():
+            output.flush()
+        return SeparationResult(sources=outputs, samplerate=samplerate)
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=SeparationService._reset_after_fork)
+
+def get_stem_scale(wav):
+    # demucs.separateの既定(clip="rescale")と同じく、クリップしないように音量を下げる
+    peak = 0.0
+    for start in range(0, wav.shape[1], decode_block_frames):
+        peak = max(peak, float(np.abs(wav[:, start:start + decode_block_frames]).max()))
+    return np.float32(1 / max(1.01 * peak, 1))
+
+def save_stem(wav, output_path, samplerate, scale=None):
+    # demucs.separateの既定と同じ16bit WAV
+    # メモリマップのステムも全体をメモリに読み込まないように、ブロックごとに書き込む
+    wav = np.asarray(wav)
+    if scale is None:
+        scale = get_stem_scale(wav)
+
+    with sf.SoundFile(output_path, "w", samplerate=samplerate, channels=len(wav), subtype="PCM_16", format="WAV") as f:
+        for start in range(0, wav.shape[1], decode_block_frames):
+            block = wav[:, start:start + decode_block_frames] * scale * 2**15
+            f.write(np.clip(block, -2**15, 2**15 - 1).astype(np.int16).T)
+
+def export_stem(wav, output_path, samplerate, bitrate=None):
+    # WAVはそのまま書き込み、それ以外の形式はメモリ上のステムから直接エンコードする
+    # 書き込んだ音量の倍率を返す
+    wav = np.asarray(wav)
+    scale = get_stem_scale(wav)
+    if os.path.splitext(output_path)[1].lower() == ".wav":
+        save_stem(wav, output_path, samplerate, scale)
     else:
-        cmd = ["python3", "-m", "demucs.separate", "-o", tmp_dir, "-n", model, "-j", str(jobs)]
-    cmd.append(tmp_input_path)
-    print(" ".join(cmd))
+        encode_pcm(wav, samplerate, output_path, bitrate, gain=scale)
+    return scale
+
+def get_pcm_hash(input_path):
+    """
+    デコードしたPCM(全チャンネル)とサンプリングレートのハッシュ。ファイルごとにプロジェクトの解析キャッシュに保存する
+    """
+    def compute():
+        pcm_hash = hashlib.sha1()
+        try:
+            with sf.SoundFile(input_path) as f:
+                pcm_hash.update(f"{f.samplerate},{f.channels}".encode())
+                for block in f.blocks(blocksize=decode_block_frames, dtype="float32", always_2d=True):
+                    pcm_hash.update(np.ascontiguousarray(block).tobytes())
+        except sf.SoundFileRuntimeError:
+            y, sr = librosa.load(input_path, sr=None, mono=False)
+            y = np.atleast_2d(y)
+            pcm_hash.update(f"{sr},{len(y)}".encode())
+            pcm_hash.update(np.ascontiguousarray(y.T).tobytes())
+        return np.array(pcm_hash.hexdigest())
+
+    return str(AudioAnalysis(input_path).load_or_compute("pcm_hash", compute))
+
+class SeparationCache(CacheEntry):
+    """
+    分離結果のステムをWorkspaceで共有するキャッシュ
+    キーは入力のPCMのハッシュ、モデル名、分離パラメータ。同じ動画を使う別のプロジェクトでも再利用する
+    """
+
+    max_bytes = separation_cache_max_bytes
+
+    def __init__(self, input_path, model, cache_dir):
+        key = {
+            "pcm_hash": get_pcm_hash(input_path),
+            "model": model,
+            "segment_duration": separation_segment_duration,
+            "segment_overlap": separation_segment_overlap,
+            **separation_params
+        }
+        super().__init__(cache_dir, key, {"input_path": input_path})
+
+    def get_stem_path(self, stem):
+        return os.path.join(self.entry_dir, f"{stem}.wav")
+
+    def get_work_dir(self):
+        # 分離途中の区間。ステムを保存したら削除する
+        return os.path.join(self.entry_dir, "segments")
+
+    def remove_work_dir(self):
+        shutil.rmtree(self.get_work_dir(), ignore_errors=True)
 
-    p = sp.run(cmd, capture_output=True, text=True)
+    def has(self, stems):
+        return os.path.exists(os.path.join(self.entry_dir, "meta.json")) and all(os.path.exists(self.get_stem_path(stem)) for stem in stems)
 
-    if p.returncode != 0:
-        raise Exception(f'{p.stderr}\n{p.stdout}\n{" ".join(cmd)}\n')
+    def save(self, result: SeparationResult):
+        os.makedirs(self.entry_dir, exist_ok=True)
+        for stem, wav in result.sources.items():
+            tmp_path = f"{self.get_stem_path(stem)}.{os.getpid()}.tmp.wav"
+            save_stem(wav, tmp_path, result.samplerate)
+            os.replace(tmp_path, self.get_stem_path(stem))
 
-    # 出力先に移動
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+        # meta.jsonは全てのステムを書き込んでから作る
+        self._touch()
+        self._evict()
 
-    if drums_only:
-        files = ["drums.wav"]
+    def export(self, output_paths, bitrate=None):
+        # WAVはキャッシュのステムをハードリンクし、それ以外の形式はキャッシュのステムを直接エンコードする
+        self._touch()
+        for stem, output_path in output_paths.items():
+            if os.path.splitext(output_path)[1].lower() == ".wav":
+                force_link_file(self.get_stem_path(stem), output_path)
+            else:
+                encode_audio(self.get_stem_path(stem), output_path, bitrate)
+        return list(output_paths.values())
+
+@debug_args
+def separate_music(model, input_path, output_paths, jobs, progress=None, cache_dir=None, bitrate=None, analyze=False):
+    """
+    output_pathsはステム名 -> 出力パス。拡張子で出力形式を決める
+    ステムは一度だけ書き込み、WAV以外の形式には中間ファイルを作らずにエンコードする
+    analyzeがTrueの場合は、出力ファイルの解析キャッシュにエンコード前のステムのPCMを保存する
+    """
+    for output_path in output_paths.values():
+        os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+
+    stems = list(output_paths.keys())
+
+    # 同じ音声とモデルの分離結果があればそれを使う
+    cache = SeparationCache(input_path, model, cache_dir) if cache_dir is not None else None
+    if cache is not None and cache.has(stems):
+        output_files = cache.export(output_paths, bitrate)
+        if analyze:
+            for stem, output_path in output_paths.items():
+                AudioAnalysis(output_path).set_native_source(cache.get_stem_path(stem))
+        print(f"Music separation is complete (cached). {output_files}")
+        return output_files
+
+    # 常駐ワーカーで分離する。キャッシュする場合は全てのステムを保存し、区間ごとに分離して途中から再開できるようにする
+    service = SeparationService.instance(model, jobs)
+    if cache is not None:
+        result = service.separate(input_path, separation_stems, progress, work_dir=cache.get_work_dir())
+        cache.save(result)
     else:
-        files = ["drums.wav", "bass.wav", "other.wav", "vocals.wav"]
+        result = service.separate(input_path, stems, progress)
 
     output_files = []
-    for file in files:
-        basename_without_ext = os.path.splitext(os.path.basename(tmp_input_path))[0]
-        tmp_output_path = os.path.join(tmp_dir, model, basename_without_ext, file)
-        output_path = os.path.join(output_dir, file)
-        force_copy_file(tmp_output_path, output_path)
+    for stem, output_path in output_paths.items():
+        scale = export_stem(result.sources[stem], output_path, result.samplerate, bitrate)
+        if analyze:
+            AudioAnalysis(output_path).set_native_pcm(result.sources[stem], result.samplerate, scale)
         output_files.append(output_path)
 
-    # 一時ファイルの削除
-    os.remove(tmp_input_path)
-    shutil.rmtree(os.path.join(tmp_dir, model, basename_without_ext))
+    del result
+    if cache is not None:
+        cache.remove_work_dir()
 
-    print(p.stdout)
-    print(f"Music separation is complete. {output_dir}")
+    print(f"Music separation is complete. {output_files}")
 
     return output_files
+
+def get_draft_marker_path(project_path):
+    return os.path.join(project_path, draft_marker_name)
+
+def is_draft_separation(project_path):
+    return os.path.exists(get_draft_marker_path(project_path))
+
+def mark_draft_separation(project_path, is_draft):
+    # 仮分離のプロジェクトはバッチ処理でDemucsで分離し直す
+    marker_path = get_draft_marker_path(project_path)
+    if is_draft:
+        with open(marker_path, "w") as f:
+            f.write("hpss\n")
+    else:
+        safe_remove_file(marker_path)
+
+@debug_args
+def separate_drums_draft(input_path, output_path, bitrate=None):
+    """
+    Demucsのかわりに、メディアンフィルタのHPSSで打楽器成分を取り出してドラム音を仮分離する
+    STFTは解析キャッシュに保存するので、同じ音声では再計算しない
+    """
+    analysis = AudioAnalysis(input_path)
+    y, sr = analysis.get_native_y()
+
+    def compute_stft():
+        return librosa.stft(np.asarray(y), n_fft=draft_n_fft, hop_length=draft_hop_length).astype(np.complex64)
+
+    S = np.asarray(analysis.load_or_compute(f"stft_{draft_n_fft}_{draft_hop_length}", compute_stft))
+
+    # メディアンフィルタが一番重いので、まとめたスペクトログラムでマスクを作って元の大きさに戻す
+    pool = draft_mask_pool
+    M = np.abs(S)
+    M = np.pad(M, ((0, -M.shape[0] % pool), (0, -M.shape[1] % pool)), mode="edge")
+    M = M.reshape(M.shape[0] // pool, pool, M.shape[1] // pool, pool).mean(axis=(1, 3))
+    mask = librosa.decompose.hpss(M, kernel_size=draft_hpss_kernel_size, margin=draft_hpss_margin, mask=True)[1]
+    mask = np.repeat(np.repeat(mask, pool, axis=0), pool, axis=1)[:S.shape[0], :S.shape[1]]
+    y_percussive = librosa.istft(S * mask, n_fft=draft_n_fft, hop_length=draft_hop_length, length=len(y))
+
+    wav = y_percussive[None].astype(np.float32)
+    scale = export_stem(wav, output_path, sr, bitrate)
+
+    # 後の解析はエンコード前の信号を使う
+    AudioAnalysis(output_path).set_native_pcm(wav, sr, scale)
+
+    print(f"Draft music separation is complete. {output_path}")
+
+    return output_path
@@ -0,0 +1,164 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import pretty_midi
+
+from scripts.convert_to_midi import DrumNotes, OnsetIndex, adjust_offset, detect_drum_notes, get_note_runs
+from scripts.midi_utils import MidiNotes, load_midi_notes, write_midi
+
+class TestGetNoteRuns(unittest.TestCase):
+
+    def test_get_note_runs(self):
+        mask = np.array([
+            [True, True, False, True],
+            [False, True, True, True],
+        ])
+        values = np.array([
+            [1.0, 3.0, 9.0, 2.0],
+            [9.0, 4.0, 6.0, 5.0],
+        ])
+
+        runs = list(zip(*[x.tolist() for x in get_note_runs(mask, values)]))
+        frames = list(zip(*[x.tolist() for x in get_note_runs(mask, values, merge_runs=False)]))
+
+        self.assertEqual(runs, [(0, 0, 2, 3.0), (1, 1, 3, 6.0), (0, 3, 1, 2.0)])
+        self.assertEqual(frames, [(0, 0, 1, 1.0), (0, 1, 1, 3.0), (1, 1, 1, 4.0), (1, 2, 1, 6.0), (0, 3, 1, 2.0), (1, 3, 1, 5.0)])
+
+    def test_get_note_runs_at_edges(self):
+        # 先頭と末尾のフレームで始まる/終わる区間と、空の行
+        mask = np.array([
+            [True, True, False, False, True],
+            [False, False, False, False, False],
+            [True, False, True, True, True],
+        ])
+        values = np.arange(15, dtype=np.float64).reshape(3, 5)
+
+        runs = list(zip(*[x.tolist() for x in get_note_runs(mask, values)]))
+
+        self.assertEqual(runs, [(0, 0, 2, 1.0), (2, 0, 1, 10.0), (2, 2, 3, 14.0), (0, 4, 1, 4.0)])
+        self.assertEqual(len(get_note_runs(np.zeros((3, 5), dtype=bool), values)[0]), 0)
+
+class TestDetectDrumNotes(unittest.TestCase):
+
+    def test_detect_drum_notes(self):
+        powers = np.array([
+            [0.0, 0.5, 1.0, 0.8, 0.2, 0.0, 0.3, 0.1],
+            [0.0, 0.0, 0.4, 0.4, 0.6, 0.1, 0.0, 0.0],
+        ])
+
+        notes = list(zip(*[values.tolist() for values in detect_drum_notes(powers, 0.5)]))
+
+        self.assertEqual(notes, [(0, 1, 2, 1.0), (1, 2, 4, 0.6), (0, 6, 6, 0.3)])
+
+    def test_detect_drum_notes_segmentation(self):
+        powers = np.array([[0.0, 2.0, 2.0, 1.0, 3.0, 0.0]])
+
+        def detect(segmentation):
+            return list(zip(*[values.tolist() for values in detect_drum_notes(powers, segmentation)]))
+
+        # 同じ値が続くフレームは立ち上がりでも立ち下がりでもない
+        self.assertEqual(detect(0.5), [(0, 1, 4, 3.0)])
+        # 0の場合はリリースしない
+        self.assertEqual(detect(0.0), [])
+        # 1より大きい場合は同じ値でもリリース
+        self.assertEqual(detect(1.2), [(0, 1, 1, 2.0), (0, 4, 4, 3.0)])
+
+class TestOnsetIndex(unittest.TestCase):
+
+    def test_nearest(self):
+        onset_index = OnsetIndex([10, 4, 20, 10])
+
+        onsets, found = onset_index.nearest([7, 12, 0, 30, 15], -5, 5)
+
+        self.assertEqual(found.tolist(), [True, True, True, False, True])
+        # 同じ距離の場合は前のonsetを優先
+        self.assertEqual(onsets[found].tolist(), [4, 10, 4, 10])
+
+    def test_nearest_with_offset_range(self):
+        onset_index = OnsetIndex([3, 8, 12])
+
+        # t + [0, 4)
+        onsets, found = onset_index.nearest([5, 10, 0], 0, 4)
+        self.assertEqual(onsets.tolist(), [8, 12, 3])
+        self.assertEqual(found.tolist(), [True, True, True])
+
+        # t + [-6, -1)
+        onsets, found = onset_index.nearest([5, 10], -6, -1)
+        self.assertEqual(onsets.tolist(), [3, 8])
+        self.assertEqual(found.tolist(), [True, True])
+
+        _, found = OnsetIndex([]).nearest([5], -5, 5)
+        self.assertEqual(found.tolist(), [False])
+
+class TestAdjustOffset(unittest.TestCase):
+
+    def test_adjust_offset(self):
+        frame_time = 0.5
+        notes = DrumNotes.from_frames([36, 36, 38, 42], [10, 20, 40, 60], np.ones(4), frame_time)
+
+        adjust_offset(notes, OnsetIndex([12, 23, 39]), frame_time, 2, -5, 5)
+
+        # 36: 1回目は平均2.5を切り捨てて+2、2回目は平均0.5、38: -1、42: 範囲内にonsetがないのでそのまま
+        self.assertEqual(notes.start_frame.tolist(), [12, 22, 39, 60])
+        np.testing.assert_allclose(notes.start, [6.25, 11.25, 19.5, 30.0])
+        np.testing.assert_allclose(notes.end, [6.75, 11.75, 20.0, 30.5])
+
+class TestDrumNotes(unittest.TestCase):
+
+    def test_instrument_round_trip(self):
+        notes = DrumNotes.from_frames([36, 38, 42], [4, 0, 9], np.array([100, 80, 60]), 0.01, frame_count=2)
+
+        track = notes.to_instrument()
+        restored = DrumNotes.from_instrument(track, 0.01)
+
+        self.assertTrue(track.is_drum)
+        self.assertEqual([(note.pitch, note.velocity) for note in track.notes], [(36, 100), (38, 80), (42, 60)])
+        self.assertEqual(restored.pitch.tolist(), [36, 38, 42])
+        self.assertEqual(restored.start_frame.tolist(), [4, 0, 9])
+        np.testing.assert_allclose(restored.start, [0.04, 0.0, 0.09])
+        np.testing.assert_allclose(restored.end, [0.06, 0.02, 0.11])
+        self.assertEqual(restored.velocity.tolist(), [100, 80, 60])
+
+    def test_select_and_concatenate(self):
+        notes = DrumNotes.from_frames(36, [0, 1, 2], np.array([1.0, 2.0, 3.0]), 0.5)
+        hh_notes = DrumNotes.from_frames(42, [5], np.array([4.0]), 0.5)
+
+        notes = notes.select(notes.velocity > 1.0).concatenate(hh_notes)
+
+        self.assertEqual(len(notes), 3)
+        self.assertEqual(notes.pitch.tolist(), [36, 36, 42])
+        self.assertEqual(notes.start_frame.tolist(), [1, 2, 5])
+        self.assertEqual(notes.start.tolist(), [0.5, 1.0, 2.5])
+        self.assertEqual(notes.velocity.tolist(), [2.0, 3.0, 4.0])
+
+    def test_round_trip_midi_matches_pretty_midi(self):
+        # .notes.npzはround_trip_midiのノーツから作るので、pretty_midiで読み込んだMIDIファイルと一致することを確認する
+        rng = np.random.default_rng(0)
+        frame_time = 0.0116
+
+        # 同じピッチで重なるノーツ、音量0と127のノーツ、長さ0のノーツ、同じtickに丸められるノーツも含める
+        notes = DrumNotes.from_frames(rng.choice([36, 38, 42], 300), rng.integers(0, 1000, 300), rng.integers(0, 128, 300), frame_time, frame_count=rng.integers(0, 20, 300))
+        notes = notes.concatenate(DrumNotes(
+            pitch=np.array([36, 36, 38, 38, 42, 42]),
+            start_frame=np.zeros(6, dtype=np.int64),
+            start=np.array([0.0, 0.0, 1.0, 1.0001, 2.0, 2.0]),
+            end=np.array([0.1, 0.1, 1.1, 1.1001, 2.0, 2.2]),
+            velocity=np.array([127, 127, 0, 127, 1, 127])))
+
+        for bpm, resolution in [(97, 8), (120, 4), (133, 16), (180, 1), (61, 32)]:
+            midi_data = pretty_midi.PrettyMIDI(resolution=bpm * resolution, initial_tempo=bpm)
+            midi_data.instruments.append(notes.to_instrument())
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                midi_path = os.path.join(tmp_dir, "drums.mid")
+                write_midi(midi_data, midi_path, notes.round_trip_midi(bpm * resolution, bpm))
+                sidecar_notes = load_midi_notes(midi_path)
+                expected = MidiNotes.from_pretty_midi(pretty_midi.PrettyMIDI(midi_path))
+
+            message = f"bpm: {bpm} resolution: {resolution}"
+            self.assertEqual(sidecar_notes.pitch.tolist(), expected.pitch.tolist(), message)
+            self.assertEqual(sidecar_notes.velocity.tolist(), expected.velocity.tolist(), message)
+            np.testing.assert_allclose(sidecar_notes.start, expected.start, err_msg=message)
+            np.testing.assert_allclose(sidecar_notes.end, expected.end, err_msg=message)
+            self.assertAlmostEqual(sidecar_notes.end_time, expected.end_time, msg=message)
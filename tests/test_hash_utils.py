@@ -0,0 +1,27 @@
+import os
+import tempfile
+import unittest
+
+from scripts.hash_utils import get_cached_file_hash, get_file_hash
+
+class TestGetCachedFileHash(unittest.TestCase):
+
+    def test_get_cached_file_hash(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "drums.wav")
+            with open(path, "wb") as f:
+                f.write(b"abcd")
+            file_hash = get_cached_file_hash(path)
+            self.assertEqual(file_hash, get_file_hash(path))
+
+            # 更新日時とサイズが同じ場合は読み直さない
+            stat = os.stat(path)
+            with open(path, "wb") as f:
+                f.write(b"efgh")
+            os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+            self.assertEqual(get_cached_file_hash(path), file_hash)
+
+            # 更新日時が変わった場合は計算し直す
+            os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+            self.assertEqual(get_cached_file_hash(path), get_file_hash(path))
+            self.assertNotEqual(get_cached_file_hash(path), file_hash)
@@ -0,0 +1,51 @@
+import unittest
+
+import numpy as np
+
+from scripts.midi_to_dtx import calculate_timings, quantize_times, to_base36_pairs
+
+class TestQuantizeTimes(unittest.TestCase):
+
+    def test_quantize_times(self):
+        measure_time = 2.0
+        resolution = 4
+        timings = calculate_timings(2, measure_time, resolution)
+
+        test_cases = [
+            (0.0, 0),
+            (0.49, 0),
+            (0.5, 1),
+            (2.0, 4),
+            (3.99, 7),
+            (4.0, -1),
+            (-0.01, -1),
+        ]
+
+        times = np.array([time for time, _ in test_cases])
+        slots = quantize_times(times, timings)
+
+        for slot, (time, result) in zip(slots, test_cases):
+            self.assertEqual(slot, result, f"time: {time}")
+
+    def test_quantize_times_matches_grid_scan(self):
+        measure_time = 60 * 4 / 97.0
+        resolution = 32
+        timings = calculate_timings(10, measure_time, resolution)
+        times = np.random.default_rng(0).uniform(-1, measure_time * 11, 1000)
+
+        slots = quantize_times(times, timings)
+
+        for slot, time in zip(slots, times):
+            expected = -1
+            for i in range(10 * resolution):
+                if time >= measure_time / resolution * i and time < measure_time / resolution * (i + 1):
+                    expected = i
+            self.assertEqual(slot, expected)
+
+class TestToBase36Pairs(unittest.TestCase):
+
+    def test_to_base36_pairs(self):
+        self.assertEqual(to_base36_pairs([0, 10, 36, 1295]).tolist(), ["00", "0A", "10", "ZZ"])
+        # 表の範囲外
+        self.assertEqual(to_base36_pairs([2, 1296, 46655]).tolist(), ["02", "100", "ZZZ"])
+        self.assertEqual(to_base36_pairs(np.zeros(0, dtype=np.int64)).tolist(), [])
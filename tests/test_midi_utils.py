@@ -0,0 +1,76 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import pretty_midi
+
+from scripts.midi_utils import MidiNotes, get_notes_sidecar_path, load_midi_notes, save_notes_sidecar, write_midi
+
+def create_midi(pitches):
+    midi_data = pretty_midi.PrettyMIDI()
+    track = pretty_midi.Instrument(program=0, is_drum=True)
+    for i, pitch in enumerate(pitches):
+        track.notes.append(pretty_midi.Note(velocity=100, pitch=pitch, start=i * 0.5, end=i * 0.5 + 0.1))
+    midi_data.instruments.append(track)
+    return midi_data
+
+class TestLoadMidiNotes(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.midi_path = os.path.join(self.tmp_dir.name, "drums.mid")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def save_marked_sidecar(self):
+        # MIDIファイルと区別できるノーツを保存する
+        notes = MidiNotes(np.array([99]), np.array([0.0]), np.array([1.0]), np.array([1]), 1.0)
+        save_notes_sidecar(self.midi_path, notes, notes.end_time)
+
+    def test_create_sidecar(self):
+        write_midi(create_midi([36, 38]), self.midi_path)
+        self.assertFalse(os.path.exists(get_notes_sidecar_path(self.midi_path)))
+
+        notes = load_midi_notes(self.midi_path)
+
+        self.assertTrue(os.path.exists(get_notes_sidecar_path(self.midi_path)))
+        self.assertEqual(notes.pitch.tolist(), [36, 38])
+        self.assertEqual(load_midi_notes(self.midi_path).pitch.tolist(), [36, 38])
+
+    def test_use_valid_sidecar(self):
+        write_midi(create_midi([36, 38]), self.midi_path)
+        self.save_marked_sidecar()
+
+        self.assertEqual(load_midi_notes(self.midi_path).pitch.tolist(), [99])
+
+    def test_use_sidecar_with_same_hash(self):
+        write_midi(create_midi([36, 38]), self.midi_path)
+        self.save_marked_sidecar()
+
+        # 更新日時だけ変わった場合はハッシュで検証する
+        stat = os.stat(self.midi_path)
+        os.utime(self.midi_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+        self.assertEqual(load_midi_notes(self.midi_path).pitch.tolist(), [99])
+
+    def test_reload_stale_sidecar(self):
+        write_midi(create_midi([36, 38]), self.midi_path)
+        self.save_marked_sidecar()
+
+        # 内容が異なるファイルに書き換える (更新日時の分解能によらず、更新日時も変える)
+        stat = os.stat(self.midi_path)
+        write_midi(create_midi([42, 46]), self.midi_path)
+        os.utime(self.midi_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+        self.assertEqual(load_midi_notes(self.midi_path).pitch.tolist(), [42, 46])
+        # 作り直した.notes.npzを使う
+        self.assertEqual(load_midi_notes(self.midi_path).pitch.tolist(), [42, 46])
+
+    def test_reload_broken_sidecar(self):
+        write_midi(create_midi([36, 38]), self.midi_path)
+        with open(get_notes_sidecar_path(self.midi_path), "wb") as f:
+            f.write(b"broken")
+
+        self.assertEqual(load_midi_notes(self.midi_path).pitch.tolist(), [36, 38])
@@ -0,0 +1,205 @@
+import os
+import tempfile
+import time
+from types import SimpleNamespace
+import unittest
+
+import numpy as np
+import soundfile as sf
+
+from scripts.feature_cache import evict_feature_cache, incomplete_cache_max_age
+from scripts.separate_music import SeparationCache, SeparationJob, SeparationService, SeparationSource, separate_music, separation_stems
+
+sr = 1000
+
+class FakeSeparationService(SeparationService):
+    """
+    Demucsのかわりにapply(wav, 呼び出し回数)の結果を返す。ワーカースレッドは起動しない
+    """
+
+    def __init__(self, apply):
+        self.pid = os.getpid()
+        self.model_name = "fake"
+        self.jobs = 1
+        self.quantized = False
+        self.device = "cpu"
+        self.model = SimpleNamespace(samplerate=sr, audio_channels=2, sources=separation_stems)
+        self.apply = apply
+        self.calls = 0
+
+    def _convert_audio(self, y, sr):
+        return np.asarray(y)
+
+    def _apply_model(self, wav, ref_mean, ref_std):
+        self.calls += 1
+        return self.apply(wav, self.calls)
+
+def identity(wav, calls):
+    return np.stack([wav] * len(separation_stems))
+
+class TestSeparateSegments(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.work_dir = os.path.join(self.tmp_dir.name, "segments")
+        self.y = np.random.default_rng(0).standard_normal((2, sr * 150)).astype(np.float32)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def separate(self, service, stems=separation_stems):
+        messages = []
+        job = SeparationJob(source=(self.y, sr), stems=stems, progress=lambda fraction, message: messages.append(message), work_dir=self.work_dir)
+        return service._separate(job), messages
+
+    def test_identity(self):
+        service = FakeSeparationService(identity)
+
+        result, _ = self.separate(service)
+
+        # 60秒ごと、2秒重ねて3区間
+        self.assertEqual(service.calls, 3)
+        self.assertEqual(sorted(result.sources.keys()), sorted(separation_stems))
+        for stem in separation_stems:
+            np.testing.assert_allclose(result.sources[stem], self.y, atol=1e-6)
+
+    def test_crossfade(self):
+        # 区間ごと、ステムごとに異なる定数を返す
+        service = FakeSeparationService(lambda wav, calls: np.stack([np.full(wav.shape, calls + 10 * i, dtype=np.float32) for i in range(len(separation_stems))]))
+
+        result, _ = self.separate(service, ["drums", "vocals"])
+
+        fade_in = (np.arange(2 * sr) + 0.5) / (2 * sr)
+        for stem in ["drums", "vocals"]:
+            output = result.sources[stem] - 10 * separation_stems.index(stem)
+            np.testing.assert_allclose(output[:, :58 * sr], 1, atol=1e-5)
+            np.testing.assert_allclose(output[:, 58 * sr:60 * sr], np.broadcast_to(1 + fade_in, (2, 2 * sr)), atol=1e-5)
+            np.testing.assert_allclose(output[:, 60 * sr:116 * sr], 2, atol=1e-5)
+            np.testing.assert_allclose(output[:, 116 * sr:118 * sr], np.broadcast_to(2 + fade_in, (2, 2 * sr)), atol=1e-5)
+            np.testing.assert_allclose(output[:, 118 * sr:], 3, atol=1e-5)
+
+    def test_resume(self):
+        result, _ = self.separate(FakeSeparationService(identity))
+        expected = np.array(result.sources["drums"])
+        del result
+
+        # 途中の区間だけ分離し直す
+        os.remove(os.path.join(self.work_dir, "segment_00001.npy"))
+        service = FakeSeparationService(identity)
+        result, messages = self.separate(service)
+
+        self.assertEqual(service.calls, 1)
+        self.assertIn("Load separated segment. 1/3", messages)
+        self.assertIn("Separate segment. 2/3", messages)
+        self.assertIn("Load separated segment. 3/3", messages)
+        np.testing.assert_array_equal(result.sources["drums"], expected)
+
+class TestSeparationSource(unittest.TestCase):
+
+    def test_mono_stats_after_convert(self):
+        y = np.array([[0.0, 1.0, 2.0, 3.0], [1.0, 1.0, 0.0, 3.0]], dtype=np.float32)
+        source = SeparationSource((y, sr))
+
+        # モデルの形式に変換した信号(ここでは2倍の長さ、3倍の音量)で計算する
+        mean, std = source.get_mono_stats(lambda y, sr: np.repeat(y, 2, axis=1) * 3)
+
+        ref = np.repeat(y.mean(axis=0), 2) * 3
+        self.assertAlmostEqual(mean, ref.mean(), places=5)
+        self.assertAlmostEqual(std, ref.std(ddof=1), places=5)
+
+class TestEvictIncompleteCache(unittest.TestCase):
+
+    def test_evict_incomplete_cache(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            entry_dirs = {}
+            for name in ["old", "new"]:
+                entry_dirs[name] = os.path.join(cache_dir, name)
+                os.makedirs(os.path.join(entry_dirs[name], "segments"))
+                with open(os.path.join(entry_dirs[name], "segments", "segment_00000.npy"), "wb") as f:
+                    f.write(b"0" * 100)
+
+            # 中断してからしばらく更新されていない区間
+            old_time = time.time() - incomplete_cache_max_age - 60
+            for root, _, files in os.walk(entry_dirs["old"]):
+                for file in files:
+                    os.utime(os.path.join(root, file), (old_time, old_time))
+                os.utime(root, (old_time, old_time))
+
+            evict_feature_cache(cache_dir, 1024)
+
+            self.assertFalse(os.path.exists(entry_dirs["old"]))
+            self.assertTrue(os.path.exists(entry_dirs["new"]))
+
+class StubSeparationService(SeparationService):
+    """
+    Demucsのモデルのかわりに、入力をステムごとに(番号 + 1) / 4倍した音声を返す。ワーカースレッドは実際に起動する
+    """
+
+    def _load_model(self):
+        self.calls = 0
+        return SimpleNamespace(samplerate=sr, audio_channels=2, sources=separation_stems)
+
+    def _convert_audio(self, y, sr):
+        return np.asarray(y)
+
+    def _apply_model(self, wav, ref_mean, ref_std):
+        self.calls += 1
+        return np.stack([wav * (i + 1) / 4 for i in range(len(separation_stems))])
+
+class TestSeparateMusic(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.input_path = os.path.join(self.tmp_dir.name, "bgm.wav")
+        self.cache_dir = os.path.join(self.tmp_dir.name, "cache")
+        self.y = (np.random.default_rng(0).standard_normal((2, sr * 3)) * 0.1).astype(np.float32)
+        sf.write(self.input_path, self.y.T, sr, subtype="FLOAT")
+
+        self.service = StubSeparationService("stub", 1)
+        SeparationService._instance = self.service
+
+    def tearDown(self):
+        SeparationService._instance = None
+        self.service.close()
+        self.tmp_dir.cleanup()
+
+    def get_output_path(self, name):
+        return os.path.join(self.tmp_dir.name, "out", name)
+
+    def assert_stem(self, path, stem):
+        y, file_sr = sf.read(path, dtype="float32", always_2d=True)
+        self.assertEqual(file_sr, sr)
+        np.testing.assert_allclose(y.T, self.y * (separation_stems.index(stem) + 1) / 4, atol=1e-4)
+
+    def test_separate_whole(self):
+        messages = []
+        output_path = self.get_output_path("drums.wav")
+
+        output_files = separate_music("stub", self.input_path, {"drums": output_path}, 1, progress=lambda fraction, message: messages.append(message))
+
+        self.assertEqual(output_files, [output_path])
+        self.assertEqual(self.service.calls, 1)
+        self.assertIn("Separate music. stub", messages)
+        self.assert_stem(output_path, "drums")
+
+    def test_separate_with_cache(self):
+        output_paths = {"drums": self.get_output_path("drums.wav"), "bass": self.get_output_path("bass.wav")}
+
+        # キャッシュがない場合は全てのステムを分離して保存する
+        separate_music("stub", self.input_path, output_paths, 1, cache_dir=self.cache_dir, analyze=True)
+
+        cache = SeparationCache(self.input_path, "stub", self.cache_dir)
+        self.assertEqual(self.service.calls, 1)
+        self.assertTrue(cache.has(separation_stems))
+        self.assertFalse(os.path.exists(cache.get_work_dir()))
+        for stem, output_path in output_paths.items():
+            self.assert_stem(output_path, stem)
+
+        # キャッシュがある場合は分離せずに、キャッシュのステムをハードリンクする
+        output_path = self.get_output_path("vocals.wav")
+        output_files = separate_music("stub", self.input_path, {"vocals": output_path}, 1, cache_dir=self.cache_dir)
+
+        self.assertEqual(output_files, [output_path])
+        self.assertEqual(self.service.calls, 1)
+        self.assertTrue(os.path.samefile(output_path, cache.get_stem_path("vocals")))
+        self.assert_stem(output_path, "vocals")